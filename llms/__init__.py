@@ -1,8 +1,26 @@
-from .gpt4 import GPT4
-from .depictqa import DepictQA
-from .gpt4_az import GPT4_AZ
-from .gemini import GEMINI
-from .qwen import QWEN
+import importlib
 
+from .registry import LLM_BACKENDS, get_llm, register_llm, release_llm
 
-__all__ = ["GPT4", "DepictQA","GPT4_AZ","GEMINI","QWEN"]
+
+# backends are imported on first access, so a run only loads the SDKs it uses
+_LAZY_ATTRS = {
+    "GPT4": ".gpt4",
+    "DepictQA": ".depictqa",
+    "GPT4_AZ": ".gpt4_az",
+    "GEMINI": ".gemini",
+    "QWEN": ".qwen",
+}
+
+
+def __getattr__(name: str):
+    if name in _LAZY_ATTRS:
+        return getattr(importlib.import_module(_LAZY_ATTRS[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> list[str]:
+    return sorted(__all__)
+
+
+__all__ = ["GPT4", "DepictQA","GPT4_AZ","GEMINI","QWEN", "LLM_BACKENDS", "get_llm", "register_llm", "release_llm"]
@@ -1,19 +1,53 @@
+import asyncio
+import contextvars
+import json
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from pathlib import Path
 import logging
+import threading
+from time import perf_counter
 from typing import Optional,Union
 import yaml
 from utils.textwork import correct_string
 from utils.misc import encode_img
 from utils.logger import get_logger
+from .cache import get_cache, query_key
+from .hedging import HedgePolicy
+from .metering import CallRecord, current_call, mark_first_token, record_call
+from .rate_limit import DEFAULT_RETRY_AFTER, estimate_tokens, get_limiter, is_rate_limited, retry_after
+from .single_flight import asingle_flight, single_flight
+from .streaming import ChunkConsumer, StreamAborted, consuming, current_consumer
+from .structured import StructuredOutputError, conform, repair_instructions, requesting, schema_instructions
+
+
+# runs the hedged calls of all LLMs, which may outlive the call that started them
+_hedge_executor: Optional[ThreadPoolExecutor] = None
+_hedge_executor_lock = threading.Lock()
+
+
+def _submit_hedged(fn, *args, **kwargs) -> Future:
+    global _hedge_executor
+    with _hedge_executor_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="hedge")
+    # keeps the call record, stage and rate limit reservations of the caller
+    return _hedge_executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
 
 
 class BaseLLM:
+    # section of config.yml holding the settings of the backend
+    config_section: Optional[str] = None
+    # whether the provider can be asked for output matching a JSON schema, see STRUCTURED_OUTPUT in config.yml
+    supports_structured_output: bool = False
+
     def __init__(self,
                  config_path: Optional[Path] = None,
                  log_path: Optional[Path] = None,
                  logger: Optional[logging.Logger] = None,
                  silent: bool = False
                  ):
+        self.config_path = config_path
         if config_path is not None:
             with open(config_path, "r") as f:
                 self.cfg: dict = yaml.safe_load(f)
@@ -22,6 +56,35 @@ class BaseLLM:
 
         self.silent = silent
 
+        # USD per 1K tokens, used by the metering of each call
+        section = ((self.cfg or {}).get(self.config_section) or {}) if self.config_section else {}
+        self.prompt_price = section.get("PROMPT_PRICE", 0.0)
+        self.completion_price = section.get("COMPLETION_PRICE", 0.0)
+        # whether backends that support it stream every response, not only those with a chunk consumer
+        self.stream = section.get("STREAM", False)
+        # provider mode for calls with a schema: True, or "json_schema" / "json_object" for OpenAI, False for none
+        self.structured_output = section.get("STRUCTURED_OUTPUT", False) if self.supports_structured_output else False
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # one instance serves the planner, evaluator and art agent from several threads
+        self._usage_lock = threading.Lock()
+        # requests and tokens per minute of the provider, shared by all its clients in the process
+        self.rate_limiter = None
+        if self.config_section is not None:
+            self.rate_limiter = get_limiter(self.config_section, section.get("RPM", 0), section.get("TPM", 0))
+
+        # opt-in hedging of slow calls with a secondary backend
+        self.hedge = None
+        hedge_cfg = section.get("HEDGE") or {}
+        if hedge_cfg.get("ENABLED", False):
+            self.hedge = HedgePolicy(hedge_cfg["BACKEND"],
+                                     percentile=hedge_cfg.get("PERCENTILE", 95),
+                                     min_delay=hedge_cfg.get("MIN_DELAY", 20),
+                                     max_fraction=hedge_cfg.get("MAX_FRACTION", 0.1))
+        # secondary backend, taken from the registry on the first hedge and given back with this instance
+        self._hedge_llm = None
+        self._hedge_llm_lock = threading.Lock()
+
         self.logger = None
         if logger is not None:
             assert log_path is None, "log_path should be None when logger is provided."
@@ -34,16 +97,211 @@ class BaseLLM:
                 file_format_str="%(message)s",
                 silent=self.silent)
 
+        # opt-in disk cache of the responses, shared by all LLMs with the same cache directory
+        self.cache = None
+        cache_cfg = (self.cfg or {}).get("LLM_CACHE") or {}
+        if cache_cfg.get("ENABLED", False):
+            self.cache = get_cache(cache_cfg.get("DIR", "cache/llm"),
+                                   cache_cfg.get("MAX_SIZE_MB", 512))
+
     def query(self,
               img_path_lst: Optional[list[Path]] = None,
               *args, **kwargs) -> tuple[str, str]:
         """Returns the prompt and response in text."""
         raise NotImplementedError
 
+    async def aquery(self,
+                     img_path_lst: Optional[list[Path]] = None,
+                     *args, **kwargs) -> tuple[str, str]:
+        """Async version of `query`. Backends without an async client run `query` in a worker thread."""
+        return await asyncio.to_thread(self.query, img_path_lst, *args, **kwargs)
+
     def __call__(self,
                  img_path: Optional[Union[Path, list[Path]]] = None,
-                 *args, **kwargs) -> str:
-        """Queries the model and logs the chat."""
+                 *args,
+                 use_cache: bool = True,
+                 on_chunk: Optional[ChunkConsumer] = None,
+                 schema: Optional[dict] = None,
+                 **kwargs) -> str:
+        """Queries the model and logs the chat.
+
+        With the response cache enabled, a query identical to an earlier one returns the earlier response.
+        `use_cache=False` queries the model anyway and refreshes the cached response.
+        Identical calls in progress at the same time share one request and its response, unless `use_cache=False`.
+        Backends that stream pass each chunk of the response to `on_chunk`, which may raise `StreamAborted`
+        to stop the generation; the text received so far is then returned, but neither cached nor shared with the
+        identical calls, which make their own request. Only the caller making the request gets the chunks.
+        With a JSON `schema`, the provider is asked for matching output where it supports it, and the response is
+        repaired and validated locally, then asked again once if it still does not match. The response is then
+        JSON text, not wrapped in quotes for `eval`; `StructuredOutputError` is raised if it never matched.
+        """
+        img_path_lst, kwargs, cache_key = self._prepare_call(img_path, args, kwargs, schema)
+        with record_call(CallRecord(self.__class__.__name__, self._cache_identity()["model"])) as record:
+            rsp_text = self._cached_response(cache_key, use_cache, record)
+            if rsp_text is not None:
+                prompt = kwargs.get("prompt", "")
+            else:
+                def request() -> tuple[str, str]:
+                    with consuming(on_chunk), requesting(schema):
+                        prompt, rsp_text = self._query_hedged(img_path_lst, args, kwargs)
+                    if schema is not None:
+                        structured, errors = self._conform(rsp_text, schema)
+                        if errors:
+                            with requesting(schema):
+                                _, rsp_text = self._query_hedged(img_path_lst, args,
+                                                                 self._repair_kwargs(kwargs, rsp_text, errors))
+                            rsp_text = self._conformed(rsp_text, schema)
+                            # asked again without the consumer, so complete
+                            record.aborted = False
+                        else:
+                            rsp_text = structured
+                    return prompt, self._store_response(cache_key, rsp_text, schema, record.aborted), record.aborted
+                if use_cache:
+                    (prompt, rsp_text, aborted), record.coalesced = single_flight(cache_key, request)
+                    if aborted and record.coalesced:
+                        # stopped by the consumer of another caller
+                        record.coalesced = False
+                        prompt, rsp_text, _ = request()
+                else:
+                    prompt, rsp_text, _ = request()
+        self._finish_call(prompt, img_path_lst, rsp_text)
+        return rsp_text
+
+    async def acall(self,
+                    img_path: Optional[Union[Path, list[Path]]] = None,
+                    *args,
+                    use_cache: bool = True,
+                    on_chunk: Optional[ChunkConsumer] = None,
+                    schema: Optional[dict] = None,
+                    **kwargs) -> str:
+        """Async version of `__call__`, with the same caching, metering, logging, hedging and schema handling."""
+        img_path_lst, kwargs, cache_key = self._prepare_call(img_path, args, kwargs, schema)
+        with record_call(CallRecord(self.__class__.__name__, self._cache_identity()["model"])) as record:
+            rsp_text = self._cached_response(cache_key, use_cache, record)
+            if rsp_text is not None:
+                prompt = kwargs.get("prompt", "")
+            else:
+                async def request() -> tuple[str, str]:
+                    with consuming(on_chunk), requesting(schema):
+                        prompt, rsp_text = await self._aquery_hedged(img_path_lst, args, kwargs)
+                    if schema is not None:
+                        structured, errors = self._conform(rsp_text, schema)
+                        if errors:
+                            with requesting(schema):
+                                _, rsp_text = await self._aquery_hedged(img_path_lst, args,
+                                                                        self._repair_kwargs(kwargs, rsp_text, errors))
+                            rsp_text = self._conformed(rsp_text, schema)
+                            record.aborted = False
+                        else:
+                            rsp_text = structured
+                    return prompt, self._store_response(cache_key, rsp_text, schema, record.aborted), record.aborted
+                if use_cache:
+                    (prompt, rsp_text, aborted), record.coalesced = await asingle_flight(cache_key, request)
+                    if aborted and record.coalesced:
+                        record.coalesced = False
+                        prompt, rsp_text, _ = await request()
+                else:
+                    prompt, rsp_text, _ = await request()
+        self._finish_call(prompt, img_path_lst, rsp_text)
+        return rsp_text
+
+    def _query_hedged(self, img_path_lst: Optional[list], args: tuple, kwargs: dict) -> tuple[str, str]:
+        """Runs `query`. With hedging enabled, a call slower than the threshold of the policy is also sent to the
+        secondary backend, and the first successful response is returned."""
+        if self.hedge is None:
+            return self.query(img_path_lst, *args, **kwargs)
+        self.hedge.start_call()
+        started = perf_counter()
+        primary = _submit_hedged(self.query, img_path_lst, *args, **kwargs)
+        primary.add_done_callback(lambda _: self.hedge.observe(perf_counter() - started))
+        delay = self.hedge.delay()
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+        if not self.hedge.try_hedge():
+            return primary.result()
+
+        self._log(f"_No response after {delay:.1f} seconds, hedging with {self.hedge.backend}_")
+        record = current_call()
+        if record is not None:
+            record.hedged = True
+        secondary = _submit_hedged(self._query_secondary, img_path_lst, args, kwargs)
+        pending = {primary, secondary}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is secondary:
+                        self.hedge.won()
+                        if record is not None:
+                            record.hedge_won = True
+                    self._log(f"_{self.hedge.stats()} so far_")
+                    # the other request runs to completion in the background
+                    return future.result()
+        # both failed
+        return primary.result()
+
+    async def _aquery_hedged(self, img_path_lst: Optional[list], args: tuple, kwargs: dict) -> tuple[str, str]:
+        """Async version of `_query_hedged`, with the secondary request in a task of the same event loop."""
+        if self.hedge is None:
+            return await self.aquery(img_path_lst, *args, **kwargs)
+        self.hedge.start_call()
+        started = perf_counter()
+        primary = asyncio.ensure_future(self.aquery(img_path_lst, *args, **kwargs))
+        primary.add_done_callback(lambda _: self.hedge.observe(perf_counter() - started))
+        delay = self.hedge.delay()
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not self.hedge.try_hedge():
+            return await primary
+
+        self._log(f"_No response after {delay:.1f} seconds, hedging with {self.hedge.backend}_")
+        record = current_call()
+        if record is not None:
+            record.hedged = True
+        secondary = asyncio.ensure_future(self._aquery_secondary(img_path_lst, args, kwargs))
+        pending = {primary, secondary}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is secondary:
+                        self.hedge.won()
+                        if record is not None:
+                            record.hedge_won = True
+                    self._log(f"_{self.hedge.stats()} so far_")
+                    # the other request runs to completion in the background, its error is not reported
+                    for other in pending:
+                        other.add_done_callback(lambda task: task.cancelled() or task.exception())
+                    return future.result()
+        # both failed
+        return await primary
+
+    def _secondary_llm(self) -> "BaseLLM":
+        """Backend hedging the calls, taken from the registry on the first hedge."""
+        from .registry import get_llm
+
+        with self._hedge_llm_lock:
+            if self._hedge_llm is None:
+                self._hedge_llm = get_llm(self.hedge.backend, self.config_path, logger=self.logger,
+                                          silent=self.silent, system_message=getattr(self, "system_message", None))
+            return self._hedge_llm
+
+    def _query_secondary(self, img_path_lst: Optional[list], args: tuple, kwargs: dict) -> tuple[str, str]:
+        secondary = self._secondary_llm()
+        # the chunk consumer follows the stream of the primary backend only
+        with consuming(None):
+            return secondary.query(img_path_lst, *args, **kwargs)
+
+    async def _aquery_secondary(self, img_path_lst: Optional[list], args: tuple, kwargs: dict) -> tuple[str, str]:
+        secondary = self._secondary_llm()
+        with consuming(None):
+            return await secondary.aquery(img_path_lst, *args, **kwargs)
+
+    def _prepare_call(self, img_path, args: tuple, kwargs: dict,
+                      schema: Optional[dict] = None) -> tuple[Optional[list], dict, str]:
+        """Normalizes the images to a list, adds the schema to the prompt and computes the key of the call,
+        for the cache and for sharing identical calls in progress."""
         img_path_lst = img_path
         if img_path is not None:
             if isinstance(img_path, Path):
@@ -51,8 +309,49 @@ class BaseLLM:
             else:
                 assert isinstance(img_path, list), \
                     f"Unexpected type of img_path: {type(img_path)}"
-        prompt, rsp_text = self.query(img_path_lst, *args, **kwargs)
-        rsp_text = correct_string(rsp_text)
+        if schema is not None:
+            # also for json_object mode and backends without a structured output mode
+            kwargs = {**kwargs, "prompt": kwargs.get("prompt", "") + schema_instructions(schema)}
+        cache_key = query_key(self._cache_identity(), getattr(self, "system_message", None),
+                              (img_path_lst,) + args, kwargs)
+        return img_path_lst, kwargs, cache_key
+
+    def _cached_response(self, cache_key: str, use_cache: bool, record: CallRecord) -> Optional[str]:
+        rsp_text = self.cache.get(cache_key) if self.cache is not None and use_cache else None
+        if rsp_text is not None:
+            record.cached = True
+            self._log(f"_Cached response ({self.cache.stats()} so far)_")
+        return rsp_text
+
+    def _conform(self, rsp_text: str, schema: dict) -> tuple[Optional[str], list[str]]:
+        """Returns the response as JSON text matching `schema` after the local repair, or the problems left."""
+        value, errors = conform(rsp_text, schema)
+        if errors:
+            self._log(f"The response does not match the schema: {'; '.join(errors)}", level='warning')
+            return None, errors
+        return json.dumps(value, ensure_ascii=False), []
+
+    def _conformed(self, rsp_text: str, schema: dict) -> str:
+        structured, errors = self._conform(rsp_text, schema)
+        if errors:
+            raise StructuredOutputError(f"The response does not match the schema: {'; '.join(errors)}")
+        return structured
+
+    def _repair_kwargs(self, kwargs: dict, rsp_text: str, errors: list[str]) -> dict:
+        """Query arguments asking again for a response that did not match the schema."""
+        self._meter_retry()
+        return {**kwargs, "prompt": kwargs.get("prompt", "") + repair_instructions(rsp_text, errors)}
+
+    def _store_response(self, cache_key: str, rsp_text: str, schema: Optional[dict] = None,
+                        aborted: bool = False) -> str:
+        if schema is None:
+            rsp_text = correct_string(rsp_text)
+        # a response stopped early is not the answer to the query
+        if self.cache is not None and not aborted:
+            self.cache.put(cache_key, rsp_text)
+        return rsp_text
+
+    def _finish_call(self, prompt: str, img_path_lst: Optional[list], rsp_text: str) -> None:
         img_base64_lst = []
         if img_path_lst is not None:
             for img_path in img_path_lst:
@@ -62,11 +361,99 @@ class BaseLLM:
         self._log_chat(prompt, img_base64_lst, rsp_text)
         self._post_process()
 
-        return rsp_text
-
     def _post_process(self):
         pass
 
+    def _meter_usage(self, prompt_tokens: int, completion_tokens: int) -> None:
+        """Adds the tokens of one request to the totals of the client and to the call in progress."""
+        with self._usage_lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+        record = current_call()
+        if record is not None:
+            record.prompt_tokens += prompt_tokens
+            record.completion_tokens += completion_tokens
+            record.cost += prompt_tokens/1000*self.prompt_price + completion_tokens/1000*self.completion_price
+        if self.rate_limiter is not None:
+            self.rate_limiter.settle(prompt_tokens + completion_tokens)
+
+    def _meter_retry(self) -> None:
+        """Counts a failed request or a response asked again in the call in progress."""
+        record = current_call()
+        if record is not None:
+            record.retries += 1
+
+    def _streams(self) -> bool:
+        """Whether to stream the response of the call in progress."""
+        return self.stream or current_consumer() is not None
+
+    def _stream_start(self) -> None:
+        """Tells the consumer of the call that a new attempt starts streaming, so that it forgets the chunks of
+        the previous one. Consumers with a `reset` method only."""
+        reset = getattr(current_consumer(), "reset", None)
+        if reset is not None:
+            reset()
+
+    def _stream_chunk(self, chunk: str) -> None:
+        """Passes a chunk of a streamed response to the consumer of the call, if any."""
+        mark_first_token()
+        consumer = current_consumer()
+        if consumer is not None:
+            consumer(chunk)
+
+    def _stream_aborted(self, e: StreamAborted) -> None:
+        """Notes that the consumer stopped the response of the call in progress, so that it is not cached."""
+        self._log(f"Stopped the response early: {e}", level='warning')
+        record = current_call()
+        if record is not None:
+            record.aborted = True
+
+    def _throttle(self, messages: object = None) -> None:
+        """Waits until the rate limits of the provider allow another request with `messages`."""
+        if self.rate_limiter is not None:
+            waited = self.rate_limiter.acquire(estimate_tokens(messages))
+            if waited > 0:
+                self._log(f"_Waited {waited:.1f} seconds for the rate limit of {self.rate_limiter.name}_")
+
+    async def _athrottle(self, messages: object = None) -> None:
+        """Async version of `_throttle`."""
+        if self.rate_limiter is not None:
+            waited = await self.rate_limiter.aacquire(estimate_tokens(messages))
+            if waited > 0:
+                self._log(f"_Waited {waited:.1f} seconds for the rate limit of {self.rate_limiter.name}_")
+
+    def _retry_hint(self, error: BaseException) -> Optional[float]:
+        """Returns the delay before retrying after a rate limit error, preferably the one given by the provider, or None for other errors."""
+        if not is_rate_limited(error):
+            return None
+        delay = retry_after(error)
+        return delay if delay is not None else DEFAULT_RETRY_AFTER
+
+    def _hold_off(self, delay: float) -> None:
+        """Makes every client of the provider wait `delay` seconds after a rate limit error."""
+        if self.rate_limiter is not None:
+            self.rate_limiter.penalize(delay)
+
+    def _log_usage(self) -> None:
+        """Logs the token usage and cost of the client so far."""
+        self._log("Token usage so far: "
+                  f"{self.prompt_tokens} prompt tokens, "
+                  f"{self.completion_tokens} completion tokens")
+        total_cost = self.prompt_tokens/1000*self.prompt_price + self.completion_tokens/1000*self.completion_price
+        self._log(f"Cost so far: ${total_cost:.5f}")
+
+    def _cache_identity(self) -> dict:
+        """Backend, model and temperature, which a cached response must match."""
+        model = getattr(self, "model", None)
+        if not isinstance(model, str):
+            # local models keep the loaded model in `model` and its directory in `dir`
+            model = getattr(self, "dir", None)
+        return {
+            "backend": self.__class__.__name__,
+            "model": model,
+            "temperature": getattr(self, "temperature", None),
+        }
+
     def _log_chat(self,
                   prompt: str,
                   img_base64_lst: list[str],
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Optional, Union
+
+from utils.misc import hash_file
+
+
+def hash_attachment(obj: object) -> object:
+    """Returns a JSON-serializable digest of a query argument, hashing the content of files and images."""
+    if isinstance(obj, (list, tuple)):
+        return [hash_attachment(item) for item in obj]
+    if isinstance(obj, Path):
+        return "file:" + hash_file(obj)
+    if hasattr(obj, "tobytes") and hasattr(obj, "mode"):
+        # PIL image, e.g. key frames of a candidate video
+        sha = hashlib.sha256(f"{obj.mode}{obj.size}".encode())
+        sha.update(obj.tobytes())
+        return "image:" + sha.hexdigest()
+    if obj is None or isinstance(obj, (str, int, float, bool)):
+        return obj
+    if callable(obj):
+        return getattr(obj, "__qualname__", repr(obj))
+    return repr(obj)
+
+
+def query_key(identity: dict, system_message: Optional[str], args: tuple, kwargs: dict) -> str:
+    """Hashes the identity of the model (backend, model, temperature), the system message and the query arguments."""
+    data = {
+        "identity": identity,
+        "system_message": system_message,
+        "args": hash_attachment(list(args)),
+        "kwargs": {name: hash_attachment(value) for name, value in kwargs.items()},
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Disk cache of LLM responses, keyed by the content of the query.
+
+    Each response is stored in its own JSON file. When the cache grows beyond
+    `max_size_mb`, the least recently used responses are evicted.
+
+    Args:
+        cache_dir (Path): Directory of the cache, created if missing.
+        max_size_mb (float, optional): Maximum total size of the cached responses. Defaults to 512.
+    """
+
+    def __init__(self, cache_dir: Union[Path, str], max_size_mb: float = 512) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = sum(path.stat().st_size for path in self.cache_dir.glob("*/*.json"))
+
+    def key(self, identity: dict, system_message: Optional[str], args: tuple, kwargs: dict) -> str:
+        return query_key(identity, system_message, args, kwargs)
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the cached response, or None on a miss."""
+        path = self._path(key)
+        with self._lock:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    response = json.load(f)["response"]
+            except (OSError, ValueError, KeyError):
+                self.misses += 1
+                return None
+            # the modification time orders the entries for eviction
+            os.utime(path)
+            self.hits += 1
+            return response
+
+    def put(self, key: str, response: str) -> None:
+        path = self._path(key)
+        with self._lock:
+            path.parent.mkdir(exist_ok=True)
+            old_size = path.stat().st_size if path.exists() else 0
+            tmp_path = path.with_suffix(".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"response": response}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            self._size += path.stat().st_size - old_size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Removes the least recently used responses until the cache is at most 90% full."""
+        entries = sorted(self.cache_dir.glob("*/*.json"), key=lambda path: path.stat().st_mtime)
+        for path in entries:
+            if self._size <= self.max_size * 0.9:
+                break
+            self._size -= path.stat().st_size
+            path.unlink()
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({rate:.0%} hit rate)"
+
+
+_caches: dict[str, ResponseCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(cache_dir: Union[Path, str], max_size_mb: float = 512) -> ResponseCache:
+    """Returns the cache of `cache_dir`, shared by all the LLMs of the process so they share counters and eviction."""
+    cache_dir = str(Path(cache_dir).resolve())
+    with _caches_lock:
+        if cache_dir not in _caches:
+            _caches[cache_dir] = ResponseCache(cache_dir, max_size_mb)
+        return _caches[cache_dir]
@@ -1,9 +1,9 @@
 from pathlib import Path
-import requests
 import logging
 from typing import Optional,Union
 
 from .base_llm import BaseLLM
+from utils.http import get_session
 from utils.custom_types import Degradation, Level
 
 
@@ -72,7 +72,7 @@ class DepictQA(BaseLLM):
             )
             url = "http://127.0.0.1:5001/evaluate_degradation"
             payload = {"imageA_path": img.resolve(), "prompt": prompt}
-            rsp: str = requests.post(url, data=payload).json()["answer"]
+            rsp: str = get_session().post(url, data=payload).json()["answer"]
             assert rsp in levels, f"Unexpected response from DepictQA: {list(rsp)}"
             res.append((degradation, rsp))
 
@@ -89,7 +89,7 @@ class DepictQA(BaseLLM):
             "imageB_path": img2.resolve(),
             "prompt": prompt
         }
-        rsp: str = requests.post(url, data=payload).json()["answer"]
+        rsp: str = get_session().post(url, data=payload).json()["answer"]
 
         if "A" in rsp and "B" not in rsp:
             choice = "former"
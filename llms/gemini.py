@@ -1,3 +1,4 @@
+import asyncio
 from pathlib import Path
 import requests
 import logging
@@ -7,20 +8,35 @@ import random
 import re
 import google.generativeai as genai
 from .base_llm import BaseLLM
+from .streaming import StreamAborted
+from .structured import current_schema, gemini_schema
 import base64
 import httpx
 from typing_extensions import override
 from google.generativeai.types import content_types
 import base64
+import os
+import threading
+from functools import lru_cache
 from io import BytesIO
+from types import SimpleNamespace
 
 def encode_pdf(pdf_path: Union[Path, str]) -> str:
+    """Returns the base64 of the PDF, encoded once per file version."""
+    stat = os.stat(pdf_path)
+    return _encode_pdf(str(Path(pdf_path).resolve()), stat.st_mtime_ns, stat.st_size)
+
+@lru_cache(maxsize=8)
+def _encode_pdf(pdf_path: str, mtime_ns: int, size: int) -> str:
+    # mtime and size are only part of the cache key, so an edited file is encoded again
     with open(pdf_path, "rb") as doc_file:
         doc_data = base64.standard_b64encode(doc_file.read()).decode("utf-8")
         return doc_data
 
 class GEMINI(BaseLLM):
     """Parameters when called: img_path_lst, prompt, format_check."""
+    config_section = "GEMINI"
+    supports_structured_output = True
     def __init__(self,
                  config_path: Path = Path("config.yml"),
                  log_path: Optional[Union[Path, str]] = None,
@@ -43,6 +59,10 @@ class GEMINI(BaseLLM):
             self.model = model
         self.max_tokens = self.cfg["GEMINI"]["MAX_TOKENS"]
         self.temperature = self.cfg["GEMINI"]["TEMPERATURE"]
+        # upload each PDF once through the File API and refer to it, instead of sending it inline in every call
+        self.upload_pdf = self.cfg["GEMINI"].get("UPLOAD_PDF", False)
+        self._uploaded_pdfs: dict[tuple[str, int, int], object] = {}
+        self._upload_lock = threading.Lock()
         self.prompt_tokens = 0
         self.completion_tokens = 0
         genai.configure(api_key=self.api_key)
@@ -71,13 +91,13 @@ class GEMINI(BaseLLM):
             response = self._send_request(message)
 
             usage = response.usage_metadata
-            self.prompt_tokens += usage.prompt_token_count
-            self.completion_tokens += usage.candidates_token_count
+            self._meter_usage(usage.prompt_token_count, usage.candidates_token_count)
 
             rsp_text: str = response.text
             if format_check is not None:
                 valid, rsp_text = self._check_syntax(rsp_text, format_check)
                 if not valid:
+                    self._meter_retry()
                     continue
             return prompt, rsp_text
 
@@ -96,9 +116,13 @@ class GEMINI(BaseLLM):
                 content.append(
                 {"mime_type": "image/png", "data": b64_str})
         if pdf_path is not None:
-            doc_data = encode_pdf(pdf_path)
-            content.append(
-                {'mime_type': 'application/pdf', 'data': doc_data})
+            uploaded_pdf = self._upload_pdf(pdf_path) if self.upload_pdf else None
+            if uploaded_pdf is not None:
+                content.append(uploaded_pdf)
+            else:
+                doc_data = encode_pdf(pdf_path)
+                content.append(
+                    {'mime_type': 'application/pdf', 'data': doc_data})
                 
         content.append(prompt)
         
@@ -106,6 +130,54 @@ class GEMINI(BaseLLM):
         
         return  messages
 
+    def _upload_pdf(self, pdf_path: Union[Path, str],
+                    max_wait: int = 120):
+        """Uploads a PDF once per file version and returns the uploaded file, or None if the upload failed."""
+        stat = os.stat(pdf_path)
+        key = (str(Path(pdf_path).resolve()), stat.st_mtime_ns, stat.st_size)
+        with self._upload_lock:
+            if key in self._uploaded_pdfs:
+                return self._uploaded_pdfs[key]
+            try:
+                uploaded = genai.upload_file(pdf_path, mime_type="application/pdf")
+                waited = 0
+                while uploaded.state.name == "PROCESSING" and waited < max_wait:
+                    sleep(2)
+                    waited += 2
+                    uploaded = genai.get_file(uploaded.name)
+                if uploaded.state.name != "ACTIVE":
+                    raise RuntimeError(f"file {uploaded.name} is {uploaded.state.name}")
+            except Exception as e:
+                self._log("Failed to upload the PDF, sending it inline instead: "
+                          f"{type(e).__name__}: {e}",
+                          level='warning')
+                return None
+            self._log(f"Uploaded {key[0]} as {uploaded.name}")
+            self._uploaded_pdfs[key] = uploaded
+            return uploaded
+
+    def release(self, pdf_path: Union[Path, str]) -> None:
+        """Deletes every uploaded version of the PDF."""
+        pdf_path = str(Path(pdf_path).resolve())
+        with self._upload_lock:
+            keys = [key for key in self._uploaded_pdfs if key[0] == pdf_path]
+            for key in keys:
+                self._delete_upload(self._uploaded_pdfs.pop(key))
+
+    def close(self) -> None:
+        """Deletes the PDFs uploaded by this client."""
+        with self._upload_lock:
+            for uploaded in self._uploaded_pdfs.values():
+                self._delete_upload(uploaded)
+            self._uploaded_pdfs.clear()
+
+    def _delete_upload(self, uploaded) -> None:
+        try:
+            genai.delete_file(uploaded.name)
+        except Exception as e:
+            self._log(f"Failed to delete {uploaded.name}: {type(e).__name__}: {e}",
+                      level='warning')
+
     def _send_request(self, messages: list,
                       max_retries: int = 5,
                       initial_delay: int = 3,
@@ -116,24 +188,33 @@ class GEMINI(BaseLLM):
         n_retries = 0
         backoff_delay = initial_delay
         while True:
+            self._throttle(messages)
             try:
-                response = self.client.generate_content(messages, 
-                                                        generation_config = genai.GenerationConfig(max_output_tokens=self.max_tokens,
-                                                                                                   temperature=self.temperature))
+                generation_config = self._generation_config()
+                if self._streams():
+                    response, aborted = self._stream_content(messages, generation_config)
+                    if aborted:
+                        return response
+                else:
+                    response = self.client.generate_content(messages,
+                                                            generation_config=generation_config)
                 is_valid, recommended_delay = self._check_response(response)
-                if response!=None:
+                if is_valid:
                     return response
             except Exception as e:
                 self._log("An error occurred when sending a request: "
                           f"{type(e).__name__}: {e}",
                           level='warning')
-                recommended_delay = None
+                recommended_delay = self._retry_hint(e)
 
             n_retries += 1
+            self._meter_retry()
             if n_retries > max_retries:
                 raise RuntimeError(
                     "Too many errors occurred when querying LLM.")
             if recommended_delay is not None:
+                # every client of the provider holds off, not only this one
+                self._hold_off(recommended_delay)
                 delay = recommended_delay
             else:
                 backoff_delay *= exp_base * (1 + jitter*random.random())
@@ -142,38 +223,150 @@ class GEMINI(BaseLLM):
                 f"Retrying in {delay:.3f} seconds...", level='warning')
             sleep(delay)
 
-    def _check_response(self, response: requests.Response) -> tuple[bool, Optional[float]]:
+    def _generation_config(self) -> genai.GenerationConfig:
+        """Sampling settings, and the JSON mode and schema of the call in progress if it has one."""
+        schema = current_schema()
+        if schema is not None and self.structured_output:
+            return genai.GenerationConfig(max_output_tokens=self.max_tokens,
+                                          temperature=self.temperature,
+                                          response_mime_type="application/json",
+                                          response_schema=gemini_schema(schema))
+        return genai.GenerationConfig(max_output_tokens=self.max_tokens,
+                                      temperature=self.temperature)
+
+    async def aquery(self,
+                     img_path_lst: Optional[list[Path]] = None,
+                     pdf_path: Optional[list[Path]] = None,
+                     prompt: str = "",
+                     format_check: Optional[Callable[[object], None]] = None,
+                     ) -> tuple[str, str]:
+        """Async version of `query`."""
+        # encoding or uploading the PDF blocks, so it runs in a worker thread
+        message = await asyncio.to_thread(
+            self._prepare_message_, prompt, img_path_lst, pdf_path)
+        while True:
+            response = await self._asend_request(message)
+
+            usage = response.usage_metadata
+            self._meter_usage(usage.prompt_token_count, usage.candidates_token_count)
+
+            rsp_text: str = response.text
+            if format_check is not None:
+                valid, rsp_text = self._check_syntax(rsp_text, format_check)
+                if not valid:
+                    self._meter_retry()
+                    continue
+            return prompt, rsp_text
+
+    async def _asend_request(self, messages: list,
+                             max_retries: int = 5,
+                             initial_delay: int = 3,
+                             exp_base: int = 2,
+                             jitter: bool = True):
+        """Async version of `_send_request`."""
+
+        n_retries = 0
+        backoff_delay = initial_delay
+        while True:
+            await self._athrottle(messages)
+            try:
+                generation_config = self._generation_config()
+                if self._streams():
+                    response, aborted = await self._astream_content(messages, generation_config)
+                    if aborted:
+                        return response
+                else:
+                    response = await self.client.generate_content_async(messages,
+                                                                        generation_config=generation_config)
+                is_valid, recommended_delay = self._check_response(response)
+                if is_valid:
+                    return response
+            except Exception as e:
+                self._log("An error occurred when sending a request: "
+                          f"{type(e).__name__}: {e}",
+                          level='warning')
+                recommended_delay = self._retry_hint(e)
+
+            n_retries += 1
+            self._meter_retry()
+            if n_retries > max_retries:
+                raise RuntimeError(
+                    "Too many errors occurred when querying LLM.")
+            if recommended_delay is not None:
+                # every client of the provider holds off, not only this one
+                self._hold_off(recommended_delay)
+                delay = recommended_delay
+            else:
+                backoff_delay *= exp_base * (1 + jitter*random.random())
+                delay = backoff_delay
+            self._log( 
+                f"Retrying in {delay:.3f} seconds...", level='warning')
+            await asyncio.sleep(delay)
+
+    def _stream_content(self, messages: list, generation_config) -> tuple[object, bool]:
+        """Streams the response, passing each chunk to the consumer of the call.
+
+        Returns:
+            response: The complete response, or the text and usage received so far if the consumer aborted.
+            aborted (bool): Whether the consumer aborted the stream.
+        """
+        self._stream_start()
+        response = self.client.generate_content(messages, generation_config=generation_config, stream=True)
+        text, usage = "", None
+        try:
+            for chunk in response:
+                usage = chunk.usage_metadata
+                if chunk.parts:
+                    text += chunk.text
+                    self._stream_chunk(chunk.text)
+        except StreamAborted as e:
+            self._stream_aborted(e)
+            return SimpleNamespace(text=text, usage_metadata=usage), True
+        return response, False
+
+    async def _astream_content(self, messages: list, generation_config) -> tuple[object, bool]:
+        """Async version of `_stream_content`."""
+        self._stream_start()
+        response = await self.client.generate_content_async(messages, generation_config=generation_config,
+                                                            stream=True)
+        text, usage = "", None
+        try:
+            async for chunk in response:
+                usage = chunk.usage_metadata
+                if chunk.parts:
+                    text += chunk.text
+                    self._stream_chunk(chunk.text)
+        except StreamAborted as e:
+            self._stream_aborted(e)
+            return SimpleNamespace(text=text, usage_metadata=usage), True
+        return response, False
+
+    def _check_response(self, response) -> tuple[bool, Optional[float]]:
         """Checks if the response is valid. If error occurs, gets the recommended delay if any.
 
         Args:
-            response (requests.Response): Response from the OpenAI API to check.
+            response (GenerateContentResponse): Response from the Gemini API to check.
 
         Returns:
             is_valid (bool): Whether the response is valid.
-            recommended_delay (float | None): The delay recommended by the API if any.
+            recommended_delay (float | None): The delay recommended by the API if any. Gemini raises quota
+                errors as exceptions instead, so it is always None here.
         """
 
-        if  response._error:
-            #err_msg: str = response.json()['error']['message']
-            #self._log(f"An error occurred when querying LLM: {err_msg}",level='warning')
-
-            #recommended_delay = None
-            #if response.json()['error']['code'] == 'rate_limit_exceeded':
-                # there may exist "Please try again in xxs/xxmxxs/xxms." in the error message
-                #match = re.search(
-                    #R"(?<=Please try again in )(\d+m)?\d+\.?\d*(?=s)", err_msg)
-                #if match is not None:
-                    #t = match.group().split('m')
-                    #m = t[0] if len(t) > 1 else 0
-                    #s = t[-1]
-                    #recommended_delay = 60*int(m) + float(s)
+        if response.prompt_feedback and response.prompt_feedback.block_reason:
+            self._log(f"The prompt is blocked: {response.prompt_feedback.block_reason}",
+                      level='warning')
+            return False, None
 
-            return False#, recommended_delay
+        if not response.candidates or not response.candidates[0].content.parts:
+            finish_reason = response.candidates[0].finish_reason if response.candidates else None
+            self._log(f"Empty response, finish_reason is {finish_reason}", level='warning')
+            return False, None
 
-        if response._done:
-            #self._log(f"finish_reason if {finish_reason}", level='warning')
+        if (finish_reason := response.candidates[0].finish_reason.name) != "STOP":
+            self._log(f"finish_reason is {finish_reason}", level='warning')
 
-            return True, None
+        return True, None
 
     def _check_syntax(self, rsp_text: str, format_check: Callable[[object], None]
                       ) -> tuple[bool, str]:
@@ -203,10 +396,6 @@ class GEMINI(BaseLLM):
     
     def _post_process(self):
         """Logs the token usage and cost."""        
-        self._log("Token usage so far: "
-                  f"{self.prompt_tokens} prompt tokens, "
-                  f"{self.completion_tokens} completion tokens")
-        total_cost = self.prompt_tokens/1000*0.01 + self.completion_tokens/1000*0.03
-        self._log(f"Cost so far: ${total_cost:.5f}")
+        self._log_usage()
 
     
\ No newline at end of file
@@ -1,17 +1,23 @@
+import asyncio
 from pathlib import Path
+import httpx
 import requests
 import logging
 from typing import Callable, Optional,Union
 from time import sleep
 import random
-import re
 from openai import AzureOpenAI
 from .base_llm import BaseLLM
+from .rate_limit import DEFAULT_RETRY_AFTER, retry_after
+from .structured import current_schema, openai_response_format
 from utils.misc import encode_img
+from utils.http import get_async_client, get_session
 
 
 class GPT4(BaseLLM):
     """Parameters when called: img_path_lst, prompt, format_check."""
+    config_section = "GPT"
+    supports_structured_output = True
 
     def __init__(self,
                  config_path: Path = Path("config.yml"),
@@ -57,13 +63,13 @@ class GPT4(BaseLLM):
             response = self._send_request(headers, payload)
 
             usage = response.json()["usage"]
-            self.prompt_tokens += usage["prompt_tokens"]
-            self.completion_tokens += usage["completion_tokens"]
+            self._meter_usage(usage["prompt_tokens"], usage["completion_tokens"])
 
             rsp_text: str = response.json()['choices'][0]['message']['content']
             if format_check is not None:
                 valid, rsp_text = self._check_syntax(rsp_text, format_check)
                 if not valid:
+                    self._meter_retry()
                     continue
             return prompt, rsp_text
 
@@ -106,6 +112,10 @@ class GPT4(BaseLLM):
             "max_tokens": self.max_tokens,
             "temperature": self.temperature
         }
+        schema = current_schema()
+        if schema is not None and self.structured_output:
+            payload["response_format"] = openai_response_format(
+                schema, "json_object" if self.structured_output == "json_object" else "json_schema")
 
         return headers, payload
 
@@ -119,8 +129,9 @@ class GPT4(BaseLLM):
         n_retries = 0
         backoff_delay = initial_delay
         while True:
+            self._throttle(payload["messages"])
             try:
-                response = requests.post("https://api.openai.com/v1/chat/completions",
+                response = get_session().post("https://api.openai.com/v1/chat/completions",
                                          headers=headers, json=payload)
                 is_valid, recommended_delay = self._check_response(response)
                 if is_valid:
@@ -129,13 +140,16 @@ class GPT4(BaseLLM):
                 self._log("An error occurred when sending a request: "
                           f"{type(e).__name__}: {e}",
                           level='warning')
-                recommended_delay = None
+                recommended_delay = self._retry_hint(e)
 
             n_retries += 1
+            self._meter_retry()
             if n_retries > max_retries:
                 raise RuntimeError(
                     "Too many errors occurred when querying LLM.")
             if recommended_delay is not None:
+                # every client of the provider holds off, not only this one
+                self._hold_off(recommended_delay)
                 delay = recommended_delay
             else:
                 backoff_delay *= exp_base * (1 + jitter*random.random())
@@ -144,6 +158,67 @@ class GPT4(BaseLLM):
                 f"Retrying in {delay:.3f} seconds...", level='warning')
             sleep(delay)
 
+    async def aquery(self,
+                     img_path_lst: Optional[list[Path]] = None,
+                     prompt: str = "",
+                     format_check: Optional[Callable[[object], None]] = None,
+                     ) -> tuple[str, str]:
+        """Async version of `query`."""
+        headers, payload = self._prepare_for_request(
+            prompt, img_path_lst)
+        while True:
+            response = await self._asend_request(headers, payload)
+
+            usage = response.json()["usage"]
+            self._meter_usage(usage["prompt_tokens"], usage["completion_tokens"])
+
+            rsp_text: str = response.json()['choices'][0]['message']['content']
+            if format_check is not None:
+                valid, rsp_text = self._check_syntax(rsp_text, format_check)
+                if not valid:
+                    self._meter_retry()
+                    continue
+            return prompt, rsp_text
+
+    async def _asend_request(self, headers: dict, payload: dict,
+                             max_retries: int = 5,
+                             initial_delay: int = 3,
+                             exp_base: int = 2,
+                             jitter: bool = True) -> httpx.Response:
+        """Async version of `_send_request`."""
+
+        n_retries = 0
+        backoff_delay = initial_delay
+        while True:
+            await self._athrottle(payload["messages"])
+            try:
+                response = await get_async_client().post("https://api.openai.com/v1/chat/completions",
+                                                         headers=headers, json=payload)
+                is_valid, recommended_delay = self._check_response(response)
+                if is_valid:
+                    return response
+            except Exception as e:
+                self._log("An error occurred when sending a request: "
+                          f"{type(e).__name__}: {e}",
+                          level='warning')
+                recommended_delay = self._retry_hint(e)
+
+            n_retries += 1
+            self._meter_retry()
+            if n_retries > max_retries:
+                raise RuntimeError(
+                    "Too many errors occurred when querying LLM.")
+            if recommended_delay is not None:
+                # every client of the provider holds off, not only this one
+                self._hold_off(recommended_delay)
+                delay = recommended_delay
+            else:
+                backoff_delay *= exp_base * (1 + jitter*random.random())
+                delay = backoff_delay
+            self._log(
+                f"Retrying in {delay:.3f} seconds...", level='warning')
+            await asyncio.sleep(delay)
+
     def _check_response(self, response: requests.Response) -> tuple[bool, Optional[float]]:
         """Checks if the response is valid. If error occurs, gets the recommended delay if any.
 
@@ -162,14 +237,10 @@ class GPT4(BaseLLM):
 
             recommended_delay = None
             if response.json()['error']['code'] == 'rate_limit_exceeded':
-                # there may exist "Please try again in xxs/xxmxxs/xxms." in the error message
-                match = re.search(
-                    R"(?<=Please try again in )(\d+m)?\d+\.?\d*(?=s)", err_msg)
-                if match is not None:
-                    t = match.group().split('m')
-                    m = t[0] if len(t) > 1 else 0
-                    s = t[-1]
-                    recommended_delay = 60*int(m) + float(s)
+                # the delay is in the Retry-After header or "Please try again in xxs/xxmxxs/xxms." in the error message
+                recommended_delay = retry_after(err_msg, response.headers)
+                if recommended_delay is None:
+                    recommended_delay = DEFAULT_RETRY_AFTER
 
             return False, recommended_delay
 
@@ -206,9 +277,5 @@ class GPT4(BaseLLM):
     
     def _post_process(self):
         """Logs the token usage and cost."""        
-        self._log("Token usage so far: "
-                  f"{self.prompt_tokens} prompt tokens, "
-                  f"{self.completion_tokens} completion tokens")
-        total_cost = self.prompt_tokens/1000*0.01 + self.completion_tokens/1000*0.03
-        self._log(f"Cost so far: ${total_cost:.5f}")
+        self._log_usage()
 
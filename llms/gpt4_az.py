@@ -1,16 +1,36 @@
+import asyncio
 from pathlib import Path
 import requests
 import logging
 from typing import Callable, Optional,Union
 from time import sleep
+import os
 import random
 import re
-from openai import AzureOpenAI
+import threading
+from openai import AsyncAzureOpenAI, AzureOpenAI
 from .base_llm import BaseLLM
+from .rate_limit import estimate_tokens
+from .streaming import StreamAborted
+from .structured import current_schema, openai_response_format
+from utils.http import get_async_client
 from typing_extensions import override
 from openai import AssistantEventHandler
+
+
+class PdfSession:
+    """Assistant, vector store and uploaded file through which GPT4_AZ answers questions about one PDF."""
+
+    def __init__(self, assistant_id: str, vector_store_id: str, file_id: str) -> None:
+        self.assistant_id = assistant_id
+        self.vector_store_id = vector_store_id
+        self.file_id = file_id
+
+
 class GPT4_AZ(BaseLLM, AssistantEventHandler):
     """Parameters when called: img_path_lst, prompt, format_check."""
+    config_section = "GPT4_AZ"
+    supports_structured_output = True
 
     def __init__(self,
                  config_path: Path = Path("config.yml"),
@@ -42,8 +62,13 @@ class GPT4_AZ(BaseLLM, AssistantEventHandler):
         self.client = AzureOpenAI(
             api_key=self.api_key,
             azure_endpoint=self.endpoint,
-            api_version=self.version
+            api_version=self.version,
+            # rate limit errors are retried by `_send_request`, which shares the delay with every client
+            max_retries=0,
         )
+        # one session per PDF version, reused by every call until released
+        self._pdf_sessions: dict[tuple[str, int, int], PdfSession] = {}
+        self._session_lock = threading.Lock()
 
         self.system_message = system_message
         if self.system_message is not None:
@@ -61,15 +86,15 @@ class GPT4_AZ(BaseLLM, AssistantEventHandler):
         
         message = self._prepare_message_(
             prompt, img_path_lst, pdf_path)
+        session = self._pdf_session(pdf_path) if pdf_path is not None else None
         while True:
-            response = self._send_request(message)
-            self.prompt_tokens += len(prompt)
-            self.completion_tokens += len(response)
+            response = self._send_request(message, session)
 
             rsp_text: str = response
             if format_check is not None:
                 valid, rsp_text = self._check_syntax(rsp_text, format_check)
                 if not valid:
+                    self._meter_retry()
                     continue
             return prompt, rsp_text
 
@@ -102,64 +127,102 @@ class GPT4_AZ(BaseLLM, AssistantEventHandler):
             "role": "user",
             "content": content
         })
-        self.assistant= None
-
         if pdf_path is not None:
-            self.assistant = self.client.beta.assistants.create(
+            # the PDF is searched through the vector store of the assistant of its session
+            messages=[
+                {
+            "role": "user",
+            "content": prompt,
+            } ]
+            
+        return  messages
+
+    def _pdf_session(self, pdf_path: Union[Path, str]) -> PdfSession:
+        """Returns the session of the PDF, creating the assistant, vector store and file upload on first use."""
+        stat = os.stat(pdf_path)
+        key = (str(Path(pdf_path).resolve()), stat.st_mtime_ns, stat.st_size)
+        with self._session_lock:
+            if key in self._pdf_sessions:
+                return self._pdf_sessions[key]
+            vector_store = self.client.beta.vector_stores.create(name="Paper to Video Assistant")
+            with open(pdf_path, "rb") as f:
+                message_file = self.client.files.create(file=f, purpose="assistants")
+            # indexes the PDF once, instead of once per message attachment
+            self.client.beta.vector_stores.files.create_and_poll(
+                vector_store_id=vector_store.id, file_id=message_file.id)
+            assistant = self.client.beta.assistants.create(
                 name="Paper to Video Assistant",
                 model=self.model,
                 tools=[{"type": "file_search"}],
+                tool_resources={"file_search": {"vector_store_ids": [vector_store.id]}},
             )
+            session = PdfSession(assistant.id, vector_store.id, message_file.id)
+            self._pdf_sessions[key] = session
+            self._log(f"Created assistant {assistant.id} for {key[0]}")
+            return session
 
-            vector_store = self.client.beta.vector_stores.create(name="Paper to Video Assistant")
+    def release(self, pdf_path: Union[Path, str]) -> None:
+        """Deletes the assistant, vector store and file of every session of the PDF."""
+        pdf_path = str(Path(pdf_path).resolve())
+        with self._session_lock:
+            keys = [key for key in self._pdf_sessions if key[0] == pdf_path]
+            for key in keys:
+                self._delete_session(self._pdf_sessions.pop(key))
 
-            self.assistant = self.client.beta.assistants.update(
-                assistant_id=self.assistant.id,
-                tool_resources={"file_search": {"vector_store_ids": [vector_store.id]}},
-            )
+    def close(self) -> None:
+        """Deletes the sessions of all PDFs."""
+        with self._session_lock:
+            for session in self._pdf_sessions.values():
+                self._delete_session(session)
+            self._pdf_sessions.clear()
 
-            message_file = self.client.files.create(
-                file=open(pdf_path, "rb"), purpose="assistants"
-            )
-            messages=[
-                {
-            "role": "user",
-            "content": prompt,
-      # Attach the new file to the message.
-            "attachments": [
-            { "file_id": message_file.id, "tools": [{"type": "file_search"}] }],} ]
-            
-        return  messages
+    def _delete_session(self, session: PdfSession) -> None:
+        for delete, object_id in ((self.client.beta.assistants.delete, session.assistant_id),
+                                  (self.client.beta.vector_stores.delete, session.vector_store_id),
+                                  (self.client.files.delete, session.file_id)):
+            try:
+                delete(object_id)
+            except Exception as e:
+                self._log(f"Failed to delete {object_id}: {type(e).__name__}: {e}",
+                          level='warning')
 
     def _send_request(self, messages: list,
+                      session: Optional[PdfSession] = None,
                       max_retries: int = 5,
                       initial_delay: int = 3,
                       exp_base: int = 2,
-                      jitter: bool = True) -> requests.Response:
+                      jitter: bool = True) -> str:
         """Sends a request to the OpenAI API and handles errors with exponential backoff."""
 
         n_retries = 0
         backoff_delay = initial_delay
         while True:
+            self._throttle(messages)
             try:
-                if self.assistant != None:
-                    response = self.talk_with_pdf(messages)
-                else:
-                    response = self.client.chat.completions.create(model=self.model, messages=messages, 
-                                                        temperature=self.temperature)
+                if session is not None:
+                    return self.talk_with_pdf(messages, session)
+                if self._streams():
+                    return self._stream_chat(messages)
+                response = self.client.chat.completions.create(model=self.model, messages=messages, 
+                                                    temperature=self.temperature, **self._format_kwargs())
+                if response.usage is not None:
+                    self._meter_usage(response.usage.prompt_tokens, response.usage.completion_tokens)
             
                 return response.choices[0].message.content
             except Exception as e:
                 self._log("An error occurred when sending a request: "
                           f"{type(e).__name__}: {e}",
                           level='warning')
-                recommended_delay = None
+                recommended_delay = self._retry_hint(e)
 
             n_retries += 1
+            self._meter_retry()
             if n_retries > max_retries:
                 raise RuntimeError(
                     "Too many errors occurred when querying LLM.")
             if recommended_delay is not None:
+                # every client of the provider holds off, not only this one
+                self._hold_off(recommended_delay)
                 delay = recommended_delay
             else:
                 backoff_delay *= exp_base * (1 + jitter*random.random())
@@ -168,6 +231,143 @@ class GPT4_AZ(BaseLLM, AssistantEventHandler):
                 f"Retrying in {delay:.3f} seconds...", level='warning')
             sleep(delay)
 
+    async def aquery(self,
+                     img_path_lst: Optional[list[Path]] = None,
+                     pdf_path: Optional[list[Path]] = None,
+                     prompt: str = "",
+                     format_check: Optional[Callable[[object], None]] = None,
+                     ) -> tuple[str, str]:
+        """Async version of `query`."""
+        message = self._prepare_message_(
+            prompt, img_path_lst, pdf_path)
+        session = None
+        if pdf_path is not None:
+            session = await asyncio.to_thread(self._pdf_session, pdf_path)
+        while True:
+            response = await self._asend_request(message, session)
+
+            rsp_text: str = response
+            if format_check is not None:
+                valid, rsp_text = self._check_syntax(rsp_text, format_check)
+                if not valid:
+                    self._meter_retry()
+                    continue
+            return prompt, rsp_text
+
+    async def _asend_request(self, messages: list,
+                             session: Optional[PdfSession] = None,
+                             max_retries: int = 5,
+                             initial_delay: int = 3,
+                             exp_base: int = 2,
+                             jitter: bool = True) -> str:
+        """Async version of `_send_request`. Runs on assistants still go through the sync client in a worker thread."""
+
+        n_retries = 0
+        backoff_delay = initial_delay
+        while True:
+            await self._athrottle(messages)
+            try:
+                if session is not None:
+                    return await asyncio.to_thread(self.talk_with_pdf, messages, session)
+                if self._streams():
+                    return await self._astream_chat(messages)
+                response = await self._async_client().chat.completions.create(model=self.model, messages=messages,
+                                                    temperature=self.temperature, **self._format_kwargs())
+                if response.usage is not None:
+                    self._meter_usage(response.usage.prompt_tokens, response.usage.completion_tokens)
+
+                return response.choices[0].message.content
+            except Exception as e:
+                self._log("An error occurred when sending a request: "
+                          f"{type(e).__name__}: {e}",
+                          level='warning')
+                recommended_delay = self._retry_hint(e)
+
+            n_retries += 1
+            self._meter_retry()
+            if n_retries > max_retries:
+                raise RuntimeError(
+                    "Too many errors occurred when querying LLM.")
+            if recommended_delay is not None:
+                # every client of the provider holds off, not only this one
+                self._hold_off(recommended_delay)
+                delay = recommended_delay
+            else:
+                backoff_delay *= exp_base * (1 + jitter*random.random())
+                delay = backoff_delay
+            self._log(
+                f"Retrying in {delay:.3f} seconds...", level='warning')
+            await asyncio.sleep(delay)
+
+    def _format_kwargs(self) -> dict:
+        """`response_format` of the call in progress if it has a schema. Runs on the assistants of PDF sessions
+        go without it, as file search does not take one, and rely on the instructions in the prompt."""
+        schema = current_schema()
+        if schema is None or not self.structured_output:
+            return {}
+        mode = "json_object" if self.structured_output == "json_object" else "json_schema"
+        return {"response_format": openai_response_format(schema, mode)}
+
+    def _stream_chat(self, messages: list) -> str:
+        """Streams a chat completion, passing each chunk to the consumer of the call. Returns the text received."""
+        self._stream_start()
+        stream = self.client.chat.completions.create(model=self.model, messages=messages,
+                                                     temperature=self.temperature, stream=True,
+                                                     stream_options={"include_usage": True},
+                                                     **self._format_kwargs())
+        text, usage = "", None
+        try:
+            for chunk in stream:
+                # the usage comes in a last chunk without choices
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    text += chunk.choices[0].delta.content
+                    self._stream_chunk(chunk.choices[0].delta.content)
+        except StreamAborted as e:
+            stream.close()
+            self._stream_aborted(e)
+        self._meter_stream_usage(usage, messages, text)
+        return text
+
+    async def _astream_chat(self, messages: list) -> str:
+        """Async version of `_stream_chat`."""
+        self._stream_start()
+        stream = await self._async_client().chat.completions.create(model=self.model, messages=messages,
+                                                                    temperature=self.temperature, stream=True,
+                                                                    stream_options={"include_usage": True},
+                                                                    **self._format_kwargs())
+        text, usage = "", None
+        try:
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    text += chunk.choices[0].delta.content
+                    self._stream_chunk(chunk.choices[0].delta.content)
+        except StreamAborted as e:
+            await stream.close()
+            self._stream_aborted(e)
+        self._meter_stream_usage(usage, messages, text)
+        return text
+
+    def _meter_stream_usage(self, usage, messages: list, text: str) -> None:
+        # an aborted stream ends before its usage is sent
+        if usage is not None:
+            self._meter_usage(usage.prompt_tokens, usage.completion_tokens)
+        else:
+            self._meter_usage(estimate_tokens(messages), estimate_tokens(text))
+
+    def _async_client(self) -> AsyncAzureOpenAI:
+        """Async client on the pooled connections of the running event loop."""
+        return AsyncAzureOpenAI(
+            api_key=self.api_key,
+            azure_endpoint=self.endpoint,
+            api_version=self.version,
+            http_client=get_async_client(),
+            max_retries=0,
+        )
+
     def _check_response(self, response: requests.Response) -> tuple[bool, Optional[float]]:
         """Checks if the response is valid. If error occurs, gets the recommended delay if any.
 
@@ -230,35 +430,56 @@ class GPT4_AZ(BaseLLM, AssistantEventHandler):
     
     def _post_process(self):
         """Logs the token usage and cost."""        
-        self._log("Token usage so far: "
-                  f"{self.prompt_tokens} prompt tokens, "
-                  f"{self.completion_tokens} completion tokens")
-        total_cost = self.prompt_tokens/1000*0.01 + self.completion_tokens/1000*0.03
-        self._log(f"Cost so far: ${total_cost:.5f}")
-
-    def talk_with_pdf(self, messages):
-        print(1)
+        self._log_usage()
+
+    def talk_with_pdf(self, messages, session: PdfSession) -> str:
         thread = self.client.beta.threads.create(
             messages=messages)
-        with self.client.beta.threads.runs.stream(
-            thread_id=thread.id,
-            assistant_id=self.assistant.id,
-            instructions="",
-            event_handler=EventHandler(self.client),
-        ) as stream:
-            stream.until_done()
-        return final_response
+        self._stream_start()
+        event_handler = EventHandler(self.client, on_delta=self._stream_chunk)
+        try:
+            with self.client.beta.threads.runs.stream(
+                thread_id=thread.id,
+                assistant_id=session.assistant_id,
+                instructions="",
+                event_handler=event_handler,
+            ) as stream:
+                stream.until_done()
+        except StreamAborted as e:
+            self._stream_aborted(e)
+            event_handler.final_response = event_handler.partial_response
+        finally:
+            # deleting the thread also stops an aborted run
+            self.client.beta.threads.delete(thread.id)
+        # the run reports the tokens of all its steps, including file search
+        usage = getattr(event_handler.current_run, "usage", None)
+        if usage is not None:
+            self._meter_usage(usage.prompt_tokens, usage.completion_tokens)
+        else:
+            self._meter_usage(estimate_tokens(messages), estimate_tokens(event_handler.partial_response))
+        if event_handler.final_response is None:
+            raise RuntimeError("The assistant returned no message.")
+        return event_handler.final_response
 
 
 class EventHandler(AssistantEventHandler):
-    def __init__(self, client):
+    def __init__(self, client, on_delta: Optional[Callable[[str], None]] = None):
         super().__init__()
         self.client = client
+        self.on_delta = on_delta
+        self.partial_response = ""
+        self.final_response: Optional[str] = None
 
     @override
     def on_text_created(self, text) -> None:
         print(f"\nassistant > ", end="", flush=True)
     @override
+    def on_text_delta(self, delta, snapshot) -> None:
+        if delta.value:
+            self.partial_response += delta.value
+            if self.on_delta is not None:
+                self.on_delta(delta.value)
+    @override
     def on_tool_call_created(self, tool_call):
         print(f"\nassistant > {tool_call.type}\n", flush=True)
     @override
@@ -274,5 +495,4 @@ class EventHandler(AssistantEventHandler):
             if file_citation := getattr(annotation, "file_citation", None):
                 cited_file = self.client.files.retrieve(file_citation.file_id)
                 citations.append(f"[{index}] {cited_file.filename}")
-        global final_response
-        final_response = message_content.value
\ No newline at end of file
+        self.final_response = message_content.value
\ No newline at end of file
@@ -0,0 +1,72 @@
+import threading
+from collections import deque
+
+
+class HedgePolicy:
+    """When to send a slow call of a backend again to a secondary backend.
+
+    A call is hedged once it has run longer than the `percentile` latency of the
+    recent calls of the backend (never earlier than `min_delay`), as long as at
+    most `max_fraction` of the calls have been hedged.
+
+    Args:
+        backend (str): Registry name of the secondary backend, e.g. "GPT4_AZ".
+        percentile (float, optional): Percentile of the recent latencies after which a call is hedged. Defaults to 95.
+        min_delay (float, optional): Minimum delay in seconds before hedging, also used until `min_samples` calls are done. Defaults to 20.
+        max_fraction (float, optional): Maximum fraction of the calls that are hedged. Defaults to 0.1.
+        window (int, optional): Number of recent latencies kept. Defaults to 200.
+        min_samples (int, optional): Number of latencies needed before the percentile is used. Defaults to 20.
+    """
+
+    def __init__(self,
+                 backend: str,
+                 percentile: float = 95,
+                 min_delay: float = 20.0,
+                 max_fraction: float = 0.1,
+                 window: int = 200,
+                 min_samples: int = 20) -> None:
+        self.backend = backend
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_fraction = max_fraction
+        self.min_samples = min_samples
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.calls = 0
+        self.hedges = 0
+        # hedges answered first by the secondary backend
+        self.wins = 0
+        self._lock = threading.Lock()
+
+    def start_call(self) -> None:
+        with self._lock:
+            self.calls += 1
+
+    def observe(self, latency: float) -> None:
+        """Records the latency of a call of the primary backend, hedged or not."""
+        with self._lock:
+            self.latencies.append(latency)
+
+    def delay(self) -> float:
+        """Seconds after which a call in progress is hedged."""
+        with self._lock:
+            if len(self.latencies) < self.min_samples:
+                return self.min_delay
+            latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return max(self.min_delay, latencies[index])
+
+    def try_hedge(self) -> bool:
+        """Counts a hedge if the budget allows it."""
+        with self._lock:
+            if self.hedges >= self.max_fraction * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+    def won(self) -> None:
+        with self._lock:
+            self.wins += 1
+
+    def stats(self) -> str:
+        with self._lock:
+            return f"{self.hedges} of {self.calls} calls hedged with {self.backend}, {self.wins} answered first"
@@ -12,6 +12,7 @@ from llamaapi import LlamaAPI
 
 
 class Llama(BaseLLM):
+    config_section = "LLAMA"
 
     def __init__(
         self,
@@ -61,14 +62,14 @@ class Llama(BaseLLM):
             response = self._send_request(payload)
 
             usage = response.json()["usage"]
-            self.prompt_tokens += usage["prompt_tokens"]
-            self.completion_tokens += usage["completion_tokens"]
+            self._meter_usage(usage["prompt_tokens"], usage["completion_tokens"])
 
             rsp_text: str = response.json()["choices"][0]["message"]["content"]
             if format_check is not None:
                 valid, rsp_text = self._check_syntax(rsp_text, format_check)
                 if not valid:
                     n_retries += 1
+                    self._meter_retry()
                     if n_retries > max_retries:
                         raise RuntimeError("Too many errors occurred when parsing the response.")
                     continue
@@ -99,6 +100,7 @@ class Llama(BaseLLM):
         n_retries = 0
         backoff_delay = initial_delay
         while True:
+            self._throttle(payload["messages"])
             try:
                 response = self.llama.run(payload)
                 if (finish_reason := response.json()["choices"][0]["finish_reason"]) != "stop":
@@ -110,12 +112,19 @@ class Llama(BaseLLM):
                     f"{type(e).__name__}: {e}",
                     level="warning",
                 )
+                recommended_delay = self._retry_hint(e)
 
             n_retries += 1
+            self._meter_retry()
             if n_retries > max_retries:
                 raise RuntimeError("Too many errors occurred when querying LLM.")
-            backoff_delay *= exp_base * (1 + jitter * random.random())
-            delay = backoff_delay
+            if recommended_delay is not None:
+                # every client of the provider holds off, not only this one
+                self._hold_off(recommended_delay)
+                delay = recommended_delay
+            else:
+                backoff_delay *= exp_base * (1 + jitter * random.random())
+                delay = backoff_delay
             self._log(f"Retrying in {delay:.3f} seconds...", level="warning")
             sleep(delay)
 
@@ -149,8 +158,4 @@ class Llama(BaseLLM):
 
     def _post_process(self):
         """Logs the token usage and cost."""
-        self._log(
-            "Token usage so far: "
-            f"{self.prompt_tokens} prompt tokens, "
-            f"{self.completion_tokens} completion tokens"
-        )
+        self._log_usage()
@@ -0,0 +1,180 @@
+import json
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from time import perf_counter
+from typing import Iterator, Optional, Union
+
+
+_current_stage: ContextVar[str] = ContextVar("llm_stage", default="other")
+_current_meter: ContextVar[Optional["Meter"]] = ContextVar("llm_meter", default=None)
+_current_call: ContextVar[Optional["CallRecord"]] = ContextVar("llm_call", default=None)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Tags the LLM calls made in the block (or the decorated function) with a pipeline stage, e.g. "high_plan"."""
+    token = _current_stage.set(name)
+    try:
+        yield
+    finally:
+        _current_stage.reset(token)
+
+
+@contextmanager
+def metering(meter: "Meter") -> Iterator["Meter"]:
+    """Records the LLM calls made in the block into `meter`."""
+    token = _current_meter.set(meter)
+    try:
+        yield meter
+    finally:
+        _current_meter.reset(token)
+
+
+def current_call() -> Optional["CallRecord"]:
+    """The record of the LLM call in progress in this context, if any."""
+    return _current_call.get()
+
+
+class CallRecord:
+    """Tokens, wall time, retries and cost of one LLM call.
+
+    Args:
+        backend (str): Class name of the LLM.
+        model (str | None): Model name or directory.
+        stage (str, optional): Pipeline stage the call belongs to. Defaults to the current stage.
+    """
+
+    def __init__(self, backend: str, model: Optional[str], stage: Optional[str] = None) -> None:
+        self.backend = backend
+        self.model = model
+        self.stage = stage if stage is not None else _current_stage.get()
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.wall_time = 0.0
+        # failed requests and responses asked again after a failed format check
+        self.retries = 0
+        self.cost = 0.0
+        self.cached = False
+        # whether the call was also sent to a secondary backend, and whether that one answered first
+        self.hedged = False
+        self.hedge_won = False
+        # whether the response came from an identical call in progress
+        self.coalesced = False
+        # whether the chunk consumer stopped the response early, which is then neither cached nor shared
+        self.aborted = False
+        # streamed calls only: seconds from the start of the call to the first chunk, and generation speed after it
+        self.ttft: Optional[float] = None
+        self.tokens_per_second: Optional[float] = None
+        self._started = perf_counter()
+
+    def to_dict(self) -> dict:
+        return {name: value for name, value in vars(self).items() if not name.startswith("_")}
+
+
+class Meter:
+    """Collects the LLM calls of a run and summarizes them by stage and by backend.
+
+    Args:
+        latency_buckets (tuple[float, ...], optional): Upper bounds in seconds of the latency histogram bins.
+    """
+
+    def __init__(self, latency_buckets: tuple[float, ...] = (1, 2, 5, 10, 20, 40, 80, 160)) -> None:
+        self.latency_buckets = latency_buckets
+        self.records: list[CallRecord] = []
+        self._lock = threading.Lock()
+
+    def add(self, record: CallRecord) -> None:
+        with self._lock:
+            self.records.append(record)
+
+    def extend(self, other: "Meter") -> None:
+        with other._lock:
+            records = list(other.records)
+        with self._lock:
+            self.records.extend(records)
+
+    def _totals(self, records: list[CallRecord]) -> dict:
+        streamed = [record for record in records if record.ttft is not None]
+        return {
+            "calls": len(records),
+            "cached_calls": sum(record.cached for record in records),
+            "coalesced_calls": sum(record.coalesced for record in records),
+            "aborted_calls": sum(record.aborted for record in records),
+            "prompt_tokens": sum(record.prompt_tokens for record in records),
+            "completion_tokens": sum(record.completion_tokens for record in records),
+            "wall_time": round(sum(record.wall_time for record in records), 3),
+            "retries": sum(record.retries for record in records),
+            "hedged_calls": sum(record.hedged for record in records),
+            "hedges_won": sum(record.hedge_won for record in records),
+            "cost": round(sum(record.cost for record in records), 6),
+            "streamed_calls": len(streamed),
+            "mean_ttft": round(sum(record.ttft for record in streamed) / len(streamed), 3) if streamed else None,
+            "mean_tokens_per_second": round(sum(record.tokens_per_second or 0 for record in streamed) / len(streamed), 1)
+                                      if streamed else None,
+        }
+
+    def _histogram(self, records: list[CallRecord]) -> dict[str, int]:
+        bins = {f"<={bound}s": 0 for bound in self.latency_buckets}
+        bins[f">{self.latency_buckets[-1]}s"] = 0
+        for record in records:
+            bound = next((bound for bound in self.latency_buckets if record.wall_time <= bound), None)
+            bins[f"<={bound}s" if bound is not None else f">{self.latency_buckets[-1]}s"] += 1
+        return bins
+
+    def summary(self) -> dict:
+        """Totals of all calls, per stage and per backend, with a latency histogram per stage."""
+        with self._lock:
+            records = list(self.records)
+        stages = sorted({record.stage for record in records})
+        backends = sorted({record.backend for record in records})
+        return {
+            "total": self._totals(records),
+            "by_stage": {
+                name: {**self._totals([record for record in records if record.stage == name]),
+                       "latency_histogram": self._histogram(
+                           [record for record in records if record.stage == name and not record.cached])}
+                for name in stages
+            },
+            "by_backend": {
+                name: self._totals([record for record in records if record.backend == name])
+                for name in backends
+            },
+        }
+
+    def export(self, path: Union[Path, str]) -> None:
+        """Saves the summary and every call to a JSON file."""
+        summary = self.summary()
+        with self._lock:
+            summary["calls"] = [record.to_dict() for record in self.records]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+def current_meter() -> Optional[Meter]:
+    return _current_meter.get()
+
+
+def mark_first_token() -> None:
+    """Records the time to the first token of the call in progress, on its first chunk."""
+    record = _current_call.get()
+    if record is not None and record.ttft is None:
+        record.ttft = perf_counter() - record._started
+
+
+@contextmanager
+def record_call(record: CallRecord) -> Iterator[CallRecord]:
+    """Makes `record` the call in progress, so the backend can add its usage, and adds it to the current meter once done."""
+    token = _current_call.set(record)
+    record._started = perf_counter()
+    try:
+        yield record
+    finally:
+        record.wall_time = perf_counter() - record._started
+        if record.ttft is not None and record.completion_tokens:
+            record.tokens_per_second = record.completion_tokens / max(record.wall_time - record.ttft, 1e-6)
+        _current_call.reset(token)
+        meter = _current_meter.get()
+        if meter is not None:
+            meter.add(record)
@@ -1,15 +1,204 @@
-from transformers import Qwen2_5_VLForConditionalGeneration, AutoTokenizer, AutoProcessor, BitsAndBytesConfig
+from transformers import Qwen2_5_VLForConditionalGeneration, AutoTokenizer, AutoProcessor, BitsAndBytesConfig, DynamicCache
 from qwen_vl_utils import process_vision_info
 from .base_llm import BaseLLM
 from typing import Callable, Optional,Union
 from pathlib import Path
 from utils.textwork import read_pdf
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
 import torch
 
 
+class _Request:
+    """A prompt waiting for the shared model, with its result once generated."""
+
+    def __init__(self, text: str, images: Optional[list] = None, videos: Optional[list] = None) -> None:
+        self.text = text
+        self.images = images
+        self.videos = videos
+        # output text, prompt tokens and completion tokens
+        self.result: Optional[tuple[str, int, int]] = None
+        self.error: Optional[Exception] = None
+
+
+class SharedModel:
+    """A loaded model shared by all QWEN instances of the process.
+
+    Generation is not thread-safe, so the callers take turns. The prompts queued
+    while the model is busy are generated together in one padded `generate` call.
+
+    Args:
+        model: The loaded model.
+        processor: Its processor.
+        device (str): "cuda" or "cpu".
+        max_batch_size (int, optional): Maximum number of prompts generated together. Defaults to 4.
+        max_new_tokens (int, optional): Maximum number of generated tokens per prompt. Defaults to 128.
+        prefix_cache_size (int, optional): Number of prefixes whose key/value cache is kept. Defaults to 1.
+    """
+
+    def __init__(self, model, processor, device: str, max_batch_size: int = 4, max_new_tokens: int = 128,
+                 prefix_cache_size: int = 1) -> None:
+        self.model = model
+        self.processor = processor
+        # prompts of a batch end at the same position, so that generation continues all of them
+        self.processor.tokenizer.padding_side = "left"
+        self.device = device
+        self._pending: list[_Request] = []
+        self._pending_lock = threading.Lock()
+        self._generate_lock = threading.Lock()
+        # token ids and key/value cache of the recent prefixes, by hash of their text
+        self._prefixes: OrderedDict[str, tuple] = OrderedDict()
+        self.configure(max_batch_size, max_new_tokens, prefix_cache_size)
+
+    def configure(self, max_batch_size: int, max_new_tokens: int, prefix_cache_size: int) -> None:
+        """Applies the generation settings of the latest config to the loaded model, without reloading it."""
+        with self._generate_lock:
+            self.max_batch_size = max(1, max_batch_size)
+            self.max_new_tokens = max_new_tokens
+            self.prefix_cache_size = max(1, prefix_cache_size)
+            while len(self._prefixes) > self.prefix_cache_size:
+                self._prefixes.popitem(last=False)
+
+    def generate(self, text: str, images: Optional[list] = None, videos: Optional[list] = None) -> tuple[str, int, int]:
+        """Generates the response to `text`. Returns it with the prompt and completion token counts."""
+        request = _Request(text, images, videos)
+        with self._pending_lock:
+            self._pending.append(request)
+        with self._generate_lock:
+            # another caller may have generated it with its own batch
+            while request.result is None and request.error is None:
+                with self._pending_lock:
+                    batch = self._pending[:self.max_batch_size]
+                    del self._pending[:self.max_batch_size]
+                try:
+                    self._run(batch)
+                except Exception as e:
+                    for queued in batch:
+                        queued.error = e
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    @torch.inference_mode()
+    def _run(self, batch: list[_Request]) -> None:
+        images = [image for request in batch for image in request.images or []]
+        videos = [video for request in batch for video in request.videos or []]
+        inputs = self.processor(
+            text=[request.text for request in batch],
+            images=images or None,
+            videos=videos or None,
+            padding=True,
+            return_tensors="pt",
+        )
+        inputs = inputs.to(self.device)
+
+        generated_ids = self.model.generate(**inputs, max_new_tokens=self.max_new_tokens)
+        generated_ids_trimmed = generated_ids[:, inputs.input_ids.shape[1]:]
+        output_texts = self.processor.batch_decode(
+            generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )
+        pad_token_id = self.processor.tokenizer.pad_token_id
+        for i, request in enumerate(batch):
+            request.result = (output_texts[i],
+                              int(inputs.attention_mask[i].sum()),
+                              int((generated_ids_trimmed[i] != pad_token_id).sum()))
+
+
+    def generate_with_prefix(self, prefix: str, text: str) -> tuple[str, int, int]:
+        """Generates the response to `prefix` followed by `text`, reusing the key/value cache of `prefix`.
+
+        The cache of a prefix is computed on its first use, so only `text` is encoded by the
+        later calls with the same prefix.
+        """
+        with self._generate_lock:
+            return self._run_with_prefix(prefix, text)
+
+    def _prefix(self, prefix: str) -> tuple:
+        key = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+        if key in self._prefixes:
+            self._prefixes.move_to_end(key)
+            return self._prefixes[key]
+        prefix_ids = self.processor.tokenizer(prefix, return_tensors="pt").input_ids.to(self.device)
+        self._reset_rope_deltas()
+        cache = DynamicCache()
+        self.model(input_ids=prefix_ids, past_key_values=cache, use_cache=True)
+        self._prefixes[key] = (prefix_ids, cache)
+        while len(self._prefixes) > self.prefix_cache_size:
+            self._prefixes.popitem(last=False)
+        return prefix_ids, cache
+
+    @torch.inference_mode()
+    def _run_with_prefix(self, prefix: str, text: str) -> tuple[str, int, int]:
+        prefix_ids, cache = self._prefix(prefix)
+        text_ids = self.processor.tokenizer(text, return_tensors="pt", add_special_tokens=False).input_ids.to(self.device)
+        input_ids = torch.cat([prefix_ids, text_ids], dim=1)
+        # generation starts after the cached prefix, where the positions are offset by the rope deltas
+        # of the previous batch, which may have had images
+        self._reset_rope_deltas()
+        try:
+            generated_ids = self.model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+                                                past_key_values=cache, max_new_tokens=self.max_new_tokens)
+        finally:
+            # drops the tokens of this call, so the cache holds the prefix only again
+            cache.crop(prefix_ids.shape[1])
+        generated_ids_trimmed = generated_ids[:, input_ids.shape[1]:]
+        output_text = self.processor.batch_decode(
+            generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )[0]
+        return output_text, input_ids.shape[1], generated_ids_trimmed.shape[1]
+
+    def _reset_rope_deltas(self) -> None:
+        """Sets the rope deltas of the model to those of one unpadded text prompt.
+
+        Qwen2.5-VL computes the positions of a prompt from scratch only when it starts at position 0,
+        and otherwise offsets them by the deltas it kept from that prompt.
+        """
+        # positions of text are the same on the three rope axes, so they have no offset
+        deltas = torch.zeros((1, 1), dtype=torch.long, device=self.device)
+        # kept by the language model in recent versions of transformers
+        for module in (self.model, getattr(self.model, "model", None)):
+            if module is not None and hasattr(module, "rope_deltas"):
+                module.rope_deltas = deltas
+
+
+# loaded models by directory and device
+_models: dict[tuple[str, str], SharedModel] = {}
+_models_lock = threading.Lock()
+
+
+def _load_model(model_dir: str, device: str, max_batch_size: int = 4, max_new_tokens: int = 128,
+                prefix_cache_size: int = 1) -> SharedModel:
+    """Returns the shared model of `model_dir` on `device`, loading it on first use.
+    The generation settings are applied to the model already loaded, so the latest config wins.
+
+    On CUDA the weights are quantized to 4 bits with bitsandbytes. On CPU the model is
+    loaded in float32 and its linear layers are dynamically quantized to int8.
+    """
+    with _models_lock:
+        if (model_dir, device) not in _models:
+            if device == "cpu":
+                model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+                    model_dir, torch_dtype=torch.float32, low_cpu_mem_usage=True)
+                # int8 weights, activations quantized on the fly
+                model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            else:
+                bnb_config = BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=torch.bfloat16, bnb_4bit_use_double_quant=True, bnb_4bit_quant_type='nf4')
+                model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+                    model_dir, torch_dtype=torch.bfloat16, low_cpu_mem_usage=True, quantization_config=bnb_config)#, attn_implementation="flash_attention_2"
+            model.eval()
+            processor = AutoProcessor.from_pretrained(model_dir)
+            _models[(model_dir, device)] = SharedModel(model, processor, device, max_batch_size, max_new_tokens,
+                                                       prefix_cache_size)
+        else:
+            _models[(model_dir, device)].configure(max_batch_size, max_new_tokens, prefix_cache_size)
+        return _models[(model_dir, device)]
+
+
 class QWEN(BaseLLM):
     """Parameters when called: img_path_lst, prompt, format_check."""
+    config_section = "QWEN"
     def __init__(self,
                  config_path: Path = Path("config.yml"),
                  log_path: Optional[Union[Path, str]] = None,
@@ -26,6 +215,12 @@ class QWEN(BaseLLM):
         self.dir = self.cfg["QWEN"]["local_dir"]
         self.prompt_tokens = 0
         self.completion_tokens = 0
+        # "cuda", "cpu", or "auto" to use CUDA when available
+        self.device = self.cfg["QWEN"].get("DEVICE", "cuda")
+        if self.device == "auto":
+            self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        if self.device == "cpu" and self.cfg["QWEN"].get("NUM_THREADS"):
+            torch.set_num_threads(self.cfg["QWEN"]["NUM_THREADS"])
 
         self.system_message = system_message
         if self.system_message is not None:
@@ -33,10 +228,13 @@ class QWEN(BaseLLM):
                       "and the system message is always attached in each turn for GPT._")
             self._log("**System message for GPT**")
             self._log(self.system_message)
-        bnb_config = BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=torch.bfloat16, bnb_4bit_use_double_quant=True, bnb_4bit_quant_type='nf4')
-        self.model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-            self.dir, torch_dtype=torch.bfloat16, low_cpu_mem_usage=True, quantization_config=bnb_config)#, attn_implementation="flash_attention_2"
-        self.processor = AutoProcessor.from_pretrained(self.dir)    
+        self.shared_model = _load_model(self.dir, self.device,
+                                        self.cfg["QWEN"].get("MAX_BATCH_SIZE", 4),
+                                        self.cfg["QWEN"].get("MAX_NEW_TOKENS", 128),
+                                        self.cfg["QWEN"].get("PREFIX_CACHE_SIZE", 1))
+        # puts the paper before the prompt, so its key/value cache is computed once and shared by all prompts
+        self.prefix_cache = self.cfg["QWEN"].get("PREFIX_CACHE", False)
+        self.model, self.processor = self.shared_model.model, self.shared_model.processor
     def _prepare_message_(self, prompt: str,
                              img_path_lst: Optional[list[Path]] = None,
                              pdf_path: Optional[list[Path]] = None,
@@ -63,31 +261,25 @@ class QWEN(BaseLLM):
               format_check: Optional[Callable[[object], None]] = None,
               ) -> tuple[str, str]:
 
+        if self.prefix_cache and pdf_path is not None and img_path_lst is None:
+            output_text, prompt_tokens, completion_tokens = self.shared_model.generate_with_prefix(
+                read_pdf(pdf_path), prompt)
+            self._meter_usage(prompt_tokens, completion_tokens)
+            return prompt, output_text
+
         messages = self._prepare_message_(
             prompt, img_path_lst, pdf_path)
         while True:
-            text = messages[0]['text'] 
+            text = messages[-1]['text']
             image_inputs, video_inputs=None, None
             if img_path_lst is not None:
                 text=self.processor.apply_chat_template(
-                    messages, tokenize=False, add_generation_prompt=True
-                )       
-                image_inputs, video_inputs = process_vision_info(messages)
-            inputs = self.processor(
-                text=[text],
-                images=image_inputs,
-                videos=video_inputs,
-                padding=True,
-                return_tensors="pt",
-            )
-            inputs = inputs.to("cuda")
-
-# Inference: Generation of the output
-            generated_ids = self.model.generate(**inputs, max_new_tokens=128)
-            generated_ids_trimmed = [
-                out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-            ]
-            output_text = self.processor.batch_decode(
-                generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
-            )[0]
-            return prompt, output_text   
+                    [{"role": "user", "content": messages}], tokenize=False, add_generation_prompt=True
+                )
+                image_inputs, video_inputs = process_vision_info([{"role": "user", "content": messages}])
+
+# Inference: Generation of the output, batched with the prompts of other threads
+            output_text, prompt_tokens, completion_tokens = self.shared_model.generate(
+                text, image_inputs, video_inputs)
+            self._meter_usage(prompt_tokens, completion_tokens)
+            return prompt, output_text
@@ -0,0 +1,188 @@
+import asyncio
+import re
+import threading
+import time
+from contextvars import ContextVar
+from typing import Mapping, Optional, Union
+
+
+# delay before retrying a rate limited request when the provider gives no hint
+DEFAULT_RETRY_AFTER = 10.0
+
+# tokens reserved by the request in progress in this context, settled once its usage is known
+_reserved_tokens: ContextVar[int] = ContextVar("reserved_tokens", default=0)
+
+
+class TokenBucket:
+    """Allowance refilled continuously up to a budget per minute.
+
+    Requests are debited when reserved, so the balance may go negative and
+    later requests wait until it has been refilled.
+
+    Args:
+        per_minute (float): Budget per minute, also the burst capacity.
+    """
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.balance = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.balance = min(self.capacity, self.balance + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        """Debits `amount` and returns the seconds to wait before using it."""
+        self._refill(now)
+        self.balance -= amount
+        return max(0.0, -self.balance / self.rate)
+
+    def adjust(self, amount: float, now: float) -> None:
+        """Debits (or credits back, if negative) `amount` without waiting."""
+        self._refill(now)
+        self.balance = min(self.capacity, self.balance - amount)
+
+
+class RateLimiter:
+    """Requests and tokens per minute allowed to one provider, shared by all its clients in the process.
+
+    A rate limit error reported by any client holds off every client of the
+    provider until the delay given by the server has passed.
+
+    Args:
+        name (str): Name of the provider, e.g. "GEMINI".
+        rpm (float, optional): Requests per minute, unlimited if 0. Defaults to 0.
+        tpm (float, optional): Tokens per minute, unlimited if 0. Defaults to 0.
+    """
+
+    def __init__(self, name: str, rpm: float = 0, tpm: float = 0) -> None:
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: int) -> float:
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.blocked_until - now)
+            if self.requests is not None:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.reserve(tokens, now))
+        _reserved_tokens.set(tokens)
+        return wait
+
+    def _penalty_left(self) -> float:
+        with self._lock:
+            return max(0.0, self.blocked_until - time.monotonic())
+
+    def acquire(self, tokens: int = 0) -> float:
+        """Blocks until a request of about `tokens` tokens is allowed. Returns the seconds waited."""
+        waited = wait = self._reserve(tokens)
+        while wait > 0:
+            time.sleep(wait)
+            # another client may have hit the limit in the meantime
+            wait = self._penalty_left()
+            waited += wait
+        return waited
+
+    async def aacquire(self, tokens: int = 0) -> float:
+        """Async version of `acquire`."""
+        waited = wait = self._reserve(tokens)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self._penalty_left()
+            waited += wait
+        return waited
+
+    def settle(self, tokens: int) -> None:
+        """Replaces the estimate reserved by the request in progress with the `tokens` it actually used."""
+        reserved = _reserved_tokens.get()
+        _reserved_tokens.set(0)
+        if self.tokens is not None:
+            with self._lock:
+                self.tokens.adjust(tokens - reserved, time.monotonic())
+
+    def penalize(self, delay: float) -> None:
+        """Holds off every request to the provider for `delay` seconds."""
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+
+_limiters: dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name: str, rpm: float = 0, tpm: float = 0) -> RateLimiter:
+    """Returns the limiter of the provider `name`, created with the limits of its first client."""
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = RateLimiter(name, rpm, tpm)
+        return _limiters[name]
+
+
+def estimate_tokens(obj: object) -> int:
+    """Rough token count of the text of a request, about four characters per token.
+
+    Inline images and files are not counted; `RateLimiter.settle` corrects the
+    estimate once the usage is known.
+    """
+    if isinstance(obj, str):
+        return 0 if obj.startswith("data:") else len(obj) // 4
+    if isinstance(obj, dict):
+        if "mime_type" in obj:
+            # inline data of Gemini, base64 encoded
+            return 0
+        return sum(estimate_tokens(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(estimate_tokens(item) for item in obj)
+    return 0
+
+
+def is_rate_limited(error: BaseException) -> bool:
+    """Whether `error` is a rate limit (HTTP 429) error of any of the provider SDKs."""
+    if type(error).__name__ in ("RateLimitError", "ResourceExhausted", "TooManyRequests"):
+        return True
+    for status in (getattr(error, "status_code", None), getattr(error, "code", None),
+                   getattr(getattr(error, "response", None), "status_code", None)):
+        if status == 429:
+            return True
+    return "rate limit" in str(error).lower()
+
+
+def retry_after(error: Union[BaseException, str],
+                headers: Optional[Mapping[str, str]] = None) -> Optional[float]:
+    """Returns the delay in seconds recommended by the provider, from the response headers or the error message.
+
+    Args:
+        error (BaseException | str): Error raised by the SDK, or the error message.
+        headers (Mapping[str, str] | None, optional): Response headers. Defaults to those of the response of `error`, if any.
+    """
+    if headers is None:
+        headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers is not None:
+        try:
+            if headers.get("retry-after-ms") is not None:
+                return float(headers["retry-after-ms"]) / 1000
+            if headers.get("retry-after") is not None:
+                return float(headers["retry-after"])
+        except (TypeError, ValueError):
+            # an HTTP date, which the providers do not send in practice
+            pass
+
+    message = str(error)
+    # Gemini: "retry_delay { seconds: 37 }"
+    match = re.search(R"retry_delay\s*\{\s*seconds:\s*(\d+)", message)
+    if match is not None:
+        return float(match.group(1))
+    # OpenAI: "Please try again in 1m20s / 20s / 20ms", Azure: "Please retry after 20 seconds"
+    match = re.search(R"(?:try again|retry) (?:in|after) (?:(\d+)m(?!s))?(\d+(?:\.\d+)?)\s*(ms|s|sec|seconds?)\b",
+                      message)
+    if match is not None:
+        minutes, value, unit = match.groups()
+        seconds = float(value) / 1000 if unit == "ms" else float(value)
+        return 60 * int(minutes or 0) + seconds
+    return None
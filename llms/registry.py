@@ -0,0 +1,89 @@
+import importlib
+import logging
+import threading
+from pathlib import Path
+from typing import Callable, Optional
+
+from .base_llm import BaseLLM
+
+
+# factories of the backends by name, called with config_path, logger, silent and system_message
+LLM_BACKENDS: dict[str, Callable[..., BaseLLM]] = {}
+
+_instances: dict[tuple, BaseLLM] = {}
+# handles given out by `get_llm` and not yet given back by `release_llm`, per key
+_handles: dict[tuple, int] = {}
+_instances_lock = threading.Lock()
+
+
+def register_llm(name: str, factory: Callable[..., BaseLLM]) -> None:
+    """Makes a backend available to `get_llm` by name.
+
+    Args:
+        name (str): Name used for plan_by, eval_by and art_work, e.g. "GEMINI".
+        factory (Callable[..., BaseLLM]): Called with the keyword arguments config_path, logger, silent and
+            system_message, like the constructors of the LLM classes.
+    """
+    LLM_BACKENDS[name] = factory
+
+
+def get_llm(name: str,
+            config_path: Path,
+            logger: Optional[logging.Logger] = None,
+            silent: bool = False,
+            system_message: Optional[str] = None) -> BaseLLM:
+    """Returns the instance of the backend for these settings, created on first use and shared afterwards.
+
+    The planner, evaluator and art agent of a Preacher get the same instance when they use
+    the same backend, so it is built once and its client and connections are reused.
+    Each call takes a handle, which is given back with `release_llm`.
+    """
+    if name not in LLM_BACKENDS:
+        raise ValueError(f"Unknown LLM backend {name!r}, expected one of {sorted(LLM_BACKENDS)}.")
+    key = (name, str(Path(config_path).resolve()), logger, silent, system_message)
+    with _instances_lock:
+        if key not in _instances:
+            _instances[key] = LLM_BACKENDS[name](config_path=config_path, logger=logger,
+                                                 silent=silent, system_message=system_message)
+        _handles[key] = _handles.get(key, 0) + 1
+        return _instances[key]
+
+
+def release_llm(llm: BaseLLM) -> None:
+    """Gives back a handle taken by `get_llm`. The last handle closes the instance and removes it from the
+    registry, so a later `get_llm` with the same settings builds a new one."""
+    with _instances_lock:
+        key = next((key for key, instance in _instances.items() if instance is llm), None)
+        if key is None:
+            return
+        _handles[key] -= 1
+        if _handles[key] > 0:
+            return
+        del _instances[key]
+        del _handles[key]
+    if hasattr(llm, "close"):
+        llm.close()
+    # the backend hedging its calls, see `BaseLLM._query_secondary`
+    secondary = getattr(llm, "_hedge_llm", None)
+    if secondary is not None:
+        llm._hedge_llm = None
+        release_llm(secondary)
+
+
+def _lazy(module: str, class_name: str) -> Callable[..., BaseLLM]:
+    """Factory importing the backend class (and its SDK) only when the backend is first used."""
+    def factory(**kwargs) -> BaseLLM:
+        return getattr(importlib.import_module(module, __package__), class_name)(**kwargs)
+    return factory
+
+
+def _depictqa(config_path, logger, silent, system_message) -> BaseLLM:
+    from .depictqa import DepictQA
+    return DepictQA(logger=logger, silent=silent)
+
+
+register_llm("GPT4v", _lazy(".gpt4", "GPT4"))
+register_llm("GPT4_AZ", _lazy(".gpt4_az", "GPT4_AZ"))
+register_llm("GEMINI", _lazy(".gemini", "GEMINI"))
+register_llm("QWEN", _lazy(".qwen", "QWEN"))
+register_llm("depictqa", _depictqa)
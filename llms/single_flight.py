@@ -0,0 +1,67 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Awaitable, Callable, TypeVar
+
+
+T = TypeVar("T")
+
+# calls in progress by query key, shared by all the LLMs of the process, sync and async
+_in_flight: dict[str, Future] = {}
+_in_flight_lock = threading.Lock()
+
+
+def _join(key: str) -> tuple[Future, bool]:
+    """Returns the future of the call with `key` and whether the caller leads it, i.e. has to make the call."""
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        if future is not None:
+            return future, False
+        future = Future()
+        _in_flight[key] = future
+        return future, True
+
+
+def _settle(key: str, future: Future, fn: Callable[[], T]) -> T:
+    try:
+        result = fn()
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+
+
+def single_flight(key: str, fn: Callable[[], T]) -> tuple[T, bool]:
+    """Calls `fn`, unless a call with the same key is in progress, whose result (or error) is then shared.
+
+    Returns:
+        result: Result of `fn` or of the call in progress.
+        shared (bool): Whether the result comes from a call of another caller.
+    """
+    future, leader = _join(key)
+    if not leader:
+        return future.result(), True
+    return _settle(key, future, fn), False
+
+
+async def asingle_flight(key: str, fn: Callable[[], Awaitable[T]]) -> tuple[T, bool]:
+    """Async version of `single_flight`, sharing calls with the sync callers too."""
+    future, leader = _join(key)
+    if not leader:
+        return await asyncio.wrap_future(future), True
+    try:
+        result = await fn()
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result, False
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
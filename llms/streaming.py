@@ -0,0 +1,76 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator, Optional
+
+
+# called with each chunk of text of a streamed response
+ChunkConsumer = Callable[[str], None]
+
+_current_consumer: ContextVar[Optional[ChunkConsumer]] = ContextVar("chunk_consumer", default=None)
+
+
+class StreamAborted(Exception):
+    """Raised by a chunk consumer to stop the generation, e.g. when the output can no longer be parsed."""
+
+
+@contextmanager
+def consuming(on_chunk: Optional[ChunkConsumer]) -> Iterator[None]:
+    """Passes the chunks of the responses streamed in the block to `on_chunk`."""
+    token = _current_consumer.set(on_chunk)
+    try:
+        yield
+    finally:
+        _current_consumer.reset(token)
+
+
+def current_consumer() -> Optional[ChunkConsumer]:
+    return _current_consumer.get()
+
+
+class JsonStreamChecker:
+    """Chunk consumer checking that a response is on its way to contain a JSON object or array.
+
+    Any text or code fence may come before the JSON. The stream is aborted when a bracket
+    is closed by one of another kind. Nothing is checked after the JSON is complete.
+    """
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        """Forgets the chunks seen so far, for a new attempt of the request."""
+        self.n_chars = 0
+        self.stack: list[str] = []
+        self.quote: Optional[str] = None
+        self.escaped = False
+        self.done = False
+
+    def __call__(self, chunk: str) -> None:
+        for char in chunk:
+            self._feed(char)
+
+    def _feed(self, char: str) -> None:
+        if self.done:
+            return
+        self.n_chars += 1
+        if not self.stack:
+            if char in "{[":
+                self.stack.append(char)
+            return
+        if self.quote is not None:
+            if self.escaped:
+                self.escaped = False
+            elif char == "\\":
+                self.escaped = True
+            elif char == self.quote:
+                self.quote = None
+            return
+        # single quotes too, for Python literals
+        if char in "\"'":
+            self.quote = char
+        elif char in "{[":
+            self.stack.append(char)
+        elif char in "}]":
+            if self.stack.pop() != {"}": "{", "]": "["}[char]:
+                raise StreamAborted(f"Unbalanced {char!r} after {self.n_chars} characters.")
+            self.done = not self.stack
@@ -0,0 +1,171 @@
+import json
+import re
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+from utils.textwork import _load_json_dict
+
+
+# JSON schema of the output of the call in progress, for backends with a structured output mode
+_current_schema: ContextVar[Optional[dict]] = ContextVar("output_schema", default=None)
+
+_JSON_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+}
+
+
+class StructuredOutputError(ValueError):
+    """Raised when a response does not match the schema of the call, even after the repair pass."""
+
+
+@contextmanager
+def requesting(schema: Optional[dict]) -> Iterator[None]:
+    """Asks the backends for output matching `schema` in the requests of the block."""
+    token = _current_schema.set(schema)
+    try:
+        yield
+    finally:
+        _current_schema.reset(token)
+
+
+def current_schema() -> Optional[dict]:
+    return _current_schema.get()
+
+
+def schema_instructions(schema: dict) -> str:
+    """Appended to the prompt, so backends without a structured output mode know the format too."""
+    return ("\nAnswer with a single JSON value matching this JSON schema, and nothing else:\n"
+            + json.dumps(schema, ensure_ascii=False))
+
+
+def repair_instructions(response: str, errors: list[str]) -> str:
+    """Appended to the prompt when asking again for a response that does not match the schema."""
+    return ("\nYour previous answer did not match the schema:\n" + response
+            + "\nProblems: " + "; ".join(errors) + "\nAnswer again with valid JSON only.")
+
+
+def openai_response_format(schema: dict, mode: str) -> dict:
+    """`response_format` of the chat completions API, in "json_schema" or "json_object" mode."""
+    if mode == "json_object":
+        return {"type": "json_object"}
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": schema.get("title", "response"),
+            "schema": {name: value for name, value in schema.items() if name != "title"},
+            "strict": True,
+        },
+    }
+
+
+def gemini_schema(schema: dict) -> dict:
+    """Converts a JSON schema to the OpenAPI subset taken by Gemini as `response_schema`."""
+    converted = {}
+    for name, value in schema.items():
+        if name == "type":
+            converted["type"] = value.upper()
+        elif name == "properties":
+            converted["properties"] = {key: gemini_schema(sub) for key, sub in value.items()}
+        elif name == "items":
+            converted["items"] = gemini_schema(value)
+        elif name in ("required", "enum", "description"):
+            converted[name] = value
+    if "enum" in converted:
+        converted["format"] = "enum"
+    return converted
+
+
+def validate(value: object, schema: dict, path: str = "$") -> list[str]:
+    """Checks `value` against the subset of JSON schema used by the prompts: type, properties, required,
+    additionalProperties, items and enum. Returns the problems found."""
+    expected = schema.get("type")
+    if expected is not None:
+        # bool is an int in Python, but not in JSON
+        if not isinstance(value, _JSON_TYPES[expected]) or (isinstance(value, bool) and expected != "boolean"):
+            return [f"{path} should be of type {expected}, not {type(value).__name__}"]
+    errors = []
+    if "enum" in schema and value not in schema["enum"]:
+        errors.append(f"{path} should be one of {schema['enum']}, not {value!r}")
+    if isinstance(value, dict):
+        properties = schema.get("properties", {})
+        for name in schema.get("required", []):
+            if name not in value:
+                errors.append(f"{path} misses {name!r}")
+        for name, item in value.items():
+            if name in properties:
+                errors.extend(validate(item, properties[name], f"{path}.{name}"))
+            elif schema.get("additionalProperties", True) is False:
+                errors.append(f"{path} has unexpected {name!r}")
+    if isinstance(value, list) and "items" in schema:
+        for index, item in enumerate(value):
+            errors.extend(validate(item, schema["items"], f"{path}[{index}]"))
+    return errors
+
+
+def repair(value: object, schema: dict) -> object:
+    """Fixes the usual slips of models without a structured output mode: keys with stray spaces or another case,
+    scalars instead of strings, enum values in another case, a list where an object with one list field is
+    expected and the other way round."""
+    expected = schema.get("type")
+    if expected == "object" and isinstance(value, list):
+        lists = [name for name, sub in schema.get("properties", {}).items() if sub.get("type") == "array"]
+        if len(lists) == 1 and len(schema.get("properties", {})) == 1:
+            value = {lists[0]: value}
+        elif len(value) == 1:
+            value = value[0]
+    elif expected == "array" and isinstance(value, dict):
+        lists = [item for item in value.values() if isinstance(item, list)]
+        value = lists[0] if len(lists) == 1 else [value]
+    elif expected == "string" and isinstance(value, (int, float)) and not isinstance(value, bool):
+        value = str(value)
+    elif expected in ("integer", "number") and isinstance(value, str):
+        try:
+            value = int(value) if expected == "integer" else float(value)
+        except ValueError:
+            pass
+
+    if isinstance(value, str) and "enum" in schema and value not in schema["enum"]:
+        for option in schema["enum"]:
+            if isinstance(option, str) and option.lower() == value.strip().lower():
+                value = option
+                break
+    if isinstance(value, dict) and "properties" in schema:
+        properties = schema["properties"]
+        names = {re.sub(r"\s+", "", name).lower(): name for name in properties}
+        fixed = {}
+        for name, item in value.items():
+            name = names.get(re.sub(r"\s+", "", str(name)).lower(), name)
+            fixed[name] = repair(item, properties[name]) if name in properties else item
+        value = fixed
+    if isinstance(value, list) and "items" in schema:
+        value = [repair(item, schema["items"]) for item in value]
+    return value
+
+
+def conform(response: str, schema: dict) -> tuple[object, list[str]]:
+    """Parses a response, repairs it locally and validates it against `schema`.
+
+    Returns:
+        value: Parsed and repaired response, or None if it is not JSON.
+        errors (list[str]): Problems left, empty if the response matches the schema.
+    """
+    try:
+        value = _load_json_dict(response)
+    except ValueError:
+        # a sentence before or after the JSON
+        start = min((index for index in (response.find("{"), response.find("[")) if index >= 0), default=-1)
+        end = max(response.rfind("}"), response.rfind("]"))
+        try:
+            if start < 0 or end < start:
+                raise ValueError("no JSON object or array")
+            value = _load_json_dict(response[start:end + 1])
+        except ValueError as e:
+            return None, [f"the response is not JSON ({e})"]
+    value = repair(value, schema)
+    return value, validate(value, schema)
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Optional, Union
+
+from utils.misc import hash_file
+
+
+def hash_obj(obj: object) -> str:
+    """Returns the sha256 of a JSON-serializable object."""
+    data = json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class ArtifactGraph:
+    """Dependency graph of the artifacts of one run, persisted in a JSON manifest.
+
+    Each node is an artifact file (plan, audio, video, ...). Its key is the hash of
+    its own inputs (prompts, model config, plan fields) and of the content digests
+    of the nodes it depends on, so a node becomes stale as soon as anything it is
+    built from changes, including an upstream artifact that was rebuilt.
+
+    Args:
+        manifest_path (Path): Path to the JSON manifest, created if missing.
+    """
+
+    def __init__(self, manifest_path: Path) -> None:
+        self.manifest_path = Path(manifest_path)
+        self._lock = threading.Lock()
+        if self.manifest_path.exists():
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                self.nodes: dict[str, dict] = json.load(f)
+        else:
+            self.nodes = {}
+
+    def key(self, name: str, inputs: object = None, deps: tuple[str, ...] = ()) -> str:
+        """Computes the key of node `name` from its inputs and the digests of its dependencies."""
+        with self._lock:
+            dep_digests = {dep: self.nodes.get(dep, {}).get("digest") for dep in deps}
+        return hash_obj({"name": name, "inputs": inputs, "deps": dep_digests})
+
+    def is_fresh(self, name: str, key: str) -> bool:
+        """Whether node `name` was built with `key` and its file still exists."""
+        with self._lock:
+            node = self.nodes.get(name)
+        return node is not None and node["key"] == key and Path(node["path"]).exists()
+
+    def is_outdated(self, name: str, key: str) -> bool:
+        """Whether node `name` was built before, but from different inputs."""
+        with self._lock:
+            node = self.nodes.get(name)
+        return node is not None and node["key"] != key
+
+    def path(self, name: str) -> Path:
+        with self._lock:
+            return Path(self.nodes[name]["path"])
+
+    def meta(self, name: str) -> dict:
+        """Extra values stored alongside node `name` when it was recorded."""
+        with self._lock:
+            return dict(self.nodes[name].get("meta", {}))
+
+    def record(self,
+               name: str,
+               key: str,
+               path: Union[Path, str],
+               deps: tuple[str, ...] = (),
+               meta: Optional[dict] = None) -> None:
+        """Marks node `name` as built from `key`, and saves the manifest."""
+        digest = hash_file(path)
+        with self._lock:
+            self.nodes[name] = {
+                "key": key,
+                "path": str(path),
+                "digest": digest,
+                "deps": list(deps),
+                "meta": meta or {},
+            }
+            self._save()
+
+    def _save(self) -> None:
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.nodes, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
@@ -0,0 +1,173 @@
+import json
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import time
+
+from llms.metering import Meter
+from utils.logger import get_logger
+from .concurrency import ToolLimiter
+from .preacher import Preacher, close_clients, create_clients
+
+
+def load_manifest(input_path: Path) -> list[dict]:
+    """Lists the papers of a batch.
+
+    Args:
+        input_path (Path): A directory whose PDFs are all processed, or a JSONL manifest with one
+            {"pdf": ..., "high_plan": ... (optional)} dict per line. Relative paths in the manifest
+            are resolved against the directory of the manifest.
+
+    Returns:
+        list[dict]: One dict per paper, with a resolved "pdf" path.
+    """
+    input_path = Path(input_path)
+    if input_path.is_dir():
+        return [{"pdf": pdf_path.resolve()} for pdf_path in sorted(input_path.glob("*.pdf"))]
+
+    papers = []
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            paper = json.loads(line)
+            assert "pdf" in paper, f"Manifest entry without a pdf: {line}"
+            for key in ("pdf", "high_plan"):
+                if paper.get(key) is not None:
+                    paper[key] = (input_path.parent / paper[key]).resolve()
+            papers.append(paper)
+    return papers
+
+
+class BatchRunner:
+    """Runs Preacher on many papers with one worker pool, one set of LLM and tool clients and one set of tool caps.
+
+    Args:
+        input_path (Path): Directory of PDFs or JSONL manifest, see `load_manifest`.
+        output_dir (Path): Path to the output directory. Each paper gets its own directory in it, as with a single run.
+        llm_config_path (Path): Path to the config file of LLM.
+        plan_by (str): Agent used for planning.
+        eval_by (str): Agent used for review.
+        art_work (str): Agent used for creation.
+        max_workers (int, optional): Number of papers processed concurrently. Defaults to 2.
+        silent (bool, optional): Whether to suppress the console output. Defaults to False.
+        **preacher_kwargs: Other arguments passed to every Preacher.
+    """
+
+    def __init__(
+        self,
+        input_path: Path,
+        output_dir: Path,
+        llm_config_path: Path,
+        plan_by: str,
+        eval_by: str,
+        art_work: str,
+        max_workers: int = 2,
+        silent: bool = False,
+        **preacher_kwargs,
+    ) -> None:
+        assert max_workers >= 1, "max_workers should be at least 1."
+        self.papers = load_manifest(input_path)
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.llm_config_path = llm_config_path
+        self.plan_by = plan_by
+        self.eval_by = eval_by
+        self.art_work = art_work
+        self.max_workers = max_workers
+        self.silent = silent
+        # the caps hold across papers: manim and pymol rewrite shared files, and the quotas are per account
+        self.tool_limiter = ToolLimiter(preacher_kwargs.pop("tool_concurrency", None))
+        self.preacher_kwargs = preacher_kwargs
+
+        self.summary_path = self.output_dir / "batch_summary.json"
+        self.metrics_path = self.output_dir / "batch_metrics.json"
+        self.meter = Meter()
+        self.statuses: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+        self.logger = get_logger(
+            logger_name="Batch",
+            log_file=self.output_dir / "batch.log",
+            silent=silent,
+        )
+        # the shared clients log every paper's chats into one file
+        self.qa_logger = get_logger(
+            logger_name="QA",
+            log_file=self.output_dir / "batch_llm_qa.md",
+            console_log_level=logging.WARNING,
+            file_format_str="%(message)s",
+            silent=silent,
+        )
+        self.clients = create_clients(
+            llm_config_path,
+            plan_by,
+            eval_by,
+            art_work,
+            general_video_tool=preacher_kwargs.get("general_video_work", "wanx"),
+            captioning_tool=preacher_kwargs.get("captioning_work", "wanx"),
+            audio_tool=preacher_kwargs.get("audio_work", "qwentts"),
+            logger=self.qa_logger,
+            silent=silent,
+        )
+
+    def run(self) -> list[dict]:
+        """Processes every paper and returns their statuses, which are also saved to `batch_summary.json`."""
+        self.logger.info(f"Processing {len(self.papers)} papers with {self.max_workers} workers.")
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                statuses = list(executor.map(self._run_paper, self.papers))
+        finally:
+            close_clients(self.clients)
+            self.meter.export(self.metrics_path)
+        n_done = sum(status["status"] == "done" for status in statuses)
+        self.logger.info(f"Batch finished: {n_done} done, {len(statuses) - n_done} failed.")
+        return statuses
+
+    def _run_paper(self, paper: dict) -> dict:
+        pdf_path = Path(paper["pdf"])
+        status = {
+            "pdf": str(pdf_path),
+            "status": "running",
+            "final_video": None,
+            "error": None,
+            "elapsed": None,
+        }
+        self._update_summary(status)
+        start = time()
+        agent = None
+        try:
+            agent = Preacher(
+                input_path=pdf_path,
+                output_dir=self.output_dir,
+                llm_config_path=self.llm_config_path,
+                plan_by=self.plan_by,
+                eval_by=self.eval_by,
+                art_work=self.art_work,
+                silent=self.silent,
+                shared_clients=self.clients,
+                tool_limiter=self.tool_limiter,
+                **self.preacher_kwargs,
+            )
+            agent.run(high_plan=paper.get("high_plan"))
+            status["status"] = "done"
+            status["final_video"] = str(agent.final_video_path_)
+        except Exception as e:
+            status["status"] = "failed"
+            status["error"] = f"{type(e).__name__}: {e}"
+            self.logger.error(f"{pdf_path.name} failed:\n{traceback.format_exc()}")
+        if agent is not None:
+            self.meter.extend(agent.meter)
+        status["elapsed"] = round(time() - start, 1)
+        self.logger.info(f"{pdf_path.name}: {status['status']} in {status['elapsed']}s")
+        self._update_summary(status)
+        return status
+
+    def _update_summary(self, status: dict) -> None:
+        """Saves the status of every paper so far, so an interrupted batch still leaves a summary."""
+        with self._lock:
+            self.statuses[status["pdf"]] = dict(status)
+            with open(self.summary_path, "w", encoding="utf-8") as f:
+                json.dump(list(self.statuses.values()), f, ensure_ascii=False, indent=2)
@@ -0,0 +1,62 @@
+import contextvars
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+
+# Default number of calls allowed in flight per backend.
+DEFAULT_TOOL_CONCURRENCY: dict[str, int] = {
+    "wanx": 4,
+    "tavus": 2,
+    "qwentts": 4,
+    "manim": 1,
+    "pymol": 1,
+    "ffmpeg": 2,
+}
+# Backends rendering one scene at a time whatever the limits: Manim scenes are written to the
+# shared utils/math_vis.py before rendering, and PyMOL keeps global renderer state.
+SERIAL_TOOLS = ("manim", "pymol")
+
+
+class ToolLimiter:
+    """Caps the number of concurrent calls to each generation backend.
+
+    Args:
+        limits (dict[str, int], optional): Overrides of `DEFAULT_TOOL_CONCURRENCY`, keyed by backend name.
+            The backends of `SERIAL_TOOLS` cannot be raised above 1. Defaults to None.
+    """
+
+    def __init__(self, limits: Optional[dict[str, int]] = None) -> None:
+        self.limits = dict(DEFAULT_TOOL_CONCURRENCY)
+        if limits is not None:
+            self.limits.update(limits)
+        for name, limit in self.limits.items():
+            assert limit >= 1, f"Concurrency limit of {name} should be at least 1."
+            assert name not in SERIAL_TOOLS or limit == 1, f"{name} renders one scene at a time, its limit should be 1."
+        self._semaphores = {
+            name: threading.BoundedSemaphore(limit)
+            for name, limit in self.limits.items()
+        }
+
+    def slots(self, name: str) -> threading.BoundedSemaphore:
+        """Semaphore of backend `name`, for clients that hold a slot per task instead of per block."""
+        assert name in self._semaphores, f"Unknown tool: {name}"
+        return self._semaphores[name]
+
+    @contextmanager
+    def __call__(self, name: str) -> Iterator[None]:
+        """Holds one slot of backend `name` for the duration of the block."""
+        assert name in self._semaphores, f"Unknown tool: {name}"
+        with self._semaphores[name]:
+            yield
+
+
+def with_context(fn: Callable) -> Callable:
+    """Wraps `fn` to run in a copy of the caller's context, so context variables such as the LLM metering stage follow it into thread pools."""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # a context can only be entered by one thread at a time, so each call gets its own copy
+        return context.copy().run(fn, *args, **kwargs)
+
+    return run
@@ -4,21 +4,90 @@ import logging
 from time import localtime, strftime
 import json
 import random
-from typing import Optional
+from typing import Callable, Optional
 import re
 import os 
-from llms import GPT4, DepictQA, GPT4_AZ, GEMINI,QWEN
+import threading
+import yaml
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from llms import get_llm, release_llm
+from llms.metering import Meter, metering, stage
+from llms.streaming import JsonStreamChecker
+from llms.structured import StructuredOutputError, conform
 from . import prompts
-from utils.slides import create_ppt_style_image, get_specific_element
+from .concurrency import ToolLimiter, with_context
+from .artifacts import ArtifactGraph
+from .scene import SceneContext
 from utils.logger import get_logger
 from utils.custom_types import *
 from utils.textwork import merge_dict_keys_values, classify_response, text_to_list, extract_code,replace_animate,extract_dict,extract_list_from_text, _load_json_dict
-from utils.videowork import extract_key_frames, merge_video_audio, image_to_images, image_to_video, concatenate_videos
-from utils.math_vis import render_video
-from moviepy.editor import VideoFileClip
-from tools import Wanxiang_video, Wanxiang_image, TavusClient, Qwentts
 from utils.misc import download_file, name_to_pdb_ids, download_pdb
-from utils.mol import generate_mol_animation
+from utils.http import DEFAULT_POOL_MAXSIZE, configure_session
+
+
+# attributes of Preacher holding the LLM and tool clients
+CLIENT_NAMES = ("planner", "evaluator", "art_agent", "audio_tool",
+                "general_video_tool", "captioning_tool", "talking_head_tool")
+
+
+def create_clients(
+    llm_config_path: Path,
+    plan_by: str,
+    eval_by: str,
+    art_work: str,
+    general_video_tool: str = "wanx",
+    captioning_tool: str = "wanx",
+    audio_tool: str = "qwentts",
+    logger: Optional[logging.Logger] = None,
+    silent: bool = False,
+) -> dict[str, object]:
+    """Creates the LLM and tool clients of a Preacher, keyed by `CLIENT_NAMES`. The clients can be shared by several Preachers."""
+    # tools and backends are imported only when used, along with their SDKs
+    from tools import Qwentts, TavusClient, Wanxiang_image, Wanxiang_video
+    with open(llm_config_path, "r") as f:
+        http_cfg = (yaml.safe_load(f) or {}).get("HTTP") or {}
+    if http_cfg:
+        # connection pools of the session shared by the REST clients
+        configure_session(http_cfg.get("POOL_MAXSIZE", DEFAULT_POOL_MAXSIZE),
+                          http_cfg.get("HOST_POOL_MAXSIZE"),
+                          http_cfg.get("BLOCK", False))
+    clients = {}
+    # LLMs, one instance per backend shared by the roles that use it
+    if plan_by != "GPT4v" and eval_by == "depictqa":
+        plan_by = "depictqa"
+    for name, backend in (("planner", plan_by), ("evaluator", eval_by), ("art_agent", art_work)):
+        clients[name] = get_llm(backend, llm_config_path, logger=logger, silent=silent,
+                                system_message=prompts.system_message)
+    clients["audio_tool"] = audio_tool
+    if audio_tool== "qwentts":
+        clients["audio_tool"] = Qwentts(config_path=llm_config_path)
+    clients["general_video_tool"] = general_video_tool
+    if general_video_tool == "wanx":
+        clients["general_video_tool"] = Wanxiang_video(config_path=llm_config_path)
+    clients["captioning_tool"] = captioning_tool
+    if captioning_tool == "wanx":
+        clients["captioning_tool"] = Wanxiang_image(config_path=llm_config_path)
+    clients["talking_head_tool"] = TavusClient(config_path=llm_config_path)
+    return clients
+
+
+def close_clients(clients: dict, pdf_path: Optional[Path] = None) -> None:
+    """Frees the remote resources (uploads, assistants, ...) the clients hold, only those of `pdf_path` if given.
+
+    Without `pdf_path`, the clients are done with: the LLMs give back their handles from `get_llm`,
+    which closes and forgets each instance no other Preacher holds.
+    """
+    if pdf_path is None:
+        for name in ("planner", "evaluator", "art_agent"):
+            if clients.get(name) is not None:
+                release_llm(clients[name])
+    # roles using the same backend share one instance
+    for name, client in {id(client): (name, client) for name, client in clients.items()}.values():
+        if pdf_path is not None and hasattr(client, "release"):
+            client.release(pdf_path)
+        elif pdf_path is None and name not in ("planner", "evaluator", "art_agent") and hasattr(client, "close"):
+            client.close()
+
 
 class Preacher:
     """
@@ -33,8 +102,25 @@ class Preacher:
         eval_by (str, optional): The method of reflection on results of tools, "depictqa" or "gpt4v". Defaults to "depictqa".
         with_rollback (bool, optional): Whether to roll back when failing in one subtask. Defaults to True.
         silent (bool, optional): Whether to suppress the console output. Defaults to False.
+        max_plan_workers (int, optional): Number of scenes planned concurrently in low-level planning. 1 plans the scenes one after another. Defaults to 1.
+        max_generate_workers (int, optional): Number of scenes generated concurrently. 1 generates the scenes one after another. Defaults to 1.
+        tool_concurrency (dict[str, int] | None, optional): Maximum number of concurrent calls per backend ("wanx", "tavus", "qwentts", "manim", "pymol", "ffmpeg"). Unset backends use `DEFAULT_TOOL_CONCURRENCY`. Defaults to None.
+        tool_limiter (ToolLimiter | None, optional): Limiter to use instead of creating one from `tool_concurrency`, e.g. to share the caps across papers. Defaults to None.
+        pipelined (bool, optional): Whether to start generating a scene as soon as its low-level plan is done, instead of after all scenes are planned. Defaults to False.
+        shared_clients (dict[str, object] | None, optional): Clients returned by `create_clients` to use instead of creating new ones, e.g. to share them across papers. Defaults to None.
+        wanx_submit_all (bool, optional): Whether to submit the first Wanxiang candidate of every general and captioning scene up front and poll them together, so their generation overlaps. The tasks run in the background, and each scene only waits for its own candidate. When pipelined, a scene is submitted as soon as it is planned. Up to tool_concurrency["wanx"] tasks are in flight. Defaults to False.
+        early_audio (bool, optional): Whether to synthesize the narration of each scene in the background as soon as it is final, instead of when the scene is generated. Defaults to True.
+        speculative_candidates (int, optional): Number of prompt variants of a general scene rendered at once by Wanxiang in each try. The first variant that passes evaluation is kept and the others are cancelled. 1 renders one candidate per try. Defaults to 1.
     """
 
+    # prompts that the artifacts of each stage are built from
+    HIGH_PLAN_PROMPTS = ("high_level_planning_prompt", "high_level_replanning_prompt",
+                         "high_level_evaluate_prompt", "high_plan_format_prompt", "high_plan_schema")
+    LOW_PLAN_PROMPTS = ("low_level_planning_prompt", "low_level_replanning_prompt", "low_level_evaluate_prompt",
+                        "low_level_evaluate_prompt_list", "low_plan_format_prompt", "low_plan_schema")
+    VISUAL_PROMPTS = ("pro_classify_prompt", "pro_format_prompt", "animate_code_schema",
+                      "pro_vis_eval", "gen_vis_eval", "slides_vis_eval")
+
     def __init__(
         self,
         input_path: Path,
@@ -58,6 +144,15 @@ class Preacher:
         captioning_work: str = "wanx",
         slides_work: str = "xinghuo",
         audio_work: str = "qwentts",
+        max_plan_workers: int = 1,
+        max_generate_workers: int = 1,
+        tool_concurrency: Optional[dict[str, int]] = None,
+        tool_limiter: Optional[ToolLimiter] = None,
+        pipelined: bool = False,
+        shared_clients: Optional[dict[str, object]] = None,
+        wanx_submit_all: bool = False,
+        speculative_candidates: int = 1,
+        early_audio: bool = True,
     ) -> None:
         # paths
         self.pdf_path = input_path
@@ -79,9 +174,34 @@ class Preacher:
             captioning_work,
             slides_work,
             audio_work,
+            max_plan_workers,
+            max_generate_workers,
+            pipelined,
         )
         # components
-        self._create_components(llm_config_path, schedule_example_path, silent)
+        self.tool_limiter = tool_limiter if tool_limiter is not None else ToolLimiter(tool_concurrency)
+        self.artifacts = ArtifactGraph(self.artifacts_path)
+        self._cleared_nodes: set[str] = set()
+        self.meter = Meter()
+        assert speculative_candidates >= 1, "speculative_candidates should be at least 1."
+        self.speculative_candidates = speculative_candidates
+        self.early_audio = early_audio
+        self.audio_executor: Optional[ThreadPoolExecutor] = None
+        self._audio_futures: dict[str, tuple[str, Future]] = {}
+        self._audio_lock = threading.Lock()
+        self.wanx_submit_all = wanx_submit_all
+        # scenes whose first Wanxiang candidate is prefetched, resolved once it is in place or has failed
+        self._wanx_prefetch: dict[int, Future] = {}
+        self._prefetch_executor: Optional[ThreadPoolExecutor] = None
+        self._prefetch_lock = threading.Lock()
+        self.wanx_async = None
+        if wanx_submit_all or speculative_candidates > 1:
+            from tools import WanxiangAsync
+            # the tasks of all scenes, and of all papers sharing the limiter, count against one budget
+            self.wanx_async = WanxiangAsync(config_path=llm_config_path,
+                                            max_in_flight=self.tool_limiter.limits["wanx"],
+                                            slots=self.tool_limiter.slots("wanx"))
+        self._create_components(llm_config_path, schedule_example_path, silent, shared_clients)
         # constants
         self._set_constants()
 
@@ -101,6 +221,9 @@ class Preacher:
         captioning_tool: str  ,
         slides_tool: str ,
         audio_tool: str ,
+        max_plan_workers: int,
+        max_generate_workers: int,
+        pipelined: bool,
     ) -> None:
         #assert plan_by in {"GPT4v", "depictqa", "GPT4_AZ", "GEMINI"}
         self.plan_by = plan_by
@@ -121,12 +244,18 @@ class Preacher:
         self.slides_tool = slides_tool
         self.audio_tool = audio_tool
         self.max_generate_iteration =max_generate_iteration
+        assert max_plan_workers >= 1, "max_plan_workers should be at least 1."
+        self.max_plan_workers = max_plan_workers
+        assert max_generate_workers >= 1, "max_generate_workers should be at least 1."
+        self.max_generate_workers = max_generate_workers
+        self.pipelined = pipelined
 
     def _create_components(
         self,
         llm_config_path: Path,
         schedule_example_path: Optional[Path],
         silent: bool,
+        shared_clients: Optional[dict[str, object]] = None,
     ) -> None:
         # logger
         self.qa_logger = get_logger(
@@ -145,98 +274,23 @@ class Preacher:
             silent=silent,
         )
 
-        # LLM
-        if self.plan_by == "GPT4v":
-            self.planner = GPT4(
-                config_path=llm_config_path,
-                logger=self.qa_logger,
-                silent=silent,
-                system_message=prompts.system_message,
-            )
-        elif self.plan_by == "depictqa" or self.eval_by == "depictqa":
-            self.planner = DepictQA(logger=self.qa_logger, silent=silent)
-        elif self.plan_by == "GPT4_AZ":
-            self.planner = GPT4_AZ(
-                config_path=llm_config_path,
-                logger=self.qa_logger,
-                silent=silent,
-                system_message=prompts.system_message,
-            )
-        elif self.plan_by == "GEMINI":
-            self.planner = GEMINI(
-                config_path=llm_config_path,
-                logger=self.qa_logger,
-                silent=silent,
-                system_message=prompts.system_message,
-            )
-        elif self.plan_by == "QWEN":
-            self.planner = QWEN(
-                config_path=llm_config_path,
-                logger=self.qa_logger,
-                silent=silent,
-                system_message=prompts.system_message,
-            )
-        
-        # LLM evaluator
-        if self.eval_by == "GPT4v":
-            self.evaluator = GPT4(
-                config_path=llm_config_path,
-                logger=self.qa_logger,
-                silent=silent,
-                system_message=prompts.system_message,
-            )
-        elif self.eval_by == "depictqa" :
-            self.evaluator = DepictQA(logger=self.qa_logger, silent=silent)
-        elif self.eval_by== "GPT4_AZ":
-            self.evaluator = GPT4_AZ(
-                config_path=llm_config_path,
-                logger=self.qa_logger,
-                silent=silent,
-                system_message=prompts.system_message,
-            )
-        elif self.eval_by == "GEMINI":
-            self.evaluator = GEMINI(
-                config_path=llm_config_path,
-                logger=self.qa_logger,
-                silent=silent,
-                system_message=prompts.system_message,
-            )
-        elif self.eval_by == "QWEN":
-            self.evaluator = QWEN(
-                config_path=llm_config_path,
-                logger=self.qa_logger,
-                silent=silent,
-                system_message=prompts.system_message,
-            )
-        #Generator
-        if self.art_work == "GPT4_AZ":
-            self.art_agent = GPT4_AZ(
-                config_path=llm_config_path,
-                logger=self.qa_logger,
-                silent=silent,
-                system_message=prompts.system_message,
-            )
-        elif self.art_work == "GEMINI":
-            self.art_agent = GEMINI(
-                config_path=llm_config_path,
-                logger=self.qa_logger,
-                silent=silent,
-                system_message=prompts.system_message,
-            )
-        elif self.art_work == "QWEN":
-            self.art_agent = QWEN(
-                config_path=llm_config_path,
+        # LLM and tools
+        # clients created here are closed at the end of `run`, shared ones by their owner
+        self._owns_clients = shared_clients is None
+        if shared_clients is None:
+            shared_clients = create_clients(
+                llm_config_path,
+                self.plan_by,
+                self.eval_by,
+                self.art_work,
+                self.general_video_tool,
+                self.captioning_tool,
+                self.audio_tool,
                 logger=self.qa_logger,
                 silent=silent,
-                system_message=prompts.system_message,
             )
-        if self.audio_tool== "qwentts":
-            self.audio_tool = Qwentts(config_path=llm_config_path)
-        if self.general_video_tool == "wanx":
-            self.general_video_tool = Wanxiang_video(config_path=llm_config_path)
-        if self.captioning_tool == "wanx":
-            self.captioning_tool = Wanxiang_image(config_path=llm_config_path)
-        self.talking_head_tool = TavusClient(config_path=llm_config_path)
+        for name in CLIENT_NAMES:
+            setattr(self, name, shared_clients.get(name))
         # example
         if self.with_example:
             assert (
@@ -267,15 +321,136 @@ class Preacher:
         self.subtasks = set(self.degra_subtask_dict.values())
         self.levels: list[Level] = ["very low", "low", "medium", "high", "very high"]
         
-    def _ensure_audio(self, content: str, return_url=False) -> Path:
-        target = self.curr_scene_dir / "audio.wav"
-        if target.exists():
-            return target
-        url = self.audio_tool.return_audio(content)
-        if return_url:
-            return url 
-        return Path(download_file(url, target)) 
-    def run(self, high_plan: Optional[list[Subtask]]=None) -> None:#low_plan: Optional[list[Subtask]]=None, cache: Optional[Path]=None
+    def _llm_config(self, llm) -> dict:
+        """Backend, model and sampling settings of an LLM, as an input of the artifacts it builds."""
+        model = llm.model if isinstance(getattr(llm, "model", None), str) else getattr(llm, "dir", None)
+        return {
+            "backend": type(llm).__name__,
+            "model": model,
+            "temperature": getattr(llm, "temperature", None),
+            "structured_output": getattr(llm, "structured_output", False),
+        }
+
+    def _structured(self, llm) -> bool:
+        """Whether `llm` is asked for output matching a schema, instead of free text fixed by a format prompt."""
+        return bool(getattr(llm, "structured_output", False))
+
+    def _ask_structured(self, llm, schema: dict, **kwargs) -> Optional[str]:
+        """Asks `llm` for JSON text matching `schema`, or returns None if the response never matched."""
+        try:
+            return llm(schema=schema, on_chunk=JsonStreamChecker(), **kwargs)
+        except StructuredOutputError as e:
+            self.workflow_logger.warning(f"Falling back to free text: {e}")
+            return None
+
+    def _ask_json(self, llm, **kwargs) -> str:
+        """Asks `llm` for text holding a JSON object or array. The response is streamed and dropped as soon as
+        it cannot be JSON, then asked again once without the check."""
+        rsp = eval(llm(on_chunk=JsonStreamChecker(), **kwargs))
+        try:
+            _load_json_dict(rsp)
+            return rsp
+        except ValueError as e:
+            self.workflow_logger.warning(f"Asking again for JSON: {e}")
+            return eval(llm(use_cache=False, **kwargs))
+
+    def _prompt_inputs(self, names: tuple[str, ...]) -> dict:
+        return {name: getattr(prompts, name) for name in names}
+
+    def _ensure_audio(self, ctx: SceneContext, return_url=False) -> Path:
+        content = ctx.plan["audio_content"]
+        node = ctx.node("audio")
+        if not return_url:
+            with self._audio_lock:
+                scheduled = self._audio_futures.pop(node, None)
+            if scheduled is not None:
+                # also waits for a narration scheduled from an older content, so it does not overwrite the new one
+                audio_path = scheduled[1].result()
+                if scheduled[0] == content:
+                    return audio_path
+        return self._synthesize_audio(ctx, content, return_url)
+
+    def _schedule_audio(self, ctx: SceneContext) -> None:
+        """Starts synthesizing the narration of a scene in the background. `_ensure_audio` then waits for it."""
+        if self.audio_executor is None:
+            return
+        content = ctx.plan["audio_content"]
+        with self._audio_lock:
+            if ctx.node("audio") in self._audio_futures:
+                return
+            future = self.audio_executor.submit(with_context(self._synthesize_audio), ctx, content)
+            self._audio_futures[ctx.node("audio")] = (content, future)
+
+    def _synthesize_audio(self, ctx: SceneContext, content: str, return_url=False) -> Path:
+        node = ctx.node("audio")
+        key = self.artifacts.key(node, {"content": content, "tool": type(self.audio_tool).__name__})
+        if not return_url and self.artifacts.is_fresh(node, key):
+            return ctx.audio_path
+        with self.tool_limiter("qwentts"):
+            url = self.audio_tool.return_audio(content)
+            if return_url:
+                return url 
+            audio_path = Path(download_file(url, ctx.audio_path))
+        self.artifacts.record(node, key, audio_path)
+        return audio_path
+
+    def _visual_key(self, ctx: SceneContext) -> tuple[str, str]:
+        """Returns the node name and key of the visual (video or image) of a scene."""
+        node = ctx.node("visual")
+        inputs = {
+            "art_agent": self._llm_config(self.art_agent),
+            "evaluator": self._llm_config(self.evaluator),
+            "prompts": self._prompt_inputs(self.VISUAL_PROMPTS),
+            "manim_example": self.manim_example if self.with_example else None,
+            "max_generate_iteration": self.max_generate_iteration,
+        }
+        return node, self.artifacts.key(node, inputs, deps=(ctx.node("plan"),))
+
+    def _clear_candidates(self, ctx: SceneContext, node: str, key: str) -> None:
+        """Removes the candidates left in the scene directory by an outdated build of a visual, once per run."""
+        if node in self._cleared_nodes or not self.artifacts.is_outdated(node, key):
+            return
+        for pattern in ("test*.mp4", "test*.png", "image*.png", "video.mp4"):
+            for path in ctx.scene_dir.glob(pattern):
+                path.unlink()
+        self._cleared_nodes.add(node)
+
+    def _record_visual(self, ctx: SceneContext, node: str, key: str, path: Path) -> None:
+        if os.path.exists(path):
+            self.artifacts.record(node, key, path, deps=(ctx.node("plan"),),
+                                  meta={"audio_content": ctx.plan["audio_content"]})
+
+    def _compose_scene(self, ctx: SceneContext, visual_path: Path, time: str, from_image: bool = False) -> None:
+        """Merges the visual and the narration of a scene into its final video, unless they are unchanged."""
+        from utils.videowork import image_to_video, merge_video_audio
+        node = ctx.node("video")
+        deps = (ctx.node("visual"), ctx.node("audio"))
+        key = self.artifacts.key(node, {"time_cost": time}, deps=deps)
+        if self.artifacts.is_fresh(node, key):
+            return
+        with self.tool_limiter("ffmpeg"):
+            if from_image:
+                image_to_video(visual_path, ctx.audio_path, time, ctx.final_video_path)
+            else:
+                merge_video_audio(visual_path, ctx.audio_path, time, ctx.final_video_path)
+        self.artifacts.record(node, key, ctx.final_video_path, deps=deps)
+
+    def run(self, high_plan: Optional[list[Subtask]]=None) -> None:
+        """Generates the video of the paper, recording the tokens, latency and cost of every LLM call to `metrics.json`."""
+        try:
+            with metering(self.meter):
+                self._run(high_plan)
+        finally:
+            self.meter.export(self.metrics_path)
+            total = self.meter.summary()["total"]
+            self.workflow_logger.info(
+                f"LLM usage: {total['calls']} calls, {total['prompt_tokens']} prompt tokens, "
+                f"{total['completion_tokens']} completion tokens, {total['wall_time']:.1f}s, ${total['cost']:.4f}")
+
+    def _run(self, high_plan: Optional[list[Subtask]]=None) -> None:#low_plan: Optional[list[Subtask]]=None, cache: Optional[Path]=None
+        from utils.videowork import concatenate_videos
+        # the low-level plans and scenes depend on the paper too, also when the high-level plan is given
+        self.artifacts.record("pdf", "source", self.pdf_path)
         if high_plan is not None:
             with open(high_plan, 'r') as file:
                 self.high_plan = file.read() 
@@ -293,18 +468,47 @@ class Preacher:
                                     "source": "",
                                     "prompt": ""
                                     })
-            self.scene_idx = i
-            self.low_planning(self.high_plan_list[i])#self.high_plan_list[i]
-        self.video_list = []
-        for i in range(len(self.high_plan_list)):#len(self.high_plan_list)
-            self.scene_idx = i
-            self.generate_(i)
-            self.video_list.append(self.work_dir /f"scene_{self.scene_idx}"/"scene{}.mp4".format(self.scene_idx))#self.generate_(i)) 
-        concatenate_videos(self.video_list, self.final_video_path_)
+        if self.early_audio:
+            self.audio_executor = ThreadPoolExecutor(max_workers=self.tool_limiter.limits["qwentts"])
+        try:
+            if self.pipelined:
+                self.video_list = self.plan_and_generate_all()
+            else:
+                self.low_planning_all()
+                self.video_list = self.generate_all()
+        finally:
+            if self.audio_executor is not None:
+                self.audio_executor.shutdown(wait=True, cancel_futures=True)
+                self.audio_executor = None
+                self._audio_futures.clear()
+            if self._prefetch_executor is not None:
+                self._prefetch_executor.shutdown(wait=True, cancel_futures=True)
+                self._prefetch_executor = None
+                self._wanx_prefetch.clear()
+            # planning and evaluation are done, so the resources created for this paper can go
+            close_clients({name: getattr(self, name) for name in CLIENT_NAMES}, self.pdf_path)
+            if self._owns_clients:
+                close_clients({name: getattr(self, name) for name in CLIENT_NAMES})
+            if getattr(self.planner, "cache", None) is not None:
+                self.workflow_logger.info(f"LLM response cache: {self.planner.cache.stats()}")
+        deps = tuple(f"scene_{i}/video" for i in range(len(self.video_list)))
+        key = self.artifacts.key("final", deps=deps)
+        if not self.artifacts.is_fresh("final", key):
+            with self.tool_limiter("ffmpeg"):
+                concatenate_videos(self.video_list, self.final_video_path_)
+            self.artifacts.record("final", key, self.final_video_path_, deps=deps)
 
     def high_planning(self) -> None:
         """Sets the initial plan."""
-        if os.path.exists(self.high_plan_path):
+        inputs = {
+            "planner": self._llm_config(self.planner),
+            "evaluator": self._llm_config(self.evaluator),
+            "prompts": self._prompt_inputs(self.HIGH_PLAN_PROMPTS),
+            "example": self.high_example if self.with_example else None,
+            "with_reflection": self.with_reflection,
+        }
+        key = self.artifacts.key("highplan", inputs, deps=("pdf",))
+        if self.artifacts.is_fresh("highplan", key):
             with open(self.high_plan_path, "r") as file:
                 high_plan_legal = file.read()
                 return high_plan_legal
@@ -326,8 +530,10 @@ class Preacher:
         #     file.write(high_plan_legal)
         with open(self.high_plan_path, 'w', encoding='utf-8') as f:
             json.dump(high_plan_legal, f, ensure_ascii=False, indent=2)
+        self.artifacts.record("highplan", key, self.high_plan_path, deps=("pdf",))
         return high_plan_legal
     
+    @stage("high_plan")
     def high_plan_by_llm(self,eval_results, high_plan) -> str:
         if eval_results:
             prompt = high_plan + ' \n '+ prompts.high_level_replanning_prompt + eval_results
@@ -335,15 +541,25 @@ class Preacher:
             prompt = prompts.high_level_planning_prompt
             if self.with_example :
                 prompt += ' \n '+ merge_dict_keys_values(self.high_example) 
-        high_plan = eval(
-            self.planner(
-                prompt=prompt,
-                pdf_path=Path(self.pdf_path),
+        # a replan asks for a new answer, not the cached one
+        use_cache = not eval_results
+        high_plan = None
+        if self._structured(self.planner):
+            # made legal by `setting_plan_format` without another call
+            high_plan = self._ask_structured(self.planner, prompts.high_plan_schema,
+                                             prompt=prompt, pdf_path=Path(self.pdf_path), use_cache=use_cache)
+        if high_plan is None:
+            high_plan = eval(
+                self.planner(
+                    prompt=prompt,
+                    pdf_path=Path(self.pdf_path),
+                    use_cache=use_cache,
+                )
             )
-        )
         self.workflow_logger.info(f"High_plan: {high_plan}")
         return  high_plan
     
+    @stage("evaluate")
     def high_evaluate_by_llm(self, high_plan) -> str:
         prompt = prompts.high_level_evaluate_prompt + ' \n '+ high_plan
         eval_results = eval(
@@ -355,13 +571,44 @@ class Preacher:
         self.workflow_logger.info(f"Eval_Results: {eval_results}")
         return success, eval_results
     
-    def low_planning(self, part_plan):
-        plan_file = self.log_dir/f"file_{self.scene_idx}.json"
-        self.final_plan[self.scene_idx]['scenario'] = part_plan['SCENE']
-        self.final_plan[self.scene_idx]['time_cost'] = part_plan['TIME_ALLOCATION']
-        if os.path.exists(plan_file):
+    def low_planning_all(self) -> None:
+        """Plans every scene of the high level plan, `max_plan_workers` scenes at a time."""
+        if self.max_plan_workers == 1:
+            for i in range(len(self.high_plan_list)):
+                self.plan_scene(i)
+            return
+        with ThreadPoolExecutor(max_workers=self.max_plan_workers) as executor:
+            futures = [executor.submit(with_context(self.plan_scene), i)
+                       for i in range(len(self.high_plan_list))]
+            for future in futures:
+                future.result()
+
+    def plan_scene(self, scene_idx):
+        """Plans one scene, then starts synthesizing its narration if no later step rewrites it."""
+        self.low_planning(self.high_plan_list[scene_idx], scene_idx)
+        ctx = self._scene_context(scene_idx)
+        style = ctx.plan["style"].lower()
+        # professional scenes may rewrite their narration and talking heads need the audio URL, see `generate_`
+        if "general" in style or not any(s in style for s in ("prof", "scie", "math", "mol", "heads")):
+            self._schedule_audio(ctx)
+
+    def low_planning(self, part_plan, scene_idx):
+        plan_file = self.log_dir/f"file_{scene_idx}.json"
+        node = f"scene_{scene_idx}/plan"
+        inputs = {
+            "scene": part_plan,
+            "planner": self._llm_config(self.planner),
+            "evaluator": self._llm_config(self.evaluator),
+            "prompts": self._prompt_inputs(self.LOW_PLAN_PROMPTS),
+            "example": self.low_example if self.with_example else None,
+            "with_reflection": self.with_reflection,
+        }
+        key = self.artifacts.key(node, inputs, deps=("pdf",))
+        self.final_plan[scene_idx]['scenario'] = part_plan['SCENE']
+        self.final_plan[scene_idx]['time_cost'] = part_plan['TIME_ALLOCATION']
+        if self.artifacts.is_fresh(node, key):
             with open(plan_file, "r") as file:
-                self.final_plan[self.scene_idx] = json.load(file)
+                self.final_plan[scene_idx] = json.load(file)
                 return None
         elif self.with_reflection:
             iter=0
@@ -371,18 +618,20 @@ class Preacher:
             plan_idx=2
             while plan_idx < 6 and iter < self.max_low_plan_iteration:
                 low_plan = self.low_plan_by_llm(part_plan, eval_results, low_plan_legal)
-                low_plan_legal = self.setting_plan_format(low_plan)
-                plan_idx, eval_results = self.low_evaluate_by_llm(plan_idx, low_plan_legal)
+                low_plan_legal = self.setting_plan_format(low_plan, scene_idx=scene_idx)
+                plan_idx, eval_results = self.low_evaluate_by_llm(plan_idx, low_plan_legal, scene_idx)
                 iter += 1
         else:
-            low_plan = self.low_plan_by_llm()
-            low_plan_legal = self.setting_plan_format(low_plan)
-            self.final_plan[self.scene_idx] = extract_dict(low_plan_legal)
+            low_plan = self.low_plan_by_llm(part_plan, None, None)
+            low_plan_legal = self.setting_plan_format(low_plan, scene_idx=scene_idx)
+            self.final_plan[scene_idx] = extract_dict(low_plan_legal)
         
 
         with open(plan_file, "w") as file:
-            json.dump(self.final_plan[self.scene_idx], file)
+            json.dump(self.final_plan[scene_idx], file)
+        self.artifacts.record(node, key, plan_file, deps=("pdf",))
     
+    @stage("low_plan")
     def low_plan_by_llm(self, part_plan, eval_results, low_plan_legal) -> str:
         if eval_results:
             prompt = low_plan_legal + ' \n '+ prompts.low_level_replanning_prompt + eval_results
@@ -390,24 +639,32 @@ class Preacher:
             prompt = merge_dict_keys_values(prompts.low_level_planning_prompt) + merge_dict_keys_values(part_plan)
             if self.with_example :
                 prompt += 'Here are some examples, not the scene I want to ask you:'+ ' \n '+ merge_dict_keys_values(self.low_example) 
-        low_plan = eval(
-            self.planner(
-                prompt=prompt,
-                pdf_path=Path(self.pdf_path),
+        use_cache = not eval_results
+        low_plan = None
+        if self._structured(self.planner):
+            low_plan = self._ask_structured(self.planner, prompts.low_plan_schema,
+                                            prompt=prompt, pdf_path=Path(self.pdf_path), use_cache=use_cache)
+        if low_plan is None:
+            low_plan = eval(
+                self.planner(
+                    prompt=prompt,
+                    pdf_path=Path(self.pdf_path),
+                    use_cache=use_cache,
+                )
             )
-        )
         #self.workflow_logger.info(f"low_plan: {low_plan}")
         return  low_plan
     
-    def low_evaluate_by_llm(self, plan_idx, low_plan_legal):
+    @stage("evaluate")
+    def low_evaluate_by_llm(self, plan_idx, low_plan_legal, scene_idx):
         while plan_idx < 6:
             current_sec = self.low_plan_order[plan_idx-2]
             pattern = rf'"{current_sec}":\s*(?:"([^"]*)"|(\{{.*?\}})|(\[.*?\]))'
             match = re.search(pattern, low_plan_legal, re.DOTALL)
             if match:
-                self.final_plan[self.scene_idx][current_sec] = match.group(1) if match.group(1) else match.group(2) if match.group(2) else match.group(3)       
+                self.final_plan[scene_idx][current_sec] = match.group(1) if match.group(1) else match.group(2) if match.group(2) else match.group(3)       
 
-            prompt = prompts.low_level_evaluate_prompt +  prompts.low_level_evaluate_prompt_list[plan_idx-2] + str(self.final_plan[self.scene_idx])
+            prompt = prompts.low_level_evaluate_prompt +  prompts.low_level_evaluate_prompt_list[plan_idx-2] + str(self.final_plan[scene_idx])
             eval_results = eval(
                 self.evaluator(
                     prompt = prompt,
@@ -421,25 +678,167 @@ class Preacher:
                 plan_idx += 1
         return plan_idx, eval_results
     
+    def generate_all(self) -> list[Path]:
+        """Generates every scene, `max_generate_workers` scenes at a time, and returns the scene videos in order."""
+        if self.wanx_submit_all:
+            self.start_wanx_prefetch(range(len(self.high_plan_list)))
+        if self.max_generate_workers == 1:
+            for i in range(len(self.high_plan_list)):
+                self.generate_(i)
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_generate_workers) as executor:
+                futures = [executor.submit(with_context(self.generate_), i)
+                           for i in range(len(self.high_plan_list))]
+                for future in futures:
+                    future.result()
+        return self._scene_videos()
+
+    def plan_and_generate_all(self) -> list[Path]:
+        """Generates each scene as soon as its low-level plan is done, so planning of later scenes overlaps with generation of earlier ones. Returns the scene videos in order."""
+        with ThreadPoolExecutor(max_workers=self.max_plan_workers) as plan_executor, \
+                ThreadPoolExecutor(max_workers=self.max_generate_workers) as generate_executor:
+            plan_futures = {
+                plan_executor.submit(with_context(self.plan_scene), i): i
+                for i in range(len(self.high_plan_list))
+            }
+            generate_futures = []
+            for future in as_completed(plan_futures):
+                future.result()
+                scene_idx = plan_futures[future]
+                self.workflow_logger.info(f"Scene {scene_idx} is planned, start generating.")
+                if self.wanx_submit_all:
+                    self.start_wanx_prefetch([scene_idx])
+                generate_futures.append(generate_executor.submit(with_context(self.generate_), scene_idx))
+            for future in generate_futures:
+                future.result()
+        return self._scene_videos()
+
+    def _scene_videos(self) -> list[Path]:
+        return [self.work_dir / f"scene_{i}" / "scene{}.mp4".format(i)
+                for i in range(len(self.high_plan_list))]
+
+    def start_wanx_prefetch(self, scene_indices) -> None:
+        """Runs `prefetch_wanx` for the given scenes in the background. `generate_` waits for the prefetch of its own scene only."""
+        scene_indices = list(scene_indices)
+        ready = {scene_idx: Future() for scene_idx in scene_indices}
+        with self._prefetch_lock:
+            if self._prefetch_executor is None:
+                self._prefetch_executor = ThreadPoolExecutor(max_workers=self.tool_limiter.limits["wanx"],
+                                                             thread_name_prefix="wanx-prefetch")
+            self._wanx_prefetch.update(ready)
+            self._prefetch_executor.submit(with_context(self.prefetch_wanx), scene_indices, ready)
+
+    def _wait_wanx_prefetch(self, scene_idx) -> None:
+        with self._prefetch_lock:
+            ready = self._wanx_prefetch.pop(scene_idx, None)
+        if ready is not None:
+            ready.result()
+
+    def prefetch_wanx(self, scene_indices, ready: Optional[dict[int, Future]] = None) -> None:
+        """Submits the first Wanxiang candidate of the given general and captioning scenes at once and downloads each as it completes.
+
+        The scenes then find their first candidate (test0.mp4 or test0.png) in place when they are generated.
+        Candidates that fail here are generated again by the scenes themselves. The futures of `ready`, keyed by
+        scene index, are resolved as soon as the scene can be generated, i.e. its candidate is in place or failed.
+        """
+        ready = ready or {}
+
+        def release(scene_idx):
+            if scene_idx in ready and not ready[scene_idx].done():
+                ready[scene_idx].set_result(None)
+
+        try:
+            self._prefetch_wanx(scene_indices, release)
+        except Exception as e:
+            self.workflow_logger.warning(f"Prefetching Wanxiang candidates failed, the scenes generate their own: "
+                                         f"{type(e).__name__}: {e}")
+        finally:
+            for scene_idx in ready:
+                release(scene_idx)
+
+    def _prefetch_wanx(self, scene_indices, release: Callable[[int], None]) -> None:
+        scenes = []
+        for scene_idx in scene_indices:
+            ctx = self._scene_context(scene_idx)
+            kind = self._wanx_kind(ctx.plan)
+            if kind is None:
+                release(scene_idx)
+                continue
+            visual_node, visual_key = self._visual_key(ctx)
+            if self.artifacts.is_fresh(visual_node, visual_key):
+                release(scene_idx)
+                continue
+            self._clear_candidates(ctx, visual_node, visual_key)
+            candidate_path = ctx.scene_dir / ("test0.mp4" if kind == "video" else "test0.png")
+            if not candidate_path.exists():
+                scenes.append((ctx, kind, candidate_path))
+            else:
+                release(scene_idx)
+        if not scenes:
+            return
+
+        def rewrite(scene):
+            ctx, kind, _ = scene
+            if kind == "video":
+                self._rewrite_general_prompt(ctx.plan)
+            else:
+                self._rewrite_captioning_prompt(ctx.plan)
+
+        with ThreadPoolExecutor(max_workers=self.max_generate_workers) as executor:
+            list(executor.map(with_context(rewrite), scenes))
+        self.workflow_logger.info(f"Submitting {len(scenes)} Wanxiang tasks.")
+        jobs = {candidate_path: (kind, ctx.plan["prompt"]) for ctx, kind, candidate_path in scenes}
+        scene_of = {candidate_path: ctx.idx for ctx, _, candidate_path in scenes}
+
+        def on_result(candidate_path, url):
+            try:
+                if url is not None:
+                    download_file(url, candidate_path)
+            finally:
+                release(scene_of[candidate_path])
+
+        self.wanx_async.run(jobs, on_result=on_result)
+
+    def _wanx_kind(self, plan) -> Optional[str]:
+        """Whether the scene of `plan` is generated by Wanxiang as a "video" or an "image", following the dispatch of `generate_`."""
+        from tools import Wanxiang_image, Wanxiang_video
+        style = plan["style"].lower()
+        if "general" in style:
+            return "video" if isinstance(self.general_video_tool, Wanxiang_video) else None
+        if "prof" in style or "scie" in style or "math" in style or "mol" in style:
+            return None
+        if "cap" in style:
+            return "image" if isinstance(self.captioning_tool, Wanxiang_image) else None
+        return None
+
+    def _scene_context(self, scene_idx) -> SceneContext:
+        ctx = SceneContext(scene_idx, self.work_dir / "scene_{}".format(scene_idx), self.final_plan[scene_idx])
+        if not os.path.isdir(ctx.scene_dir):
+            ctx.scene_dir.mkdir()
+        return ctx
+
     def generate_(self, scene_idx):
-        self.curr_scene_dir = self.work_dir / "scene_{}".format(scene_idx)
-        if not os.path.isdir(self.curr_scene_dir):
-            self.curr_scene_dir.mkdir()
-        style = self.final_plan[scene_idx]["style"].lower()
+        # the prefetch rewrites the prompt of the scene and renders its first candidate
+        self._wait_wanx_prefetch(scene_idx)
+        ctx = self._scene_context(scene_idx)
+        style = ctx.plan["style"].lower()
         if "general" in style.lower() :
-            video_path=self.general_work(scene_idx)
+            video_path=self.general_work(ctx)
         elif "prof" in style.lower() or "scie" in style.lower() or "math" in style.lower() or "mol" in style.lower():
-            video_path=self.professional_work(scene_idx)
+            video_path=self.professional_work(ctx)
         elif "cap" in style.lower():
-            video_path=self.captioning_work(scene_idx)
+            video_path=self.captioning_work(ctx)
         elif "slides" in style.lower():
-            video_path=self.slides_work(scene_idx)
+            video_path=self.slides_work(ctx)
         elif "heads" in style.lower() :
-            video_path=self.talking_head_work(scene_idx)
+            video_path=self.talking_head_work(ctx)
         else: print("error: Please check the style file")
         return video_path
 
-    def math_single_work(self, plan, eval_results=None, code_str=None):
+    @stage("art")
+    def math_single_work(self, ctx, eval_results=None, code_str=None):
+        from utils.math_vis import render_video
+        plan = ctx.plan
         eval_prompt = "Please check if the above code follows the rules mentioned. If not, modify it: "+\
             "The first line should be 'def animate(self):\n'; the last line should be in the format 'self.wait(X)', where X is a positive integer;"+\
                 " does the code have a strong mathematical nature? Does it align with theme {}? Directly output the modified code (Code should be easy). Error message:".format(plan["prompt"])
@@ -457,102 +856,96 @@ class Preacher:
                 self.art_agent(
                     prompt=prompt_r+"\n" + plan["prompt"],
                 ))
-            code_str = eval(
-                self.art_agent(
-                    prompt=prompt+self.manim_example,
-                    pdf_path=Path(self.pdf_path),
-                    ))
+            code_str = self._animate_code(self.art_agent, prompt+self.manim_example, Path(self.pdf_path))
         else:
-            code_str = eval(
-                self.art_agent(
-                    prompt=  eval_results+ "\n"+code_str,
-                    pdf_path=Path(self.pdf_path),
-                    ))
-        code_str = eval(
-                self.art_agent(
-                    prompt=prompts.pro_format_prompt+"\n" + code_str,
-                    ))
+            code_str = self._animate_code(self.art_agent, eval_results+ "\n"+code_str, Path(self.pdf_path),
+                                          use_cache=False)
         code_str = extract_code(code_str)
         video_path = None
         while video_path == None:
             try:
-                replace_animate(self.animate_path, code_str)
-                video_path = render_video(self.curr_scene_dir,plan)
+                with self.tool_limiter("manim"):
+                    replace_animate(self.animate_path, code_str)
+                    video_path = render_video(ctx.scene_dir,plan)
             except Exception as e:
-                code_str = eval(
-                self.evaluator(
-                    prompt= code_str+ "\n"+ eval_prompt,
-                ))
-                code_str = eval(
-                    self.evaluator(
-                prompt=prompts.pro_format_prompt+"\n" + code_str,
-                ))
+                code_str = self._animate_code(self.evaluator, code_str+ "\n"+ eval_prompt, use_cache=False)
                 code_str = extract_code(code_str)
         return code_str, video_path
     
-    def professional_work(self, scene_idx):
+    @stage("art")
+    def professional_work(self, ctx):
         video_success = False
         iter=0
-        plan = self.final_plan[scene_idx]
+        plan = ctx.plan
         code_str = None
         eval_results = None
         
-        self.curr_video_path = self.curr_scene_dir/"video.mp4"
-        
-        style_ = eval(
-            self.evaluator(prompt=prompts.pro_classify_prompt+plan["prompt"],))
-        if "math" in style_.lower():
-            if os.path.exists(self.curr_video_path):
-                  pass
-            else:
+        visual_node, visual_key = self._visual_key(ctx)
+        if self.artifacts.is_fresh(visual_node, visual_key):
+            # restores the narration rewritten for molecular scenes
+            ctx.plan.update(self.artifacts.meta(visual_node))
+        else:
+            self._clear_candidates(ctx, visual_node, visual_key)
+            style_ = eval(
+                self.evaluator(prompt=prompts.pro_classify_prompt+plan["prompt"],))
+            if "math" in style_.lower():
+                self._schedule_audio(ctx)
                 while video_success == False and iter < self.max_generate_iteration:
-                    code_str, video_path = self.math_single_work(plan,eval_results,code_str)
-                    video_success, eval_results = self.video_evaluate_by_mllm(plan, video_path, type='video')
+                    code_str, video_path = self.math_single_work(ctx,eval_results,code_str)
+                    video_success, eval_results = self.video_evaluate_by_mllm(ctx, video_path, type='video')
                     iter += 1
-                video = VideoFileClip(video_path)
-                video.write_videofile(self.curr_video_path)
-        elif "mol" in style_.lower():
-            if os.path.exists(self.curr_video_path):
-                pass
-            else:
-                
+                from moviepy.editor import VideoFileClip
+                with self.tool_limiter("ffmpeg"):
+                    video = VideoFileClip(video_path)
+                    video.write_videofile(ctx.video_path)
+            elif "mol" in style_.lower():
                 prompt_mol = f"Please return the most related name  'X' of the protein in {plan["source"]} and {plan["prompt"]}. Keep it concise and breif."+" Return the name ONLY"
                 
                 pdb_name = eval(
                     self.evaluator(
                     prompt=prompt_mol,))
                 audio_mol = f'Optimize the {plan["audio_content"]} to transform it into an introduction related to molecular biology, mentioning the protein {pdb_name}, without exceeding 50 words. Return the UPDATED prompt ONLY'
-                self.final_plan[scene_idx]["audio_content"] = eval(
+                ctx.plan["audio_content"] = eval(
                     self.evaluator(
                     prompt=audio_mol,))
+                self._schedule_audio(ctx)
                 #pdb_name = _load_json_dict(pdb_name)['name']
                 ids = name_to_pdb_ids(pdb_name)
                 if not ids:
                     print("[MANUAL] no PDB ID, please check:", pdb_name)
                     return
                 pdb_id=ids[0]
-                pdb_path = os.path.join(self.curr_scene_dir, f"{pdb_id.lower()}.pdb")
+                pdb_path = os.path.join(ctx.scene_dir, f"{pdb_id.lower()}.pdb")
                 if not os.path.exists(pdb_path):
                     download_pdb(pdb_id, pdb_path)
                 if pdb_path:
                     print(f"[DONE] {pdb_id} is saved at  {pdb_path}")
-                    generate_mol_animation(pdb_path, self.curr_video_path)
+                    from utils.mol import generate_mol_animation
+                    with self.tool_limiter("pymol"):
+                        generate_mol_animation(pdb_path, ctx.video_path)
                 else:
                     url = f"https://files.rcsb.org/download/{pdb_id.upper()}.pdb"
                     print(f"[MANUAL] please download and generate by yourself:{url}")
                     
-                #video = VideoFileClip(self.curr_video_path)
-                #video.write_videofile(self.curr_video_path)
-        self.curr_audio_path = self._ensure_audio(self.final_plan[scene_idx]["audio_content"])
-        self.final_video_path = self.curr_scene_dir/"scene{}.mp4".format(scene_idx)
+                #video = VideoFileClip(ctx.video_path)
+                #video.write_videofile(ctx.video_path)
+            self._record_visual(ctx, visual_node, visual_key, ctx.video_path)
+        ctx.audio_path = self._ensure_audio(ctx)
         if "time_cost" in plan:
             time = plan["time_cost"]
         else:
             time = '8'
-        merge_video_audio(self.curr_video_path, self.curr_audio_path, time,self.final_video_path)
-        return self.final_video_path
+        self._compose_scene(ctx, ctx.video_path, time)
+        return ctx.final_video_path
 
     def general_single_work(self, plan, eval_results=None):
+        self._rewrite_general_prompt(plan, eval_results)
+        with self.tool_limiter("wanx"):
+            video_url = self.general_video_tool.query(plan["prompt"])
+        return video_url
+
+    @stage("art")
+    def _rewrite_general_prompt(self, plan, eval_results=None):
         if eval_results==None:
             prompt_r = " Please use {} as the materials to depict a video scene that a diffusion model can understand and generate.".format( plan["prompt"])
             plan["prompt"] = eval(
@@ -563,37 +956,104 @@ class Preacher:
             plan["prompt"] = eval(
             self.art_agent(
                     prompt=eval_results + "\n" + plan["prompt"],
+                    use_cache=False,
             ))
-        video_url = self.general_video_tool.query(plan["prompt"])
-        return video_url
     
-    def general_work(self, scene_idx):
+    def general_work(self, ctx):
+        from tools import Wanxiang_video
         video_success = False
         iter=0
-        plan = self.final_plan[scene_idx]
+        plan = ctx.plan
         eval_results = None
-        self.final_video_path = self.curr_scene_dir/"scene{}.mp4".format(scene_idx)
-        self.curr_video_path = self.curr_scene_dir/"video.mp4".format(scene_idx)
-        self.curr_audio_path = self._ensure_audio(plan["audio_content"])
-        if os.path.exists(self.curr_video_path):
-            video_path=self.curr_video_path
-            pass
+        ctx.audio_path = self._ensure_audio(ctx)
+        visual_node, visual_key = self._visual_key(ctx)
+        if self.artifacts.is_fresh(visual_node, visual_key):
+            video_path = self.artifacts.path(visual_node)
         else:
+            self._clear_candidates(ctx, visual_node, visual_key)
+            if self.speculative_candidates > 1 and isinstance(self.general_video_tool, Wanxiang_video):
+                video_path = self.general_speculative_work(ctx)
+                if video_path is not None:
+                    iter = self.max_generate_iteration
+                else:
+                    self.workflow_logger.warning(f"No Wanxiang candidate of scene {ctx.idx} landed, "
+                                                 "generating them one at a time.")
             while video_success == False and iter < self.max_generate_iteration:
-                video_path = self.curr_scene_dir/"test{}.mp4".format(iter)
+                video_path = ctx.scene_dir/"test{}.mp4".format(iter)
                 if not os.path.exists(video_path):
                     video_url = self.general_single_work(plan, eval_results)
+                    if video_url is None:
+                        raise RuntimeError(f"Wanxiang returned no video for scene {ctx.idx}.")
                     video_path = download_file(video_url, video_path)
-                video_success, eval_results = self.video_evaluate_by_mllm(plan, video_path, type='video')
+                video_success, eval_results = self.video_evaluate_by_mllm(ctx, video_path, type='video')
                 iter += 1
+            self._record_visual(ctx, visual_node, visual_key, video_path)
         if "time_cost" in plan:
             time = plan["time_cost"]
         else:
             time = '8'
-        merge_video_audio(video_path, self.curr_audio_path, time, self.final_video_path)
-        return self.final_video_path
+        self._compose_scene(ctx, video_path, time)
+        return ctx.final_video_path
     
+    def general_speculative_work(self, ctx) -> Path:
+        """Renders `speculative_candidates` prompt variants of a general scene per try and returns the first candidate that passes evaluation.
+
+        Candidates are evaluated as they land; the tasks still pending once one passes are cancelled.
+        At most `max_generate_iteration` candidates are rendered. If none passes, the last one evaluated is returned,
+        or None if no candidate landed, e.g. when every task failed or timed out.
+        """
+        plan = ctx.plan
+        eval_results = None
+        video_path = None
+        n_candidates = 0
+        while n_candidates < self.max_generate_iteration:
+            k = min(self.speculative_candidates, self.max_generate_iteration - n_candidates)
+            variants = {ctx.scene_dir / "test{}.mp4".format(n_candidates + j): dict(plan) for j in range(k)}
+            n_candidates += k
+            feedback = {}
+
+            def accept(path, video_url=None):
+                if video_url is not None:
+                    download_file(video_url, path)
+                if not os.path.exists(path):
+                    return False
+                variant_ctx = SceneContext(ctx.idx, ctx.scene_dir, variants[path])
+                success, feedback[path] = self.video_evaluate_by_mllm(variant_ctx, path, type='video')
+                return success
+
+            # candidates left by an interrupted run or by `prefetch_wanx` are evaluated before rendering new ones
+            accepted = next((path for path in variants if os.path.exists(path) and accept(path)), None)
+            if accepted is None:
+                missing = [path for path in variants if not os.path.exists(path)]
+
+                def rewrite(j_path):
+                    j, path = j_path
+                    if j > 0:
+                        variants[path]["prompt"] += " (variant {} of {}: choose a different composition from the other variants)".format(j + 1, len(missing))
+                    self._rewrite_general_prompt(variants[path], eval_results)
+
+                with ThreadPoolExecutor(max_workers=len(missing) or 1) as executor:
+                    list(executor.map(with_context(rewrite), enumerate(missing)))
+                jobs = {path: ("video", variants[path]["prompt"]) for path in missing}
+                accepted = self.wanx_async.first_accepted(jobs, accept) if jobs else None
+            if accepted is not None:
+                plan["prompt"] = variants[accepted]["prompt"]
+                return accepted
+            if feedback:
+                # the next variants are rewritten from the feedback on the last candidate evaluated
+                video_path = list(feedback)[-1]
+                eval_results = feedback[video_path]
+                plan["prompt"] = variants[video_path]["prompt"]
+        return video_path
+
     def captioning_single_work(self, plan, eval_results=None):
+        self._rewrite_captioning_prompt(plan, eval_results)
+        with self.tool_limiter("wanx"):
+            image_url= self.captioning_tool.query(plan["prompt"])
+        return image_url
+
+    @stage("art")
+    def _rewrite_captioning_prompt(self, plan, eval_results=None):
         if eval_results==None:
             prompt_r = " Please use {} and {} as the materials to depict a image scene that a diffusion model can understand and generate. Return the prompt ONLY".format(plan["scenario"], plan["prompt"])
             plan["prompt"] = eval(
@@ -604,110 +1064,112 @@ class Preacher:
             plan["prompt"] = eval(
             self.art_agent(
                     prompt=eval_results + "\n" + "\n" +"Please provide new prompt to depict a image scene. Be relative to" +  plan["prompt"]+ "Return the prompt ONLY.",
+                    use_cache=False,
             ))
-        image_url= self.captioning_tool.query(plan["prompt"])
-        return image_url
     
-    def captioning_work(self, scene_idx):
+    def captioning_work(self, ctx):
         video_success = False
         iter=0
-        plan = self.final_plan[scene_idx]
+        plan = ctx.plan
         eval_results = None
         
-        self.curr_image_path = self.curr_scene_dir/"image.png"
-        self.curr_audio_path = self._ensure_audio(plan["audio_content"])
-        if os.path.exists(self.curr_image_path):
-            pass
-        else:
+        ctx.audio_path = self._ensure_audio(ctx)
+        visual_node, visual_key = self._visual_key(ctx)
+        if not self.artifacts.is_fresh(visual_node, visual_key):
+            self._clear_candidates(ctx, visual_node, visual_key)
             while video_success == False and iter < self.max_generate_iteration:
-                image_path = self.curr_scene_dir/"test{}.png".format(iter)
+                image_path = ctx.scene_dir/"test{}.png".format(iter)
                 if not os.path.exists(image_path):
                     image_url = self.captioning_single_work(plan, eval_results)
                     image_path = download_file(image_url, image_path)
-                video_success, eval_results = self.video_evaluate_by_mllm(plan, [image_path], type='image')
+                video_success, eval_results = self.video_evaluate_by_mllm(ctx, [image_path], type='image')
                 iter += 1
             with Image.open(image_path) as img:
-                img.save(self.curr_image_path)
+                img.save(ctx.image_path)
+            self._record_visual(ctx, visual_node, visual_key, ctx.image_path)
         
-        self.final_video_path = self.curr_scene_dir/"scene{}.mp4".format(scene_idx)
         if "time_cost" in plan:
             time = plan["time_cost"]
         else:
             time = '8'
-        image_to_video(image_path, self.curr_audio_path, time, self.final_video_path)
-        return self.final_video_path
+        self._compose_scene(ctx, ctx.image_path, time, from_image=True)
+        return ctx.final_video_path
 
     def talking_head_single_work(self, audio_url, final_video_path):
-        video_url = self.talking_head_tool.generate_and_download(audio_url, final_video_path)
+        with self.tool_limiter("tavus"):
+            video_url = self.talking_head_tool.generate_and_download(audio_url, final_video_path)
         return video_url
     
-    def talking_head_work(self, scene_idx):
-        plan = self.final_plan[scene_idx]
-        self.final_video_path = self.curr_scene_dir/"scene{}.mp4".format(scene_idx)
-        audio_url = self._ensure_audio(plan["audio_content"], return_url=True)
-        if os.path.exists(self.final_video_path):
-            pass
-        else:
-            video_url = self.talking_head_single_work(audio_url, self.final_video_path)
-            self.final_video_path = download_file(video_url, self.curr_scene_dir/"scene{}.mp4".format(scene_idx))
-        return self.final_video_path
+    def talking_head_work(self, ctx):
+        node = ctx.node("video")
+        deps = (ctx.node("plan"),)
+        key = self.artifacts.key(node, {"tool": type(self.talking_head_tool).__name__}, deps=deps)
+        if not self.artifacts.is_fresh(node, key):
+            audio_url = self._ensure_audio(ctx, return_url=True)
+            video_url = self.talking_head_single_work(audio_url, ctx.final_video_path)
+            ctx.final_video_path = download_file(video_url, ctx.final_video_path)
+            self.artifacts.record(node, key, ctx.final_video_path, deps=deps)
+        return ctx.final_video_path
     
-    def slides_single_work(self, scene_idx, plan, image_path, eval_results=None):
+    @stage("art")
+    def slides_single_work(self, ctx, image_path, eval_results=None):
+        from utils.slides import get_specific_element
+        plan = ctx.plan
         if eval_results==None and (os.path.exists(image_path) is False):
             prompt_r = (
                 f"Please return the type and index of the {plan['source']} in the PDF "
                 "with the dict: {'type': TABLE/IMAGE, 'number': INT}"
                 "where a is TABLE or IMAGE, and b is its index."
             )
-            crop_dict = eval(
-            self.planner(
-                prompt=prompt_r,
-                pdf_path=Path(self.pdf_path),
-            ))
+            crop_dict = self._ask_json(self.planner, prompt=prompt_r, pdf_path=Path(self.pdf_path))
             result = _load_json_dict(crop_dict)
             image_path = get_specific_element(self.pdf_path, result['type'], result['number'], image_path)
             
         else:
+            use_cache = not eval_results
             if not eval_results:
                 eval_results = ''
-            self.final_plan[scene_idx]["prompt"] = eval(
+            ctx.plan["prompt"] = eval(
             self.planner(
                 prompt= 'With this reason'+ eval_results+"Provide a better prompt"+eval_results+"\n Old prompt is"+plan['prompt'] +"\n RETURN new prompt ***ONLY***",
                 pdf_path=Path(self.pdf_path),
+                use_cache=use_cache,
             ))
 
         return image_path
         
-    def slides_work(self, scene_idx):
+    def slides_work(self, ctx):
+        from utils.slides import create_ppt_style_image
         video_success = False
         iter=0
-        image_path =  self.curr_scene_dir/"image{}.png".format(iter)
-        plan = self.final_plan[scene_idx]
+        image_path =  ctx.scene_dir/"image{}.png".format(iter)
+        plan = ctx.plan
         eval_results = None
-        self.final_video_path = self.curr_scene_dir/"scene{}.mp4".format(scene_idx)
-        self.curr_image_path = self.curr_scene_dir/"image.png"
-        self.curr_audio_path = self._ensure_audio(plan["audio_content"])
-        if os.path.exists(self.curr_image_path):
-            image_path = self.curr_image_path
-            pass
-        else:
+        ctx.audio_path = self._ensure_audio(ctx)
+        visual_node, visual_key = self._visual_key(ctx)
+        if not self.artifacts.is_fresh(visual_node, visual_key):
+            self._clear_candidates(ctx, visual_node, visual_key)
             while video_success == False and iter < self.max_generate_iteration:
-                image_path = self.curr_scene_dir/"image{}.png".format(0)
-                self.slides_single_work(scene_idx, plan, image_path, eval_results)
-                video_success, eval_results = self.video_evaluate_by_mllm(plan, [image_path], type='image') 
+                image_path = ctx.scene_dir/"image{}.png".format(0)
+                self.slides_single_work(ctx, image_path, eval_results)
+                video_success, eval_results = self.video_evaluate_by_mllm(ctx, [image_path], type='image') 
                 iter += 1
-            #with Image.open(self.curr_image_path) as img:
-                #img.save(self.curr_image_path)
-            self.curr_image_path = create_ppt_style_image(image_path, plan['prompt'], self.curr_image_path)
+            #with Image.open(ctx.image_path) as img:
+                #img.save(ctx.image_path)
+            ctx.image_path = create_ppt_style_image(image_path, plan['prompt'], ctx.image_path)
+            self._record_visual(ctx, visual_node, visual_key, ctx.image_path)
         
         if "time_cost" in plan:
             time = plan["time_cost"]
         else:
             time = '8'
-        image_to_video(self.curr_image_path, self.curr_audio_path, time, self.final_video_path)
-        return self.final_video_path
+        self._compose_scene(ctx, ctx.image_path, time, from_image=True)
+        return ctx.final_video_path
         
-    def video_evaluate_by_mllm(self, plan, video_path, type='video'):
+    @stage("evaluate")
+    def video_evaluate_by_mllm(self, ctx, video_path, type='video'):
+        from utils.videowork import extract_key_frames, image_to_images
+        plan = ctx.plan
         if type=='video':
             img_list = extract_key_frames(video_path)
         elif type=='image':
@@ -731,22 +1193,50 @@ class Preacher:
         success = classify_response(eval_results)
         return success, eval_results
     
-    def setting_plan_format(self, plan, step="low"):
-        if step == "high":
-            prompt = prompts.high_plan_format_prompt + ' \n '+ plan  
-        else:
-            prompt = plan + ' \n '+ prompts.low_plan_format_prompt
-        plan_legal = eval(
-            self.planner(
-                prompt=prompt,
-                pdf_path=Path(self.pdf_path),
-            )
-        )
+    @stage("format")
+    def setting_plan_format(self, plan, step="low", scene_idx=None):
+        plan_legal = self._structured_plan_legal(plan, step) if self._structured(self.planner) else None
+        if plan_legal is None:
+            if step == "high":
+                prompt = prompts.high_plan_format_prompt + ' \n '+ plan  
+            else:
+                prompt = plan + ' \n '+ prompts.low_plan_format_prompt
+            plan_legal = self._ask_json(self.planner, prompt=prompt, pdf_path=Path(self.pdf_path))
         #self.workflow_logger.info(f"low_plan_legal: {low_plan_legal}")
         if _load_json_dict(plan_legal) and step=='low':
-            self.final_plan[self.scene_idx] = _load_json_dict(plan_legal)
+            self.final_plan[scene_idx] = _load_json_dict(plan_legal)
         return  plan_legal
 
+    def _structured_plan_legal(self, plan, step) -> Optional[str]:
+        """Formats a plan answered with the schema of its step like the format prompts ask,
+        or returns None if it does not match the schema."""
+        schema = prompts.high_plan_schema if step == "high" else prompts.low_plan_schema
+        value, errors = conform(plan, schema)
+        if errors:
+            return None
+        if step == "high":
+            # the LIST of `high_plan_format_prompt`, read by `extract_list_from_text`
+            value = [{f"SCENE{i+1}": scene["SCENE"],
+                      "DESCRIPTION": scene["DESCRIPTION"],
+                      "TIME_ALLOCATION": scene["TIME_ALLOCATION"]}
+                     for i, scene in enumerate(value["scenes"])]
+        return json.dumps(value, ensure_ascii=False)
+
+    def _animate_code(self, llm, prompt, pdf_path=None, use_cache=True) -> str:
+        """Asks `llm` for the animation function, in one call with structured output,
+        else followed by a `pro_format_prompt` call to fix its format. Repairs pass `use_cache=False`
+        to get a new answer each time."""
+        kwargs = {"pdf_path": pdf_path} if pdf_path is not None else {}
+        if self._structured(llm):
+            code = self._ask_structured(llm, prompts.animate_code_schema, prompt=prompt, use_cache=use_cache, **kwargs)
+            if code is not None:
+                return json.loads(code)["code"]
+        code_str = eval(llm(prompt=prompt, use_cache=use_cache, **kwargs))
+        return eval(
+            llm(
+                prompt=prompts.pro_format_prompt+"\n" + code_str,
+            ))
+
     def _prepare_dir(self, input_path, output_dir) -> None:
 
         pdf_name = input_path.stem
@@ -762,6 +1252,8 @@ class Preacher:
         self.workflow_path = self.log_dir / "workflow.log"
         self.high_plan_path = self.log_dir / "highplan.txt"
         self.final_video_path_= self.log_dir / "final_video.mp4"
+        self.artifacts_path = self.log_dir / "artifacts.json"
+        self.metrics_path = self.log_dir / "metrics.json"
         self.animate_path =  Path("utils/math_vis.py").resolve()
         #self.plan_path = self.log_dir
 
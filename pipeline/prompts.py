@@ -10,6 +10,29 @@ high_level_replanning_prompt = "The above are the scenes you previously designed
 
 high_plan_format_prompt = " The next paragraph of TEXT will provide descriptions for multiple scenes. I need you to fill the \"***\" section of the dict LIST with the TEXT. Please output the LIST only. LIST:[{ \"SCENE1\": \"******\", \"DESCRIPTION\": \"******\", \"TIME_ALLOCATION\": \"******\"},{ \"SCENE2\": \"******\", \"DESCRIPTION\": \"******\", \"TIME_ALLOCATION\": \"******\"}...] TEXT:"
 
+# output schemas of the backends with structured output, which then skip the *_format_prompt round trips
+high_plan_schema = {
+    "title": "high_plan",
+    "type": "object",
+    "properties": {
+        "scenes": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "SCENE": {"type": "string", "description": "Short title of the scene."},
+                    "DESCRIPTION": {"type": "string", "description": "What the scene presents, without double quotes."},
+                    "TIME_ALLOCATION": {"type": "string", "description": "Duration of the scene, e.g. \"30 seconds\"."},
+                },
+                "required": ["SCENE", "DESCRIPTION", "TIME_ALLOCATION"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["scenes"],
+    "additionalProperties": False,
+}
+
 low_level_planning_prompt = {
   "task": "Your task is to select an appropriate presentation style for the scenario (strictly choosing one style from Slides, Professional, Talking Heads, Captioning, or General Video styles) of the scene I give you at last.",
   "considerations": "Please consider the dynamics, themes, and content of the original text comprehensively.",
@@ -119,6 +142,19 @@ low_level_replanning_prompt = "The above is the scene style selection plan you d
 
 low_plan_format_prompt="Fill in the dictionary (***** means blank ) with the given above text. For \"style,\" the blank can only be filled with one of the following options: (Slides, Professional, Talking Heads, Captioning, or General Video). If there is no suitable match, write \"PASS\":{ \"audio_content\": \"******\", \"style\": \"******\", \"source\": \"******\", \" prompt\": \"******\"} Only output this dictionary, no extra content is needed! For example: { \"audio_content\": \"This is the picture from the original paper, which means a lot.\",\"style\": \"Slides\",\"source\": \"Fig.1\",\"prompt\": \"Previous palaeomagnetic investigations using samples from Apollo and Chang'e-5 missions have revealed the Moon's magnetic history. However, these studies were limited to the nearside, leaving the farside largely unexplored.\". \n Make sure that the content replacing \"******\" are strings and does not contain double quotes inside.}"
 
+low_plan_schema = {
+    "title": "low_plan",
+    "type": "object",
+    "properties": {
+        "audio_content": {"type": "string", "description": "Narration of the scene, without double quotes."},
+        "style": {"type": "string", "enum": ["Slides", "Professional", "Talking Heads", "Captioning", "General Video", "PASS"]},
+        "source": {"type": "string", "description": "Figure or table of the paper used by the scene, e.g. \"Fig.1\"."},
+        "prompt": {"type": "string", "description": "Text the visual content is made from, without double quotes."},
+    },
+    "required": ["audio_content", "style", "source", "prompt"],
+    "additionalProperties": False,
+}
+
 low_level_evaluate_prompt_list = ["\n Is the video style exactly one of those choices: [Slides, Professional, Talking Heads, Captioning, or General Video] ? \n Do you think the choice of this style is reasonable?", "\n Does the \" audio_ content\" part appear to meet the required time_cost? Avoid overly lengthy text. The time_cost is fixed and cannot be changed. \n Do you think the audio_content is reasonable?","  Only If the video \" style \" is \" slides \", answer: Does the \" source \" part explicitly provide a specific source element (exact table/picture/equation)in the original paper? \n Is the professionalism of the current plan acceptable? \n Only if the video \"style \"  is \" professional \", does the original plan provide a clear mathematical expression or molecular formula so that I can know the content without reading original paper? \n","The \"prompt\" part should be a description of the scenes for the video to be generated. Does the existing \"prompt\" work as a prompt for a generation model (if the style is a General video, Captioning) or as a note to show (if the style is Slides or Professional)?\n"] 
 
 load_table_prompt="Can you return the content of the specific table of the original paper in table fomular? No extra TEXT in output."
@@ -127,6 +163,16 @@ pro_classify_prompt = "Is this scene related to mathematical content? If yes, ou
 
 pro_format_prompt = "The code I require does not need to be complete; it only needs to exist as an animation function. Please check if the following code meets my requirements: It should not contain any import statements. It should be simple and within 100 lines! It should start with 'def animate(self):\n    '. It should end with 'self.wait(X)' (where X is a number). Conforms to indentation rules! If it does not meet the requirements, rewrite it in the format I requested. Output the code Only!"
 
+animate_code_schema = {
+    "title": "animate_code",
+    "type": "object",
+    "properties": {
+        "code": {"type": "string", "description": "The animation function only, without imports, starting with 'def animate(self):' and ending with 'self.wait(X)'."},
+    },
+    "required": ["code"],
+    "additionalProperties": False,
+}
+
 pro_gen_prompt = "Why can't the following code run? Please modify the code and make it generate the correct video. Your result must be understandable by the Python compiler! Conforms to indentation rules. Make it SIMPLE and meaningful! Make sure the code Only output the code!"
 
 pro_vis_eval = "This is the video we created to introduce the above content, and I would like you to answer the following questions with (\"YES\" or \"NO\") to determine if the current video meets the requirements while maintaining structural integrity. If the answer is \"NO,\" please provide a reason:Is there visual content (animation) in the bottom left corner of the video? Is the animation in the video reasonable and mathematically strong? Do the visual content and text avoid meanlingless overlap in the video?"
@@ -0,0 +1,24 @@
+from pathlib import Path
+
+
+class SceneContext:
+    """State of one scene while it is generated, passed explicitly through the generation methods of Preacher.
+
+    Args:
+        idx (int): Index of the scene in the high level plan.
+        scene_dir (Path): Directory holding the artifacts of the scene.
+        plan (dict): Low level plan of the scene. Generation may refine its "prompt" and "audio_content".
+    """
+
+    def __init__(self, idx: int, scene_dir: Path, plan: dict) -> None:
+        self.idx = idx
+        self.scene_dir = scene_dir
+        self.plan = plan
+        self.video_path: Path = scene_dir / "video.mp4"
+        self.image_path: Path = scene_dir / "image.png"
+        self.audio_path: Path = scene_dir / "audio.wav"
+        self.final_video_path: Path = scene_dir / "scene{}.mp4".format(idx)
+
+    def node(self, kind: str) -> str:
+        """Name of the artifact node of this scene, e.g. "scene_0/audio"."""
+        return f"scene_{self.idx}/{kind}"
@@ -0,0 +1,24 @@
+from pathlib import Path
+import argparse
+from pipeline.batch import BatchRunner
+
+parser = argparse.ArgumentParser(description="Turn a batch of papers into videos.")
+parser.add_argument("input", type=Path, help="directory of PDFs or JSONL manifest with one {\"pdf\": ...} per line")
+parser.add_argument("--output_dir", type=Path, default=Path("output"))
+parser.add_argument("--config", type=Path, default=Path("config.yml"))
+parser.add_argument("--workers", type=int, default=2, help="number of papers processed concurrently")
+args = parser.parse_args()
+
+runner = BatchRunner(
+    input_path=args.input.resolve(), output_dir=args.output_dir.resolve(), llm_config_path=args.config.resolve(),
+    plan_by="GEMINI",
+    eval_by="GEMINI",
+    art_work="GEMINI",
+    max_workers=args.workers,
+    with_example=True,
+    with_reflection=True,
+    with_rollback=True,
+    silent=False,
+    )
+
+runner.run()
@@ -1,5 +1,4 @@
 from pathlib import Path
-import torch
 from pipeline.preacher import Preacher
 #from utils.custom_types import *
 #from utils.textwork import read_log_file
@@ -0,0 +1,47 @@
+import sys
+from pathlib import Path
+
+import pytest
+import yaml
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+torch = pytest.importorskip("torch")
+qwen = pytest.importorskip("llms.qwen")
+Image = pytest.importorskip("PIL.Image")
+
+
+@pytest.fixture(scope="module")
+def shared_model():
+    with open(ROOT / "config.yml", "r", encoding="utf-8") as f:
+        cfg = yaml.safe_load(f)["QWEN"]
+    if not cfg.get("local_dir") or not Path(cfg["local_dir"]).is_dir():
+        pytest.skip("QWEN local_dir of config.yml is not a downloaded model")
+    device = cfg.get("DEVICE", "cuda")
+    if device == "auto":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = qwen._load_model(cfg["local_dir"], device, max_new_tokens=32)
+    # greedy decoding, so that both answers are deterministic
+    model.model.generation_config.do_sample = False
+    return model
+
+
+def _image_prompt(model):
+    messages = [{"role": "user", "content": [{"type": "image", "image": Image.new("RGB", (224, 448), "red")},
+                                             {"type": "text", "text": "What color is this image?"}]}]
+    text = model.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    images, videos = qwen.process_vision_info(messages)
+    return text, images, videos
+
+
+def test_prefix_cached_answer_matches_uncached_answer(shared_model):
+    prefix = "The Eiffel Tower is in Paris. The Colosseum is in Rome. Big Ben is in London.\n\n"
+    text = "Question: In which city is the Colosseum? Answer:"
+    expected = shared_model.generate(prefix + text)[0]
+
+    # first call computes the cache of the prefix, the second one reuses it
+    assert shared_model.generate_with_prefix(prefix, text)[0] == expected
+    # an image batch in between leaves rope deltas of its own in the model
+    shared_model.generate(*_image_prompt(shared_model))
+    assert shared_model.generate_with_prefix(prefix, text)[0] == expected
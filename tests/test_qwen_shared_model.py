@@ -0,0 +1,169 @@
+import importlib.util
+import sys
+import threading
+import time
+import types
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+
+class _Ids:
+    """Token ids of one prompt, with the bits of the tensor API used by SharedModel."""
+
+    def __init__(self, ids):
+        self.ids = list(ids)
+
+    @property
+    def shape(self):
+        return (1, len(self.ids))
+
+    def to(self, device):
+        return self
+
+    def __getitem__(self, index):
+        _, columns = index
+        return _Ids(self.ids[columns])
+
+
+class _Cache:
+    def __init__(self):
+        self.cropped = []
+
+    def crop(self, length):
+        self.cropped.append(length)
+
+
+class _Tokenizer:
+    padding_side = "right"
+    pad_token_id = 0
+
+    def __call__(self, text, return_tensors=None, add_special_tokens=True):
+        return types.SimpleNamespace(input_ids=_Ids(ord(char) for char in text))
+
+
+class _Processor:
+    def __init__(self):
+        self.tokenizer = _Tokenizer()
+
+    def batch_decode(self, ids, skip_special_tokens=True, clean_up_tokenization_spaces=False):
+        return [" ".join(str(i) for i in ids.ids)]
+
+
+class _Model:
+    def __init__(self):
+        self.rope_deltas = "stale"
+        self.prefix_calls = 0
+        self.deltas_at_generate = []
+
+    def __call__(self, input_ids, past_key_values, use_cache):
+        self.prefix_calls += 1
+
+    def generate(self, input_ids, attention_mask, past_key_values, max_new_tokens):
+        self.deltas_at_generate.append(self.rope_deltas)
+        return _Ids(input_ids.ids + [7] * max_new_tokens)
+
+
+@pytest.fixture
+def qwen(monkeypatch):
+    """llms/qwen.py loaded on stand-ins of torch, transformers and qwen_vl_utils, so no model is needed."""
+    torch = types.ModuleType("torch")
+    torch.long = "long"
+    torch.inference_mode = lambda: (lambda fn: fn)
+    torch.zeros = lambda shape, dtype=None, device=None: ("zeros", shape)
+    torch.cat = lambda tensors, dim: _Ids(i for tensor in tensors for i in tensor.ids)
+    torch.ones_like = lambda tensor: None
+    transformers = types.ModuleType("transformers")
+    for name in ("Qwen2_5_VLForConditionalGeneration", "AutoTokenizer", "AutoProcessor", "BitsAndBytesConfig"):
+        setattr(transformers, name, object)
+    transformers.DynamicCache = _Cache
+    qwen_vl_utils = types.ModuleType("qwen_vl_utils")
+    qwen_vl_utils.process_vision_info = lambda messages: (None, None)
+    monkeypatch.setitem(sys.modules, "torch", torch)
+    monkeypatch.setitem(sys.modules, "transformers", transformers)
+    monkeypatch.setitem(sys.modules, "qwen_vl_utils", qwen_vl_utils)
+    pytest.importorskip("llms.base_llm")
+
+    spec = importlib.util.spec_from_file_location("llms._qwen_stubbed", ROOT / "llms" / "qwen.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _queue_and_generate(model, texts):
+    """Calls `generate` from one thread per text while the model is busy, so that the prompts queue up."""
+    outcomes = {}
+
+    def call(text):
+        try:
+            outcomes[text] = model.generate(text)
+        except Exception as e:
+            outcomes[text] = e
+
+    threads = [threading.Thread(target=call, args=(text,)) for text in texts]
+    with model._generate_lock:
+        for thread in threads:
+            thread.start()
+        while len(model._pending) < len(texts):
+            time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+def test_generate_batches_queued_prompts(qwen):
+    model = qwen.SharedModel(_Model(), _Processor(), "cpu", max_batch_size=2)
+    batches = []
+
+    def run(batch):
+        batches.append([request.text for request in batch])
+        for request in batch:
+            request.result = (request.text.upper(), 1, 1)
+
+    model._run = run
+    outcomes = _queue_and_generate(model, ["a", "b", "c"])
+
+    assert outcomes == {"a": ("A", 1, 1), "b": ("B", 1, 1), "c": ("C", 1, 1)}
+    assert sorted(len(batch) for batch in batches) == [1, 2]
+
+
+def test_generate_raises_the_error_of_a_batch_in_each_of_its_callers(qwen):
+    model = qwen.SharedModel(_Model(), _Processor(), "cpu", max_batch_size=4)
+
+    def run(batch):
+        raise RuntimeError("out of memory")
+
+    model._run = run
+    outcomes = _queue_and_generate(model, ["a", "b"])
+
+    assert all(isinstance(outcome, RuntimeError) for outcome in outcomes.values())
+    assert model._pending == []
+
+
+def test_configure_evicts_the_oldest_prefixes(qwen):
+    model = qwen.SharedModel(_Model(), _Processor(), "cpu", prefix_cache_size=3)
+    for prefix in ("first", "second", "third"):
+        model._prefix(prefix)
+
+    model.configure(max_batch_size=8, max_new_tokens=64, prefix_cache_size=1)
+
+    assert (model.max_batch_size, model.max_new_tokens, model.prefix_cache_size) == (8, 64, 1)
+    assert list(model._prefixes) == [qwen.hashlib.sha256(b"third").hexdigest()]
+
+
+def test_generate_with_prefix_reuses_the_prefix_and_resets_the_rope_deltas(qwen):
+    fake = _Model()
+    model = qwen.SharedModel(fake, _Processor(), "cpu", max_new_tokens=2)
+
+    assert model.generate_with_prefix("ab", "cd") == ("7 7", 4, 2)
+    # an image batch in between leaves rope deltas of its own
+    fake.rope_deltas = "stale"
+    assert model.generate_with_prefix("ab", "cd") == ("7 7", 4, 2)
+
+    assert fake.prefix_calls == 1
+    assert fake.deltas_at_generate == [("zeros", (1, 1))] * 2
+    _, cache = model._prefix("ab")
+    assert cache.cropped == [2, 2]
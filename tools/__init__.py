@@ -1,8 +1,24 @@
-from .qwen_tts import Qwentts
-from .wanxiang_video import Wanxiang_video
-from .wanxiang_image import Wanxiang_image
-from .tavus import TavusClient
-#from .gemini import GEMINI
+import importlib
 
 
-__all__ = ["Qwentts", "Wanxiang_video","Wanxiang_image", "TavusClient"]
+# tools are imported on first access, so a run only loads the SDKs it uses
+_LAZY_ATTRS = {
+    "Qwentts": ".qwen_tts",
+    "Wanxiang_video": ".wanxiang_video",
+    "Wanxiang_image": ".wanxiang_image",
+    "WanxiangAsync": ".wanxiang_async",
+    "TavusClient": ".tavus",
+}
+
+
+def __getattr__(name: str):
+    if name in _LAZY_ATTRS:
+        return getattr(importlib.import_module(_LAZY_ATTRS[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> list[str]:
+    return sorted(__all__)
+
+
+__all__ = ["Qwentts", "Wanxiang_video","Wanxiang_image", "WanxiangAsync", "TavusClient"]
@@ -9,9 +9,10 @@ import time
 from pathlib import Path
 from typing import Dict, Optional
 
-import requests
 from tqdm import tqdm
 
+from utils.http import get_session
+
 # ---------- setting----------
 TAVUS_API_ROOT = "https://tavusapi.com/v2/videos"
 # --------------------------
@@ -39,7 +40,7 @@ class TavusClient:
             "audio_url": audio,
             "callback_url": "",
         }
-        resp = requests.post(TAVUS_API_ROOT, headers=self.headers, json=payload, timeout=30)
+        resp = get_session().post(TAVUS_API_ROOT, headers=self.headers, json=payload, timeout=30)
         resp.raise_for_status()
         data: Dict = resp.json()
         video_id = data.get("video_id") or data.get("id")
@@ -50,7 +51,7 @@ class TavusClient:
     # ---------- 2. query ----------
     def get_status(self, video_id: str) -> Dict:
         url = f"{TAVUS_API_ROOT}/{video_id}"
-        resp = requests.get(url, headers=self.headers, timeout=30)
+        resp = get_session().get(url, headers=self.headers, timeout=30)
         resp.raise_for_status()
         return resp.json()
 
@@ -81,7 +82,7 @@ class TavusClient:
     # ---------- 4. 下载 ----------
     def download(self, download_url: str, save_path: Path) -> Path:
         """with bar"""
-        resp = requests.get(download_url, stream=True, timeout=30)
+        resp = get_session().get(download_url, stream=True, timeout=30)
         resp.raise_for_status()
         total = int(resp.headers.get("content-length", 0))
         with open(save_path, "wb") as f, tqdm(
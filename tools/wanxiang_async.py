@@ -0,0 +1,251 @@
+import asyncio
+import threading
+from pathlib import Path
+from typing import AsyncIterator, Callable, Hashable, Optional
+
+import httpx
+import yaml
+
+from utils.http import get_async_client
+
+
+VIDEO_SYNTHESIS_URL = "https://dashscope.aliyuncs.com/api/v1/services/aigc/video-generation/video-synthesis"
+IMAGE_SYNTHESIS_URL = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text2image/image-synthesis"
+TASK_STATUS_URL = "https://dashscope.aliyuncs.com/api/v1/tasks/"
+# seconds per REST call, the tasks themselves are polled until `timeout`
+REQUEST_TIMEOUT = 30
+
+
+class WanxiangAsync:
+    """Submits Wanxiang video and image tasks up front and polls every outstanding task together.
+
+    Args:
+        config_path (Path, optional): Path to the config file. Defaults to Path("config.yml").
+        max_in_flight (int, optional): Maximum number of tasks submitted but not finished. Defaults to 8.
+        min_interval (float, optional): Delay before the first poll, and after a poll in which a task finished. Defaults to 2.
+        max_interval (float, optional): Polls back off by `backoff` up to this delay while nothing finishes. Defaults to 15.
+        backoff (float, optional): Growth factor of the poll interval. Defaults to 1.5.
+        timeout (float, optional): Shared deadline in seconds for all tasks of one call. Defaults to 1200.
+        slots (threading.Semaphore | None, optional): Budget of tasks in flight shared with other callers, e.g. the
+            "wanx" slots of a ToolLimiter. Each task holds one slot from submission until it ends. Defaults to None.
+    """
+
+    def __init__(self,
+                 config_path: Path = Path("config.yml"),
+                 max_in_flight: int = 8,
+                 min_interval: float = 2,
+                 max_interval: float = 15,
+                 backoff: float = 1.5,
+                 timeout: float = 1200,
+                 slots: Optional[threading.Semaphore] = None,
+                 ):
+        with open(config_path, "r") as f:
+            self.cfg: dict = yaml.safe_load(f)
+        self.api_key = self.cfg["alibaba"]["API_KEY"]
+        # same models and sizes as Wanxiang_video / Wanxiang_image
+        self.tasks = {
+            "video": {"url": VIDEO_SYNTHESIS_URL, "model": self.cfg["alibaba"]["T2V_MODEL"],
+                      "size": self.cfg["alibaba"]["VIDEO_SIZE"]},
+            "image": {"url": IMAGE_SYNTHESIS_URL, "model": self.cfg["alibaba"]["T2I_MODEL"],
+                      "size": self.cfg["alibaba"]["IMAGE_SIZE"]},
+        }
+        assert max_in_flight >= 1, "max_in_flight should be at least 1."
+        self.max_in_flight = max_in_flight
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+        self.slots = slots
+
+        self.headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "X-DashScope-Async": "enable"
+            }
+
+    async def submit(self, client: httpx.AsyncClient, prompt: str, kind: str = "video") -> Optional[str]:
+        """Creates a task and returns its ID, or None if it could not be created."""
+        task = self.tasks[kind]
+        payload = {
+            "model": task["model"],
+            "input": {"prompt": prompt},
+            "parameters": {"size": task["size"], "n": 1},
+        }
+        try:
+            response = await client.post(task["url"], headers=self.headers, json=payload, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            return response.json()["output"]["task_id"]
+        except (httpx.HTTPError, KeyError) as e:
+            print(f"creating task failed: {e}")
+            return None
+
+    async def status(self, client: httpx.AsyncClient, task_id: str, kind: str = "video") -> tuple[str, Optional[str]]:
+        """Returns the status of a task and its result URL once it succeeded."""
+        try:
+            response = await client.get(f"{TASK_STATUS_URL}{task_id}", headers=self.headers, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            output = response.json()["output"]
+        except (httpx.HTTPError, KeyError) as e:
+            # transient, the task is polled again in the next round
+            print(f"checking status failed: {e}")
+            return "UNKNOWN", None
+        task_status = output["task_status"]
+        if task_status != "SUCCEEDED":
+            return task_status, None
+        if kind == "video":
+            return task_status, output["video_url"]
+        return task_status, output["results"][0]["url"]
+
+    async def cancel(self, client: httpx.AsyncClient, task_id: str) -> None:
+        """Cancels a task that has not started running. Running tasks cannot be cancelled and are left to finish."""
+        try:
+            response = await client.post(f"{TASK_STATUS_URL}{task_id}/cancel", headers=self.headers,
+                                         timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            print(f"cancelling task {task_id} failed: {e}")
+
+    def _take_slots(self, n: int) -> int:
+        """Takes up to `n` shared slots without waiting and returns how many were taken."""
+        if self.slots is None:
+            return n
+        taken = 0
+        while taken < n and self.slots.acquire(blocking=False):
+            taken += 1
+        return taken
+
+    def _release_slot(self) -> None:
+        if self.slots is not None:
+            self.slots.release()
+
+    async def as_completed(self, jobs: dict[Hashable, tuple[str, str]]
+                           ) -> AsyncIterator[tuple[Hashable, Optional[str]]]:
+        """Runs `jobs`, a dict of key -> (kind, prompt) with kind "video" or "image", and yields (key, url) in order of completion.
+
+        The URL is None for tasks that could not be created, failed or missed the deadline. Tasks still
+        pending when the iteration stops early, at the deadline or by closing or cancelling it, are cancelled.
+        """
+        queue = list(jobs.items())
+        pending: dict[Hashable, tuple[str, str]] = {}  # key -> (kind, task_id)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        interval = self.min_interval
+        # pooled connections of the event loop, shared with the other async REST calls made on it
+        client = get_async_client()
+        try:
+            while queue or pending:
+                # keep up to max_in_flight tasks submitted, within the slots left by other callers
+                n_slots = self._take_slots(min(len(queue), self.max_in_flight - len(pending)))
+                to_submit = queue[:n_slots]
+                queue = queue[n_slots:]
+                task_ids = await asyncio.gather(
+                    *[self.submit(client, prompt, kind) for _, (kind, prompt) in to_submit])
+                for (key, (kind, _)), task_id in zip(to_submit, task_ids):
+                    if task_id is None:
+                        self._release_slot()
+                        yield key, None
+                    else:
+                        pending[key] = (kind, task_id)
+
+                if loop.time() > deadline:
+                    print(f"{len(pending) + len(queue)} tasks missed the deadline of {self.timeout}s")
+                    for key, _ in list(pending.items()) + queue:
+                        yield key, None
+                    return
+                if not pending:
+                    if queue:
+                        # every slot is taken by other callers
+                        await asyncio.sleep(self.min_interval)
+                    continue
+
+                await asyncio.sleep(interval)
+                keys = list(pending)
+                results = await asyncio.gather(
+                    *[self.status(client, pending[key][1], pending[key][0]) for key in keys])
+                finished = False
+                for key, (task_status, url) in zip(keys, results):
+                    if task_status == "SUCCEEDED":
+                        del pending[key]
+                        self._release_slot()
+                        finished = True
+                        yield key, url
+                    elif task_status in ("FAILED", "CANCELED", "UNKNOWN_TASK"):
+                        print(f"task {pending[key][1]} ended with status {task_status}")
+                        del pending[key]
+                        self._release_slot()
+                        finished = True
+                        yield key, None
+                # poll again soon after progress, back off while everything is still running
+                interval = self.min_interval if finished else min(interval * self.backoff, self.max_interval)
+        finally:
+            for _, task_id in pending.values():
+                self._release_slot()
+                await self.cancel(client, task_id)
+
+    def run(self,
+            jobs: dict[Hashable, tuple[str, str]],
+            on_result: Optional[Callable[[Hashable, Optional[str]], None]] = None,
+            ) -> dict[Hashable, Optional[str]]:
+        """Blocking wrapper of `as_completed`. Calls `on_result(key, url)` in a worker thread as each task completes, and returns all URLs."""
+        async def collect() -> dict[Hashable, Optional[str]]:
+            urls = {}
+            callbacks = []
+            async for key, url in self.as_completed(jobs):
+                urls[key] = url
+                if on_result is not None:
+                    callbacks.append(asyncio.create_task(asyncio.to_thread(on_result, key, url)))
+            await asyncio.gather(*callbacks)
+            return urls
+
+        return asyncio.run(collect())
+
+    def first_accepted(self,
+                       jobs: dict[Hashable, tuple[str, str]],
+                       accept: Callable[[Hashable, Optional[str]], bool],
+                       ) -> Optional[Hashable]:
+        """Runs `jobs` and calls `accept(key, url)` in a worker thread for each task as it completes.
+
+        Returns the key of the first task accepted, after cancelling the tasks still pending,
+        or None if no task is accepted. Checks already running cannot be interrupted, so they are
+        waited for before returning.
+        """
+        async def search() -> Optional[Hashable]:
+            results: asyncio.Queue = asyncio.Queue()
+
+            async def produce():
+                try:
+                    async for key, url in self.as_completed(jobs):
+                        results.put_nowait((key, url))
+                finally:
+                    results.put_nowait(None)
+
+            producer = asyncio.create_task(produce())
+            checks: dict[asyncio.Task, Hashable] = {}
+            next_result = asyncio.create_task(results.get())
+            exhausted = False
+            try:
+                while not exhausted or checks:
+                    waiting = set(checks) if exhausted else set(checks) | {next_result}
+                    done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task is next_result:
+                            result = task.result()
+                            if result is None:
+                                exhausted = True
+                                continue
+                            key, url = result
+                            checks[asyncio.create_task(asyncio.to_thread(accept, key, url))] = key
+                            next_result = asyncio.create_task(results.get())
+                        else:
+                            key = checks.pop(task)
+                            if task.result():
+                                return key
+                # surface errors of the polling loop
+                await producer
+                return None
+            finally:
+                next_result.cancel()
+                producer.cancel()
+                await asyncio.gather(producer, *checks, return_exceptions=True)
+
+        return asyncio.run(search())
@@ -4,6 +4,7 @@ from typing import Optional
 import time
 from dashscope import ImageSynthesis
 import yaml
+from utils.http import get_session
 
 
 IMAGE_SYNTHESIS_URL = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text2image/image-synthesis"
@@ -49,7 +50,7 @@ class Wanxiang_image():
             }
         }
         try:
-            response = requests.post(IMAGE_SYNTHESIS_URL, headers=self.headers, json=payload)
+            response = get_session().post(IMAGE_SYNTHESIS_URL, headers=self.headers, json=payload)
             response.raise_for_status()
             data = response.json()
             return data["output"]["task_id"]
@@ -60,7 +61,7 @@ class Wanxiang_image():
     def check_task_status(self, task_id: str) -> Optional[str]:
         status_url = f"{TASK_STATUS_URL}{task_id}"
         try:
-            response = requests.get(status_url, headers=self.headers)
+            response = get_session().get(status_url, headers=self.headers)
             response.raise_for_status()
             data = response.json()
             if data["output"]["task_status"] == "SUCCEEDED":
@@ -75,10 +76,10 @@ class Wanxiang_image():
             print(f"checking status fail: {e}")
             return None
 
-    def query(self, prompt: str):
+    def query(self, prompt: str, timeout: float = 1200):
    
         print("creating task...")
-        task_id = self.create_task(prompt)
+        task_id = self.create_task(prompt, model=self.model, size=self.video_size)
         if not task_id:
             print("fail to create task, please check internet and API usage")
             return
@@ -86,12 +87,15 @@ class Wanxiang_image():
         print(f"task is created with ID: {task_id}")
         print("checking status...")
 
-        while True:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
             result_url = self.check_task_status(task_id)
             if result_url:
                 print(f"task is done, URL: {result_url}")
                 return result_url
             time.sleep(5)
+        print(f"task {task_id} is not completed after {timeout}s")
+        return None
 
 
 
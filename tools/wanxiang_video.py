@@ -4,6 +4,7 @@ from typing import Optional
 import time
 from dashscope import ImageSynthesis
 import yaml
+from utils.http import get_session
 
 
 IMAGE_SYNTHESIS_URL = "https://dashscope.aliyuncs.com/api/v1/services/aigc/video-generation/video-synthesis"
@@ -24,10 +25,10 @@ class Wanxiang_video():
             self.cfg = None
         self.api_key = self.cfg["alibaba"]["API_KEY"]
         if model is None:
-            self.model = self.cfg["alibaba"]["T2I_MODEL"]
+            self.model = self.cfg["alibaba"]["T2V_MODEL"]
         else:
             self.model = model
-        self.video_size = self.cfg["alibaba"]["IMAGE_SIZE"]
+        self.video_size = self.cfg["alibaba"]["VIDEO_SIZE"]
 
         self.synthesizer = ImageSynthesis()
 
@@ -49,7 +50,7 @@ class Wanxiang_video():
             }
         }
         try:
-            response = requests.post(IMAGE_SYNTHESIS_URL, headers=self.headers, json=payload)
+            response = get_session().post(IMAGE_SYNTHESIS_URL, headers=self.headers, json=payload)
             response.raise_for_status()
             data = response.json()
             return data["output"]["task_id"]
@@ -60,7 +61,7 @@ class Wanxiang_video():
     def check_task_status(self, task_id: str) -> Optional[str]:
         status_url = f"{TASK_STATUS_URL}{task_id}"
         try:
-            response = requests.get(status_url, headers=self.headers)
+            response = get_session().get(status_url, headers=self.headers)
             response.raise_for_status()
             data = response.json()
             if data["output"]["task_status"] == "SUCCEEDED":
@@ -75,10 +76,10 @@ class Wanxiang_video():
             print(f"checking status failed: {e}")
             return None
 
-    def query(self, prompt: str):
+    def query(self, prompt: str, timeout: float = 1200):
    
         print("creating task...")
-        task_id = self.create_task(prompt)
+        task_id = self.create_task(prompt, model=self.model, size=self.video_size)
         if not task_id:
             print("creating task failed, please check API key and internet")
             return
@@ -86,12 +87,15 @@ class Wanxiang_video():
         print(f"task is created with ID: {task_id}")
         print("checking task status...")
 
-        while True:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
             result_url = self.check_task_status(task_id)
             if result_url:
                 print(f"task is completed with URL: {result_url}")
                 return result_url
             time.sleep(5)
+        print(f"task {task_id} is not completed after {timeout}s")
+        return None
 
 
 
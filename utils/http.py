@@ -0,0 +1,74 @@
+import asyncio
+import threading
+import weakref
+from typing import Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# keep-alive connections kept per host, shared by every thread of the process
+DEFAULT_POOL_MAXSIZE = 16
+# hosts whose pools are kept at the same time
+POOL_CONNECTIONS = 32
+
+_session: Optional[requests.Session] = None
+_settings: dict = {"pool_maxsize": DEFAULT_POOL_MAXSIZE, "host_pool_maxsize": {}, "block": False}
+_lock = threading.Lock()
+# async clients are bound to the event loop they were created on
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+
+def configure_session(pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+                      host_pool_maxsize: Optional[dict[str, int]] = None,
+                      block: bool = False) -> None:
+    """Sets the connection pools of the shared session. If they change, the next `get_session` builds a new
+    session. Requests in flight finish on the old one, which is dropped rather than closed under them.
+
+    Args:
+        pool_maxsize (int, optional): Connections kept alive per host. Defaults to DEFAULT_POOL_MAXSIZE.
+        host_pool_maxsize (dict[str, int] | None, optional): Overrides per URL prefix, e.g. {"https://dashscope.aliyuncs.com": 8}. Defaults to None.
+        block (bool, optional): Whether a request waits for a free connection when the pool of its host is full, which turns the pool size into a per-host limit. Otherwise an extra connection is opened and discarded after use. Defaults to False.
+    """
+    global _session
+    assert pool_maxsize >= 1, "pool_maxsize should be at least 1."
+    settings = {"pool_maxsize": pool_maxsize, "host_pool_maxsize": dict(host_pool_maxsize or {}), "block": block}
+    with _lock:
+        if settings == _settings:
+            return
+        _settings.update(settings)
+        # its connections are released when the last thread using it lets go
+        _session = None
+
+
+def get_session() -> requests.Session:
+    """Returns the session shared by the REST clients, which keeps connections alive across requests and threads."""
+    global _session
+    with _lock:
+        if _session is None:
+            session = requests.Session()
+            for prefix in ("https://", "http://"):
+                session.mount(prefix, HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                                                  pool_maxsize=_settings["pool_maxsize"],
+                                                  pool_block=_settings["block"]))
+            # longer prefixes are matched first by requests
+            for prefix, maxsize in _settings["host_pool_maxsize"].items():
+                session.mount(prefix, HTTPAdapter(pool_maxsize=maxsize, pool_block=_settings["block"]))
+            _session = session
+        return _session
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Returns the pooled async client of the running event loop, shared by the async REST calls made on it."""
+    loop = asyncio.get_running_loop()
+    with _lock:
+        client = _async_clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(max_keepalive_connections=_settings["pool_maxsize"]),
+                # LLM responses can take minutes
+                timeout=httpx.Timeout(600, connect=30),
+            )
+            _async_clients[loop] = client
+        return client
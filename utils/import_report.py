@@ -0,0 +1,69 @@
+"""Reports what importing a module costs, from the `-X importtime` output of a fresh interpreter.
+
+Usage:
+    python -m utils.import_report pipeline.preacher
+    python -m utils.import_report llms --top 30
+"""
+import argparse
+import subprocess
+import sys
+from collections import defaultdict
+
+
+def import_times(module: str) -> tuple[list[tuple[str, int, int]], str]:
+    """Imports `module` in a fresh interpreter.
+
+    Returns:
+        rows (list[tuple[str, int, int]]): Name, self time and cumulative time in microseconds of every imported module.
+        error (str): Last line of the error if the import failed, else "".
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True)
+    rows = []
+    other_lines = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            other_lines.append(line)
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            rows.append((fields[2].strip(), int(fields[0]), int(fields[1])))
+        except (IndexError, ValueError):
+            # the header line
+            continue
+    error = other_lines[-1] if result.returncode != 0 and other_lines else ""
+    return rows, error
+
+
+def report(module: str, top: int = 20) -> str:
+    """Formats the total import time of `module`, the slowest imported modules and the time per top-level package."""
+    rows, error = import_times(module)
+    by_package = defaultdict(int)
+    for name, self_us, _ in rows:
+        by_package[name.split(".")[0]] += self_us
+    total_us = sum(self_us for _, self_us, _ in rows)
+
+    lines = [f"Importing {module}: {total_us / 1e6:.2f} s, {len(rows)} modules"]
+    if error:
+        lines.append(f"(the import failed: {error})")
+    lines.append("")
+    lines.append(f"Top {top} packages by own import time:")
+    for package, self_us in sorted(by_package.items(), key=lambda item: -item[1])[:top]:
+        lines.append(f"  {self_us / 1e3:10.1f} ms  {package}")
+    lines.append("")
+    lines.append(f"Top {top} modules by cumulative import time:")
+    for name, _, cumulative_us in sorted(rows, key=lambda row: -row[2])[:top]:
+        lines.append(f"  {cumulative_us / 1e3:10.1f} ms  {name}")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Report the import time of a module and of what it imports.")
+    parser.add_argument("module", help="module to import, e.g. pipeline.preacher")
+    parser.add_argument("--top", type=int, default=20, help="number of packages and modules listed")
+    args = parser.parse_args()
+    print(report(args.module, args.top))
+
+
+if __name__ == "__main__":
+    main()
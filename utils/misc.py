@@ -1,10 +1,12 @@
 from pathlib import Path
 from base64 import b64encode
+from functools import lru_cache
 from typing import Union
 import base64
+import hashlib
 import os
-import requests
 from tqdm import tqdm
+from utils.http import get_session
 
 def encode_img(img_path: Union[Path, str]) -> str:
     """Encodes image to base64."""    
@@ -18,6 +20,22 @@ def encode_pdf(pdf_path: Union[Path, str]) -> str:
         return doc_data
 
 
+@lru_cache(maxsize=64)
+def _hash_file(path: str, mtime_ns: int, size: int) -> str:
+    # mtime and size are only part of the cache key, so an edited file is hashed again
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hash_file(file_path: Union[Path, str]) -> str:
+    """SHA-256 of the content of a file, computed once per file version."""
+    stat = os.stat(file_path)
+    return _hash_file(str(Path(file_path).resolve()), stat.st_mtime_ns, stat.st_size)
+
+
 def sorted_glob(dir_path: Path, pattern: str = "*") -> list[Path]:
     assert dir_path.is_dir(), f"{dir_path} is not a directory."
     return sorted(list(dir_path.glob(pattern)))
@@ -34,7 +52,7 @@ def download_file(url: str, local_path: Path, chunk_size: int = 8192) -> Path:
     local_path = Path(local_path)
     local_path.parent.mkdir(parents=True, exist_ok=True)  # 自动创建目录
 
-    with requests.get(url, stream=True, timeout=30) as r:
+    with get_session().get(url, stream=True, timeout=30) as r:
         r.raise_for_status()
         total = int(r.headers.get("content-length", 0))
         with open(local_path, "wb") as f, tqdm(
@@ -62,7 +80,7 @@ def name_to_pdb_ids(name: str) -> list[str]:
         "return_type": "entry"
     }
     try:
-        r = requests.post(url, json=payload, timeout=15)
+        r = get_session().post(url, json=payload, timeout=15)
         r.raise_for_status()
         return [hit["identifier"] for hit in r.json().get("result_set", [])]
     except Exception as e:
@@ -76,7 +94,7 @@ def download_pdb(pdb_id: str, dest_file: str) -> str | bool:
 
     url = f"https://files.rcsb.org/download/{pdb_id.upper()}.pdb"
     try:
-        with requests.get(url, stream=True, timeout=15) as r:
+        with get_session().get(url, stream=True, timeout=15) as r:
             r.raise_for_status()
             total = int(r.headers.get("content-length", 0))
             with open(dest_file, "wb") as f, tqdm(
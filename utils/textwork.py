@@ -1,15 +1,12 @@
-from openai import AzureOpenAI
-from typing_extensions import override
-from openai import AssistantEventHandler
-from textblob import TextBlob
 import re
 import json
+import threading
+from functools import lru_cache
+from pathlib import Path
 
-from docling.datamodel.base_models import InputFormat
-from docling.datamodel.pipeline_options import PdfPipelineOptions
-from docling.document_converter import DocumentConverter, PdfFormatOption
+from typing import Any, Dict, List, Optional, Union
 
-from typing import Any, Dict, List, Union
+from utils.misc import hash_file
 
 try:
     import demjson3  # pip install demjson3
@@ -23,22 +20,69 @@ except ImportError:
 
 JSONType = Union[Dict[str, Any], List[Any]]
 
-def read_pdf(pdf):
+# markdown of the PDFs converted so far, by file hash
+MARKDOWN_CACHE_DIR = Path("cache/markdown")
+_markdown: dict[str, str] = {}
+_markdown_locks: dict[str, threading.Lock] = {}
+_markdown_lock = threading.Lock()
+
+
+@lru_cache(maxsize=2)
+def _pdf_converter(text_only: bool):
+    # docling is only needed by the local backends, which read the PDF themselves
+    from docling.datamodel.base_models import InputFormat
+    from docling.datamodel.pipeline_options import PdfPipelineOptions
+    from docling.document_converter import DocumentConverter, PdfFormatOption
+
     pipeline_options = PdfPipelineOptions()
-    pipeline_options.images_scale = 5.0
-    pipeline_options.generate_page_images = True
-    pipeline_options.generate_picture_images = True
+    if not text_only:
+        pipeline_options.images_scale = 5.0
+        pipeline_options.generate_page_images = True
+        pipeline_options.generate_picture_images = True
 
-    doc_converter = DocumentConverter(
+    return DocumentConverter(
         format_options={
             InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options)
         }
     )
-    raw_result = doc_converter.convert(pdf)
 
-    raw_markdown = raw_result.document.export_to_markdown()
-    text_content = re.compile(r"<!--[\s\S]*?-->").sub("", raw_markdown)
-    return text_content
+
+def read_pdf(pdf, text_only: bool = True, cache_dir: Optional[Path] = MARKDOWN_CACHE_DIR) -> str:
+    """Converts a PDF to markdown, without the image placeholders.
+
+    The markdown is memoized by the hash of the file, in memory and in `cache_dir`, so each
+    version of a PDF is parsed once.
+
+    Args:
+        pdf (Path | str): Path to the PDF.
+        text_only (bool, optional): Whether to skip rendering the page and picture images, which the markdown does not contain. Defaults to True.
+        cache_dir (Path | None, optional): Directory of the markdown cache on disk, None to only memoize in memory. Defaults to MARKDOWN_CACHE_DIR.
+    """
+    key = hash_file(pdf)
+    with _markdown_lock:
+        if key in _markdown:
+            return _markdown[key]
+        # threads reading the same PDF wait for one conversion
+        lock = _markdown_locks.setdefault(key, threading.Lock())
+    with lock:
+        if key in _markdown:
+            return _markdown[key]
+        cache_path = Path(cache_dir) / f"{key}.md" if cache_dir is not None else None
+        if cache_path is not None and cache_path.exists():
+            text_content = cache_path.read_text(encoding="utf-8")
+        else:
+            raw_result = _pdf_converter(text_only).convert(pdf)
+
+            raw_markdown = raw_result.document.export_to_markdown()
+            text_content = re.compile(r"<!--[\s\S]*?-->").sub("", raw_markdown)
+            if cache_path is not None:
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = cache_path.with_suffix(".tmp")
+                tmp_path.write_text(text_content, encoding="utf-8")
+                tmp_path.replace(cache_path)
+        with _markdown_lock:
+            _markdown[key] = text_content
+        return text_content
 
 def classify_response(text):
     # Define keywords for affirmative and negative responses
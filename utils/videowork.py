@@ -151,8 +151,8 @@ def image_to_video(image_path, audio_path, video_duration, output_path):
     # create a  CompositeVideoClip 
     video = CompositeVideoClip([centered_image_clip], size=(video_width, video_height))
 
-    # save temp document
-    temp_video_path = "temp_video.mp4"
+    # save temp document next to the output, so concurrent scenes do not share it
+    temp_video_path = str(Path(output_path).with_name(Path(output_path).stem + "_temp.mp4"))
     video.write_videofile(temp_video_path, fps=24)  # 可以根据需要调整帧率
 
     # use merge_video_audio to adjust time duration